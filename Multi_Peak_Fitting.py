@@ -1,24 +1,161 @@
 from lmfit import Minimizer, Parameters, report_fit, Model
 import numpy as np
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+from tkinter import ttk, filedialog, messagebox, simpledialog
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.container import ErrorbarContainer
 import csv
 from itertools import zip_longest
 import sys
 import os
-import re
-from scipy.special import wofz
+import threading
+import multiprocessing
+import time
+
+import batch_fit
+import csv_loader
+import data_cache
+import fit_cache
+import fit_engine
+import global_fit
+import multistart
+import peak_detect
+import solvers
+import trf_fit
+import uncertainty
 
 # cd C:\DATA_HK\python\fitting_software
 
 __version__ = '1.5.2'
 
+# 不確かさの推定結果のダイアログに表示するパラメータ数の上限 (残りは保存した CSV で見る)
+UNCERTAINTY_LINES = 30
+# 列選択ウィンドウのプレビューに一度に表示する行数と列数
+PREVIEW_ROWS = 15
+PREVIEW_COLUMNS = 8
+# follow モードでファイルの追記を確かめる間隔 [ms]
+FOLLOW_POLL_MS = 500
+
+
+class PreviewTable:
+    """列選択ウィンドウのデータのプレビュー
+
+    表示する範囲 (PREVIEW_ROWS 行 × PREVIEW_COLUMNS 列) のラベルだけを作って使い回し、スクロールすると
+    csv_loader.RowIndex でその行だけをファイルから読んで書き換える (ピークの表と同じ考え方)。
+    索引は別スレッドで作るので、まだ索引のない行は '...' にしておき (pending)、索引ができてから show で書き換える。
+    列番号か見出しをクリックすると on_click(列番号 (0始まり)) を呼ぶ。
+    """
+
+    def __init__(self, master, index, on_click):
+        self.index = index
+        self.row_offset = 0
+        self.column_offset = 0
+        self.marks = {}
+        # 表示している行に索引がまだなく、'...' にしている行があるか
+        self.pending = False
+        frame = tk.Frame(master)
+        self.frame = frame
+        # 列番号と見出し (クリックで列を選ぶ)
+        self.number_labels = []
+        self.header_labels = []
+        for j in range(PREVIEW_COLUMNS):
+            number = tk.Label(frame, font=("Arial", 10, "bold"), bg="lightgray", borderwidth=1, relief="solid", width=12)
+            number.grid(row=0, column=j+1, sticky="nsew", padx=2, pady=2)
+            header = tk.Label(frame, font=("Arial", 10, "bold"), borderwidth=1, relief="solid", width=12)
+            header.grid(row=1, column=j+1, sticky="nsew", padx=2, pady=2)
+            for label in (number, header):
+                label.bind("<Button-1>", lambda event, j=j: self.click(j, on_click))
+            self.number_labels.append(number)
+            self.header_labels.append(header)
+        # 行番号とデータ
+        self.row_labels = []
+        self.cell_labels = []
+        for i in range(PREVIEW_ROWS):
+            row_label = tk.Label(frame, fg="gray", width=8, anchor="e")
+            row_label.grid(row=i+2, column=0, sticky="nsew", padx=2)
+            self.row_labels.append(row_label)
+            cells = []
+            for j in range(PREVIEW_COLUMNS):
+                cell = tk.Label(frame, borderwidth=1, relief="solid", width=12, anchor="e")
+                cell.grid(row=i+2, column=j+1, sticky="nsew", padx=2, pady=2)
+                cells.append(cell)
+            self.cell_labels.append(cells)
+        self.v_scrollbar = ttk.Scrollbar(frame, orient="vertical", command=self.scroll_rows)
+        self.v_scrollbar.grid(row=2, column=PREVIEW_COLUMNS+1, rowspan=PREVIEW_ROWS, sticky="NS")
+        self.h_scrollbar = ttk.Scrollbar(frame, orient="horizontal", command=self.scroll_columns)
+        self.h_scrollbar.grid(row=PREVIEW_ROWS+2, column=1, columnspan=PREVIEW_COLUMNS, sticky="EW")
+        for widget in [frame] + self.row_labels + sum(self.cell_labels, []):
+            widget.bind("<MouseWheel>", lambda event: self.scroll_rows('scroll', -1 if event.delta > 0 else 1, 'units'))
+            widget.bind("<Button-4>", lambda event: self.scroll_rows('scroll', -1, 'units'))
+            widget.bind("<Button-5>", lambda event: self.scroll_rows('scroll', 1, 'units'))
+        self.show()
+
+    @property
+    def n_columns(self):
+        return len(self.index.header)
+
+    def click(self, j, on_click):
+        if self.column_offset + j < self.n_columns:
+            on_click(self.column_offset + j)
+
+    def mark(self, marks):
+        """列番号 (0始まり) → 見出しの背景色 の辞書で選んだ列に色を付ける"""
+        self.marks = marks
+        self.show()
+
+    def show(self):
+        """row_offset 行目、column_offset 列目から表示する (行は索引を作った範囲だけ読み、残りは '...')"""
+        n_rows = self.index.estimated_rows()
+        self.row_offset = max(0, min(self.row_offset, n_rows - PREVIEW_ROWS))
+        self.column_offset = max(0, min(self.column_offset, self.n_columns - PREVIEW_COLUMNS))
+        rows = self.index.rows(self.row_offset, self.row_offset + PREVIEW_ROWS, wait=False)
+        self.pending = False
+        for j in range(PREVIEW_COLUMNS):
+            col = self.column_offset + j
+            used = col < self.n_columns
+            color = self.marks.get(col, "lightgray")
+            self.number_labels[j].config(text=str(col + 1) if used else "", bg=color if used else "lightgray")
+            self.header_labels[j].config(text=self.index.header[col] if used else "")
+        for i in range(PREVIEW_ROWS):
+            row = rows[i] if i < len(rows) else None
+            # 索引をまだ作っていない行 (見積もった行数の内側)
+            waiting = row is None and not self.index.complete and self.row_offset + i < max(n_rows, PREVIEW_ROWS)
+            self.pending |= waiting
+            self.row_labels[i].config(text="" if row is None and not waiting else str(self.row_offset + i + 1))
+            for j, cell in enumerate(self.cell_labels[i]):
+                col = self.column_offset + j
+                if waiting:
+                    cell.config(text="..." if col < self.n_columns else "")
+                else:
+                    cell.config(text=row[col] if row is not None and col < len(row) else "")
+        n_rows = self.index.estimated_rows()
+        self.v_scrollbar.set(self.row_offset / max(n_rows, 1), min(1.0, (self.row_offset + PREVIEW_ROWS) / max(n_rows, 1)))
+        self.h_scrollbar.set(self.column_offset / max(self.n_columns, 1),
+                             min(1.0, (self.column_offset + PREVIEW_COLUMNS) / max(self.n_columns, 1)))
+
+    @staticmethod
+    def _offset(args, offset, n, page):
+        """スクロールバーの操作 ('moveto', 位置 / 'scroll', 量, 'units' or 'pages') から新しい位置を求める"""
+        if args[0] == 'moveto':
+            return int(round(float(args[1]) * n))
+        return offset + int(args[1]) * (page if args[2] == 'pages' else 1)
+
+    def scroll_rows(self, *args):
+        self.row_offset = self._offset(args, self.row_offset, self.index.estimated_rows(), PREVIEW_ROWS)
+        self.show()
+
+    def scroll_columns(self, *args):
+        self.column_offset = self._offset(args, self.column_offset, self.n_columns, PREVIEW_COLUMNS)
+        self.show()
+
 class FittingTool:
     def __init__(self, root):
         self.root = root
         self.root.title(f"Multi Peak Fitting    ver: {__version__}")
+        # データの読み込みの番号 (データビューの読み込みを始めるたびとデータを置き換えるたびに増やす。
+        # データビューの読み込みは、終わったときに番号が変わっていなければ表示する)
+        self.load_generation = 0
         
         # UI要素の初期化
         self.init_ui()
@@ -37,9 +174,10 @@ class FittingTool:
         
         # 配置のgrid
         self.columnshift = 1+6
-        # peakの個数を指定
+        # peakの個数 (ピークの表の行数、peaks の欄で変更できる) と一度に表示する行数
         self.num_peak = 10
-        self.rowshift = self.num_peak+3 # self.rowshiftを増やす場合はself.num_peak+3の数値に書き換えること。
+        self.visible_peaks = 10
+        self.rowshift = self.visible_peaks+3 # self.rowshiftを増やす場合はself.visible_peaks+3の数値に書き換えること。
 
         # グラフ表示用キャンバス
         self.figure, self.ax = plt.subplots()
@@ -104,6 +242,14 @@ class FittingTool:
         # フィットボタン
         self.fit_button = ttk.Button(self.root, text="Fit", command=self.fit_data)
         self.fit_button.grid(row=2, column=self.columnshift+1, sticky="NSEW")
+        
+        # 逐次フィットボタン (複数ファイルを順番にフィット)
+        self.sequential_button = ttk.Button(self.root, text="Sequential Fit", command=self.fit_sequential)
+        self.sequential_button.grid(row=0, column=3, sticky="NSEW")
+        
+        # グローバルフィットボタン (複数ファイルを同時にフィット)
+        self.global_button = ttk.Button(self.root, text="Global Fit", command=self.fit_global)
+        self.global_button.grid(row=0, column=4, sticky="NSEW")
 
         # 保存ボタン
         self.save_button = ttk.Button(self.root, text="Save CSV (Pure)", command=self.save_fitting_results0)
@@ -135,8 +281,8 @@ class FittingTool:
         for i in range(15):  # 0-15行までの設定
             self.root.rowconfigure(i, weight=1)
         
-    def update_axis_range(self):
-        """エントリーボックスの値に基づいてグラフの表示範囲を更新"""
+    def update_axis_range(self, draw=True):
+        """エントリーボックスの値に基づいてグラフの表示範囲を更新 (draw が False の場合は描き直さない)"""
         try:
             # エントリーボックスから値を取得
             ymax = float(self.range_entries[0].get()) if self.range_entries[0].get() else None
@@ -151,7 +297,8 @@ class FittingTool:
                 self.ax.set_ylim(ymin, ymax)
 
             # グラフを更新
-            self.canvas.draw()
+            if draw:
+                self.canvas.draw()
 
         except ValueError:
             print("Please enter a valid number in the entry box.")
@@ -162,8 +309,8 @@ class FittingTool:
             entry.bind("<FocusOut>", lambda event: self.update_axis_range())
             entry.bind("<Return>", lambda event: self.update_axis_range())
     
-    def update_vline(self):
-        """エントリーボックスの値に基づいてグラフの参照線を更新"""
+    def update_vline(self, draw=True):
+        """エントリーボックスの値に基づいてグラフの参照線を更新 (draw が False の場合は描き直さない)"""
         try:
             # エントリーボックスから値を取得
             fit_range1 = float(self.fit_range_entries[0].get()) if self.fit_range_entries[0].get() else None
@@ -181,7 +328,8 @@ class FittingTool:
                 self.ax.axvline(x=fit_range2, color='green', linestyle='--')
 
             # グラフを更新
-            self.canvas.draw()
+            if draw:
+                self.canvas.draw()
 
         except ValueError:
             print("Please enter a valid number in the entry box.")
@@ -192,6 +340,35 @@ class FittingTool:
             entry.bind("<FocusOut>", lambda event: self.update_vline())  # 修正済み
             entry.bind("<Return>", lambda event: self.update_vline())  # 修正済み
     
+    @staticmethod
+    def build_row_index(index, cancel):
+        """プレビューの行の索引を最後まで作る (別スレッドで実行し、cancel で止める)"""
+        try:
+            index.build(cancel=cancel)
+        except (csv_loader.LoadCancelled, OSError):
+            pass
+
+    def set_loaded_data(self, file_path, columns, data):
+        """読み込んだデータ (data_cache.cached_load_xye の結果) を x_data, y_data, y_error にする
+
+        follow モードで追記を読むためにファイル・列番号・読んだバイト数を覚え、前のファイルの follow は止める。
+        データビューで読み込み中のものは (このデータを置き換えないように) 表示しない。
+        """
+        self.load_generation += 1
+        self.x_data, self.y_data, self.y_error = data.x, data.y, data.y_error
+        self.data_source = (file_path, tuple(columns), data.offset)
+        self.follow_var.set(False)
+        self.toggle_follow()
+        # 前のデータの follow の状態 (再フィット中の結果は使わない)
+        self.tail = None
+        self.follow_fit = None
+        self.follow_fitted_offset = None
+
+    def show_parse_time(self, data):
+        """読み込んだ行数と時間をウィンドウのタイトルに表示する (data は data_cache.cached_load_xye の結果)"""
+        how = "loaded from cache" if data.cached else "parsed"
+        self.root.title(f"Multi Peak Fitting    ver: {__version__}    {self.file_name}: {data.n_rows} rows {how} in {data.elapsed:.3f} s")
+
     # エントリーボックスの数値のcolumnをデータビュー無で読み込み
     def load_csv(self):
         file_path = filedialog.askopenfilename(filetypes=[("CSV Files", "*.csv")])
@@ -199,41 +376,23 @@ class FittingTool:
             return
 
         try:
-            # CSVファイルを読み込む
-            with open(file_path, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                view_data = list(reader)
-
              # ファイル名の表示
             self.file_name = file_path.split('/')[-1]  # フルパスからファイル名だけを抽出
             
-            # ヘッダー行とデータ行を分離
-            header = view_data[0]
-            rows = view_data[1:]
-            
             # columnを自動入力
             x_col = int(float(self.data_column_entry[0].get()))-1
             y_col = int(float(self.data_column_entry[1].get()))-1
             err_col = int(float(self.data_column_entry[2].get()))-1
             
-            # ヘッダーをグラフの軸として表示する
-            self.X_title = header[x_col]
-            self.Y_title = header[y_col]
-            
-            # データの抽出
-            self.x_data = np.array([float(row[x_col]) if len(row) > x_col and row[x_col] != '' and row[x_col] != 'nan' else np.nan for row in rows])
-            self.y_data = np.array([float(row[y_col]) if len(row) > y_col and row[y_col] != '' and row[y_col] != 'nan' else np.nan for row in rows])
-            self.y_error = np.array([float(row[err_col]) if len(row) > err_col and row[err_col] != '' and row[err_col] != 'nan' else np.nan for row in rows])
-            # y_error が 1e-10 以下の場合は 1 に置き換え
-            self.y_error = np.where(self.y_error <= 1e-10, 1, self.y_error)
+            # CSVファイルから x, y, y_error の列だけを読み込む (y_error <= 1e-10 は 1 に、y が NaN の行は削除)。
+            # 前に読んだファイルはキャッシュ (npy ファイル) をメモリマップする
+            data = data_cache.cached_load_xye(file_path, x_col, y_col, err_col)
+            self.show_parse_time(data)
             
-            # NaNが含まれている行を削除するためのインデックス作成
-            valid_indices = ~np.isnan(self.y_data)  # y_data が NaN でない行を True にするマスク
-
-            # x_data, y_data, y_error をフィルタリング
-            self.x_data = self.x_data[valid_indices]
-            self.y_data = self.y_data[valid_indices]
-            self.y_error = self.y_error[valid_indices]
+            # ヘッダーをグラフの軸として表示する
+            self.X_title = data.header[x_col]
+            self.Y_title = data.header[y_col]
+            self.set_loaded_data(file_path, (x_col, y_col, err_col), data)
             
             # プロットを更新
             self.ax.clear()
@@ -266,6 +425,10 @@ class FittingTool:
             self.fit_range_entries[1].delete(0, tk.END)
             self.fit_range_entries[1].insert(0, f"{np.max(self.x_data):.4f}")
             
+            # 読み込むたびにピークを自動検出する
+            if self.auto_seed_var.get():
+                self.auto_seed()
+            
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load CSV file: {e}")
     
@@ -276,133 +439,216 @@ class FittingTool:
             return
 
         try:
-            # CSVファイルを読み込む
-            with open(file_path, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                view_data = list(reader)
-
-             # ファイル名の表示
-            self.file_name = file_path.split('/')[-1]  # フルパスからファイル名だけを抽出
-            
-            # ヘッダー行とデータ行を分離
-            header = view_data[0]
-            rows = view_data[1:]
+            # 見出しの行だけを読み、プレビューは表示する行だけをファイルから読む (数値の列は Apply で読む)
+            index = csv_loader.RowIndex(file_path)
+            header = index.header
 
             # 別ウィンドウでデータプレビューと列選択
             column_selector = tk.Toplevel(self.root)
             column_selector.title("Select Columns for Data")
 
-            # 列番号を表示
-            for col_index in range(len(header)):
-                tk.Label(column_selector, text=str(col_index + 1), font=("Arial", 10, "bold"), bg="lightgray", borderwidth=1, relief="solid").grid(row=0, column=col_index, sticky="nsew", padx=2, pady=2)
-                # tk.labelでないとbgを設定できない
-            # ヘッダーを表示
-            for col_index, col_name in enumerate(header):
-                tk.Label(column_selector, text=col_name, font=("Arial", 10, "bold"), borderwidth=1, relief="solid").grid(row=1, column=col_index, sticky="nsew", padx=2, pady=2)
-            
-            # データプレビューを表示（最大10行）
-            max_preview_rows = 10
-            for row_index, row in enumerate(rows[:max_preview_rows], start=2):
-                for col_index, value in enumerate(row):
-                    tk.Label(column_selector, text=value, borderwidth=1, relief="solid").grid(row=row_index, column=col_index, sticky="nsew", padx=2, pady=2)
+            # 列選択エントリ (見出しをクリックすると、選んでいる役割 (X → Y → Yerror の順に進む) の列にする)
+            role = tk.StringVar(value="X")
+            role_frame = tk.Frame(column_selector)
+            role_frame.grid(row=1, column=0, columnspan=4, pady=5, sticky="w")
+            tk.Label(role_frame, text="Click a column header to set :").pack(side="left")
+            for name in ("X", "Y", "Yerror"):
+                tk.Radiobutton(role_frame, text=name, variable=role, value=name).pack(side="left")
 
-            # 列選択エントリ
-            tk.Label(column_selector, text="X Column Index :").grid(row=max_preview_rows + 2, column=0, columnspan=2, pady=5, sticky="w")
+            tk.Label(column_selector, text="X Column Index :").grid(row=2, column=0, columnspan=2, pady=5, sticky="w")
             x_entry = tk.Entry(column_selector)
-            x_entry.grid(row=max_preview_rows + 2, column=2, columnspan=2, pady=5, sticky="w")
+            x_entry.grid(row=2, column=2, columnspan=2, pady=5, sticky="w")
             
-            tk.Label(column_selector, text="Y Column Index :").grid(row=max_preview_rows + 3, column=0, columnspan=2, pady=5, sticky="w")
+            tk.Label(column_selector, text="Y Column Index :").grid(row=3, column=0, columnspan=2, pady=5, sticky="w")
             y_entry = tk.Entry(column_selector)
-            y_entry.grid(row=max_preview_rows + 3, column=2, columnspan=2, pady=5, sticky="w")
+            y_entry.grid(row=3, column=2, columnspan=2, pady=5, sticky="w")
             
-            tk.Label(column_selector, text="Yerror Column Index :").grid(row=max_preview_rows + 4, column=0, columnspan=2, pady=5, sticky="w")
+            tk.Label(column_selector, text="Yerror Column Index :").grid(row=4, column=0, columnspan=2, pady=5, sticky="w")
             err_entry = tk.Entry(column_selector)
-            err_entry.grid(row=max_preview_rows + 4, column=2, columnspan=2, pady=5, sticky="w")
+            err_entry.grid(row=4, column=2, columnspan=2, pady=5, sticky="w")
+
+            role_entries = {"X": x_entry, "Y": y_entry, "Yerror": err_entry}
+            role_colors = {"X": "lightblue", "Y": "lightgreen", "Yerror": "khaki"}
+
+            def mark_columns(event=None):
+                """エントリーボックスの列の見出しに色を付ける"""
+                marks = {}
+                for name, entry in role_entries.items():
+                    try:
+                        marks[int(float(entry.get())) - 1] = role_colors[name]
+                    except ValueError:
+                        pass
+                preview.mark(marks)
+
+            def select_column(col):
+                entry = role_entries[role.get()]
+                entry.delete(0, tk.END)
+                entry.insert(0, col + 1)
+                names = list(role_entries)
+                role.set(names[(names.index(role.get()) + 1) % len(names)])
+                mark_columns()
+
+            # データのプレビュー (表示する行・列のラベルだけを作る)
+            preview = PreviewTable(column_selector, index, select_column)
+            preview.frame.grid(row=0, column=0, columnspan=4, padx=5, pady=5, sticky="nsew")
+            for entry in role_entries.values():
+                entry.bind("<KeyRelease>", mark_columns)
+
+            # 行数を決めるために索引を別スレッドで最後まで作る (索引を待っている行があれば索引ができしだい
+            # 書き換え、作り終わったらスクロールバーを更新する)
+            index_cancel = threading.Event()
+            index_thread = threading.Thread(target=lambda: self.build_row_index(index, index_cancel), daemon=True)
+            index_thread.start()
+
+            def poll_index():
+                if index_cancel.is_set() or not column_selector.winfo_exists():
+                    return
+                if index_thread.is_alive():
+                    if preview.pending:
+                        preview.show()
+                    self.root.after(100, poll_index)
+                else:
+                    preview.show()
+
+            poll_index()
+
+            # 読み込み中の進捗表示 (Apply の下)
+            progress_label = tk.Label(column_selector, text="")
+            progress_label.grid(row=5, column=0, columnspan=4, sticky="w")
+            cancel = threading.Event()
+
+            def show_data(data, x_col, y_col, err_col):
+                """読み込んだ列をグラフとエントリーボックスに表示する"""
+                # ファイル名の表示
+                self.file_name = file_path.split('/')[-1]  # フルパスからファイル名だけを抽出
+                # ヘッダーをグラフの軸として表示する
+                self.X_title = data.header[x_col]
+                self.Y_title = data.header[y_col]
+                self.show_parse_time(data)
+                self.set_loaded_data(file_path, (x_col, y_col, err_col), data)
+
+                # y_data に nan が含まれている行を削除
+                #valid_indices = ~np.isnan(self.y_data)  # y_data が nan でない行を True にするマスクを作成
+
+                # x_data, y_data, y_error をマスクでフィルタリング
+                #self.x_data = self.x_data[valid_indices]
+                #self.y_data = self.y_data[valid_indices]
+                #self.y_error = self.y_error[valid_indices]
+
+                # プロットを更新
+                self.ax.clear()
+                self.ax.errorbar(self.x_data, self.y_data, yerr=self.y_error, fmt='o', label="Data", color='blue')
+                self.ax.legend()
+                # タイトルを設定する。
+                self.ax.set_title(f"Selected file: {self.file_name}")
+                # x 軸のラベルを設定する。
+                self.ax.set_xlabel(self.X_title)
+                # y 軸のラベルを設定する。
+                self.ax.set_ylabel(self.Y_title)
+                self.canvas.draw()
+                
+                # axis rangeを自動入力
+                self.range_entries[0].delete(0, tk.END)
+                self.range_entries[0].insert(0, f"{np.max(self.y_data):.4f}")
+                self.range_entries[1].delete(0, tk.END)
+                self.range_entries[1].insert(0, f"{np.min(self.y_data):.4f}")
+                self.range_entries[2].delete(0, tk.END)
+                self.range_entries[2].insert(0, f"{np.min(self.x_data):.4f}")
+                self.range_entries[3].delete(0, tk.END)
+                self.range_entries[3].insert(0, f"{np.max(self.x_data):.4f}")
+                
+                # columnを自動入力
+                self.data_column_entry[0].delete(0, tk.END)
+                self.data_column_entry[0].insert(0, int(x_col+1))
+                self.data_column_entry[1].delete(0, tk.END)
+                self.data_column_entry[1].insert(0, int(y_col+1))
+                self.data_column_entry[2].delete(0, tk.END)
+                self.data_column_entry[2].insert(0, int(err_col+1)) 
+                
+                # fitting領域を自動入力。初期値は全範囲
+                self.fit_range_entries[0].delete(0, tk.END)
+                self.fit_range_entries[0].insert(0, f"{np.min(self.x_data):.4f}")
+                self.fit_range_entries[1].delete(0, tk.END)
+                self.fit_range_entries[1].insert(0, f"{np.max(self.x_data):.4f}")
 
-            # 適用ボタン
+                # 読み込むたびにピークを自動検出する
+                if self.auto_seed_var.get():
+                    self.auto_seed()
+
+                # 列選択ウィンドウを閉じる
+                index_cancel.set()
+                column_selector.destroy()
+
+            # 適用ボタン (選んだ列だけを別スレッドで読み込む)
             def apply_selection():
                 try:
                     # ユーザーの入力を取得
                     x_col = int(float(x_entry.get())) - 1
                     y_col = int(float(y_entry.get())) - 1
                     err_col = int(float(err_entry.get())) - 1
-                    
-                    # ヘッダーをグラフの軸として表示する
-                    self.X_title = header[x_col]
-                    self.Y_title = header[y_col]
-
-                    # 動的に列データを抽出（数値に変換
-                    #self.x_data = [float(row[x_col]) if len(row) > x_col and row[x_col] != '' else None for row in rows]
-                    #self.y_data = [float(row[y_col]) if len(row) > y_col and row[y_col] != '' else None for row in rows]
-                    #self.y_error = [float(row[err_col]) if len(row) > err_col and row[err_col] != '' else None for row in rows]
-                    
-                    #np.array([float(row[x_col]) if len(row) > x_col and row[x_col] != '' and row[x_col] != 'nan' else None for row in rows])
-                    
-                    self.x_data = np.array([float(row[x_col]) if len(row) > x_col and row[x_col] != '' and row[x_col] != 'nan' else np.nan for row in rows])
-                    self.y_data = np.array([float(row[y_col]) if len(row) > y_col and row[y_col] != '' and row[y_col] != 'nan' else np.nan for row in rows])
-                    self.y_error = np.array([float(row[err_col]) if len(row) > err_col and row[err_col] != '' and row[err_col] != 'nan' else np.nan for row in rows])
-                    # y_error が 1e-10 以下の場合は 1 に置き換え
-                    self.y_error = np.where(self.y_error <= 1e-10, 1, self.y_error)
-                    
-                    # NaNが含まれている行を削除するためのインデックス作成
-                    valid_indices = ~np.isnan(self.y_data)  # y_data が NaN でない行を True にするマスク
-
-                    # x_data, y_data, y_error をフィルタリング
-                    self.x_data = self.x_data[valid_indices]
-                    self.y_data = self.y_data[valid_indices]
-                    self.y_error = self.y_error[valid_indices]
-
-                    # y_data に nan が含まれている行を削除
-                    #valid_indices = ~np.isnan(self.y_data)  # y_data が nan でない行を True にするマスクを作成
-
-                    # x_data, y_data, y_error をマスクでフィルタリング
-                    #self.x_data = self.x_data[valid_indices]
-                    #self.y_data = self.y_data[valid_indices]
-                    #self.y_error = self.y_error[valid_indices]
-
-                    # プロットを更新
-                    self.ax.clear()
-                    self.ax.errorbar(self.x_data, self.y_data, yerr=self.y_error, fmt='o', label="Data", color='blue')
-                    self.ax.legend()
-                    # タイトルを設定する。
-                    self.ax.set_title(f"Selected file: {self.file_name}")
-                    # x 軸のラベルを設定する。
-                    self.ax.set_xlabel(self.X_title)
-                    # y 軸のラベルを設定する。
-                    self.ax.set_ylabel(self.Y_title)
-                    self.canvas.draw()
-                    
-                    # axis rangeを自動入力
-                    self.range_entries[0].delete(0, tk.END)
-                    self.range_entries[0].insert(0, f"{np.max(self.y_data):.4f}")
-                    self.range_entries[1].delete(0, tk.END)
-                    self.range_entries[1].insert(0, f"{np.min(self.y_data):.4f}")
-                    self.range_entries[2].delete(0, tk.END)
-                    self.range_entries[2].insert(0, f"{np.min(self.x_data):.4f}")
-                    self.range_entries[3].delete(0, tk.END)
-                    self.range_entries[3].insert(0, f"{np.max(self.x_data):.4f}")
-                    
-                    # columnを自動入力
-                    self.data_column_entry[0].delete(0, tk.END)
-                    self.data_column_entry[0].insert(0, int(x_col+1))
-                    self.data_column_entry[1].delete(0, tk.END)
-                    self.data_column_entry[1].insert(0, int(y_col+1))
-                    self.data_column_entry[2].delete(0, tk.END)
-                    self.data_column_entry[2].insert(0, int(err_col+1)) 
-                    
-                    # fitting領域を自動入力。初期値は全範囲
-                    self.fit_range_entries[0].delete(0, tk.END)
-                    self.fit_range_entries[0].insert(0, f"{np.min(self.x_data):.4f}")
-                    self.fit_range_entries[1].delete(0, tk.END)
-                    self.fit_range_entries[1].insert(0, f"{np.max(self.x_data):.4f}")
-
-                    # 列選択ウィンドウを閉じる
-                    column_selector.destroy()
+                    for col in (x_col, y_col, err_col):
+                        if not 0 <= col < len(header):
+                            raise ValueError(f"column {col + 1} does not exist")
                 except Exception as e:
                     messagebox.showerror("Error", f"Invalid column selection: {e}")
+                    return
+
+                apply_button.config(state="disabled")
+                state = {'progress': None, 'data': None, 'error': None}
+                # この読み込みの番号 (終わるまでに別の読み込みを始めたら、この結果は表示しない)
+                self.load_generation += 1
+                generation = self.load_generation
+
+                def progress(n_bytes, total):
+                    state['progress'] = (n_bytes, total)
+
+                def run():
+                    # 選んだ列だけを数値の配列として読み込む (y_error <= 1e-10 は 1 に、y が NaN の行は削除)
+                    try:
+                        state['data'] = data_cache.cached_load_xye(file_path, x_col, y_col, err_col,
+                                                                   progress=progress, cancel=cancel)
+                    except Exception as e:
+                        state['error'] = e
+
+                thread = threading.Thread(target=run, daemon=True)
+                thread.start()
+
+                def poll():
+                    # ウィンドウを閉じた、または後から別の読み込みを始めた (キャッシュから読むと cancel を見ずに終わる)
+                    if (cancel.is_set() or generation != self.load_generation
+                            or not column_selector.winfo_exists()):
+                        return
+                    if thread.is_alive():
+                        if state['progress'] is not None:
+                            n_bytes, total = state['progress']
+                            progress_label.config(text=f"Loading ... {n_bytes / 2**20:.0f} / {total / 2**20:.0f} MB "
+                                                       f"({100 * n_bytes / max(total, 1):.0f} %)")
+                        self.root.after(100, poll)
+                        return
+                    if isinstance(state['error'], csv_loader.LoadCancelled):
+                        return
+                    if state['error'] is not None:
+                        apply_button.config(state="normal")
+                        progress_label.config(text="")
+                        messagebox.showerror("Error", f"Failed to load CSV file: {state['error']}")
+                        return
+                    try:
+                        show_data(state['data'], x_col, y_col, err_col)
+                    except Exception as e:
+                        messagebox.showerror("Error", f"Invalid column selection: {e}")
+
+                poll()
+
+            # 読み込み中に閉じた場合は読み込みを止める
+            def close_selector():
+                cancel.set()
+                index_cancel.set()
+                column_selector.destroy()
+
+            column_selector.protocol("WM_DELETE_WINDOW", close_selector)
 
             apply_button = tk.Button(column_selector, text="Apply", command=apply_selection)
-            apply_button.grid(row=max_preview_rows + 6, column=0, columnspan=len(header), pady=10)
+            apply_button.grid(row=6, column=0, columnspan=4, pady=10)
 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load CSV file: {e}")            
@@ -554,13 +800,23 @@ class FittingTool:
         self.bg_entries = []  # バックグラウンドのエントリボックス
         self.bg_errors = []   # バックグラウンドの誤差表示用エントリボックス
         
-        # チェックボックスの作成
-        for i in range(self.num_peak):  # 最大self.num_peak個のガウシアン
+        # ピークの表の中身 (行ごとのチェックの状態とエントリーボックスの文字列)。
+        # エントリーボックスは表示する self.visible_peaks 行の分だけ作り、スクロールすると表示する行を入れ替える
+        # (ピーク数が多くてもウィジェットの数は変わらない)
+        self.peak_enabled = [False] * self.num_peak
+        self.peak_texts = [[""] * 5 for _ in range(self.num_peak)]
+        self.peak_error_texts = [[""] * 5 for _ in range(self.num_peak)]
+        self.peak_offset = 0
+        self.check_buttons = []
+
+        # チェックボックスの作成 (ピーク番号を表示)
+        for i in range(self.visible_peaks):
             # チェックボックス (初期状態でオフ)
             check_var = tk.BooleanVar(value=False)
-            checkbox = ttk.Checkbutton(self.root, variable=check_var, command=self.toggle_entry_state)
+            checkbox = ttk.Checkbutton(self.root, text=str(i+1), variable=check_var, command=self.toggle_entry_state)
             checkbox.grid(row=3 + i, column=self.columnshift+1, sticky="NSEW")
             self.checkboxes.append(check_var)
+            self.check_buttons.append(checkbox)
             
         # χ^2を表示する
         self.X2_entry = []
@@ -579,7 +835,7 @@ class FittingTool:
             self.bg_entries.append(bg_entry)  
             
         # ピーク関数のパラメータ
-        for i in range(self.num_peak):  # 最大self.num_peak個のピーク
+        for i in range(self.visible_peaks):  # 表示する行
             row_entries = []
             # 各ガウシアンのエントリボックス (Area, Center, FWHM)
             for j in range(5):# 擬voigt関数の場合5つ
@@ -596,7 +852,7 @@ class FittingTool:
             self.bg_errors.append(bg_error_entry)  
 
         # ピーク関数のパラメータの誤差        
-        for i in range(self.num_peak):  # 最大self.num_peak個のピーク
+        for i in range(self.visible_peaks):  # 表示する行
             row_errors = []
             # 各ガウシアンの誤差表示用エントリボックス (readonly)
             for j in range(5):
@@ -604,6 +860,24 @@ class FittingTool:
                 error_entry.grid(row=3 + i, column=self.columnshift+7+j, sticky="NSEW")
                 row_errors.append(error_entry)
             self.error_entries.append(row_errors)
+
+        # 表示する行をスクロールするスクロールバー (マウスホイールでも動かせる)
+        self.peak_scrollbar = ttk.Scrollbar(self.root, orient="vertical", command=self.scroll_peaks)
+        self.peak_scrollbar.grid(row=3, column=self.columnshift+12, rowspan=self.visible_peaks, sticky="NS")
+        for widget in self.check_buttons + sum(self.entries, []) + sum(self.error_entries, []):
+            widget.bind("<MouseWheel>", lambda event: self.scroll_peaks('scroll', -1 if event.delta > 0 else 1, 'units'))
+            widget.bind("<Button-4>", lambda event: self.scroll_peaks('scroll', -1, 'units'))
+            widget.bind("<Button-5>", lambda event: self.scroll_peaks('scroll', 1, 'units'))
+
+        # ピークの個数
+        ttk.Label(self.root, text="peaks : ").grid(row=2+self.visible_peaks+3, column=self.columnshift+1+1+5+1, sticky="NSEW")
+        self.peak_count = tk.StringVar(value=str(self.num_peak))
+        peak_count_box = ttk.Spinbox(self.root, from_=1, to=100000, textvariable=self.peak_count, width=10,
+                                     command=self.set_peak_count)
+        peak_count_box.grid(row=2+self.visible_peaks+3, column=self.columnshift+1+1+5+2, sticky="NSEW")
+        peak_count_box.bind("<Return>", lambda event: self.set_peak_count())
+        peak_count_box.bind("<FocusOut>", lambda event: self.set_peak_count())
+        self.show_peak_rows(store=False)
             
         # パラメータのラベル
         self.param_lbl = ["Ratio","Area","Center","G_FWHM","L_FWHM","Error (Ratio)","Error (Area)","Error (Center)","Error (G_FWHM)","Error (L_FWHM)"]
@@ -611,13 +885,61 @@ class FittingTool:
             ttk.Label(self.root, text=label).grid(row=2, column=self.columnshift+2+i, sticky="NSEW")
             
         self.clear_button = ttk.Button(self.root, text="clear parameter", command=self.clear_param)
-        self.clear_button.grid(row=2+self.num_peak+1, column=self.columnshift+1+1, columnspan = 5, sticky="NSEW")
+        self.clear_button.grid(row=2+self.visible_peaks+1, column=self.columnshift+1+1, columnspan = 5, sticky="NSEW")
+        
+        # 大域探索 (多点スタート / 差分進化) と方法の選択
+        self.search_button = ttk.Button(self.root, text="Global Search", command=self.global_search)
+        self.search_button.grid(row=2+self.visible_peaks+1, column=self.columnshift+1, sticky="NSEW")
+        self.search_method = tk.StringVar(value=multistart.METHODS[0])
+        tk.OptionMenu(self.root, self.search_method, *multistart.METHODS).grid(row=2+self.visible_peaks+2, column=self.columnshift+1, sticky="NSEW")
+        
+        # ピークの自動検出 (初期値の入力)。2+self.visible_peaks+2 の行はフィット範囲のエントリ
+        self.auto_seed_button = ttk.Button(self.root, text="Auto Seed", command=self.auto_seed)
+        self.auto_seed_button.grid(row=2+self.visible_peaks+3, column=self.columnshift+1+1, columnspan = 3, sticky="NSEW")
+        self.auto_seed_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.root, text="on load", variable=self.auto_seed_var).grid(row=2+self.visible_peaks+3, column=self.columnshift+1+4, columnspan = 2, sticky="NSEW")
+        
+        # ブートストラップ / MCMC による不確かさの推定と方法の選択
+        self.uncertainty_button = ttk.Button(self.root, text="Uncertainty", command=self.estimate_uncertainty)
+        self.uncertainty_button.grid(row=2+self.visible_peaks+3, column=self.columnshift+1, sticky="NSEW")
+        self.uncertainty_method = tk.StringVar(value=uncertainty.METHODS[0])
+        tk.OptionMenu(self.root, self.uncertainty_method, *uncertainty.METHODS).grid(row=2+self.visible_peaks+4, column=self.columnshift+1, sticky="NSEW")
+        
+        # Fit ボタンの解法 (solvers.SOLVERS)
+        ttk.Label(self.root, text="solver : ").grid(row=2+self.visible_peaks+4, column=self.columnshift+1+1, sticky="NSEW")
+        self.solver_method = tk.StringVar(value=solvers.DEFAULT_SOLVER)
+        tk.OptionMenu(self.root, self.solver_method, *solvers.SOLVERS).grid(row=2+self.visible_peaks+4, column=self.columnshift+1+2, columnspan = 2, sticky="NSEW")
+        # 'trf' の損失関数 (soft_l1 / huber / cauchy はスパイクなどの外れ値の影響を抑える)
+        ttk.Label(self.root, text="loss : ").grid(row=2+self.visible_peaks+5, column=self.columnshift+1+1, sticky="NSEW")
+        self.loss_method = tk.StringVar(value=trf_fit.LOSSES[0])
+        tk.OptionMenu(self.root, self.loss_method, *trf_fit.LOSSES).grid(row=2+self.visible_peaks+5, column=self.columnshift+1+2, columnspan = 2, sticky="NSEW")
+        # Fit ボタンの打ち切りの条件 (経過時間 [s] と関数評価の回数の上限、空欄は上限なし)
+        ttk.Label(self.root, text="time [s] : ").grid(row=2+self.visible_peaks+5, column=self.columnshift+1+4, sticky="NSEW")
+        self.time_budget_entry = ttk.Entry(self.root, state="normal", width=10)
+        self.time_budget_entry.grid(row=2+self.visible_peaks+5, column=self.columnshift+1+5, sticky="NSEW")
+        ttk.Label(self.root, text="max nfev : ").grid(row=2+self.visible_peaks+5, column=self.columnshift+1+1+5+1, sticky="NSEW")
+        self.max_nfev_entry = ttk.Entry(self.root, state="normal", width=10)
+        self.max_nfev_entry.grid(row=2+self.visible_peaks+5, column=self.columnshift+1+1+5+2, sticky="NSEW")
+        # 長いデータで各ピークを裾の小さい範囲を除いて計算する
+        self.windowed_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.root, text="windowed", variable=self.windowed_var).grid(row=2+self.visible_peaks+4, column=self.columnshift+1+4, columnspan = 2, sticky="NSEW")
+        # フィット中のバックグラウンドの基底 (結果は x^k の係数で表示する)
+        ttk.Label(self.root, text="background : ").grid(row=2+self.visible_peaks+4, column=self.columnshift+1+1+5+1, sticky="NSEW")
+        self.bg_basis = tk.StringVar(value=fit_engine.MONOMIAL)
+        tk.OptionMenu(self.root, self.bg_basis, *fit_engine.BG_BASES).grid(row=2+self.visible_peaks+4, column=self.columnshift+1+1+5+2, sticky="NSEW")
+        # 読み込んだファイルに追記された点を読み、前の結果から再フィットする (再フィットの間隔 [s])
+        self.follow_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.root, text="follow file", variable=self.follow_var, command=self.toggle_follow).grid(row=2+self.visible_peaks+6, column=self.columnshift+1, sticky="NSEW")
+        ttk.Label(self.root, text="refit every [s] : ").grid(row=2+self.visible_peaks+6, column=self.columnshift+1+1, sticky="NSEW")
+        self.follow_interval_entry = ttk.Entry(self.root, state="normal", width=10)
+        self.follow_interval_entry.grid(row=2+self.visible_peaks+6, column=self.columnshift+1+2, sticky="NSEW")
+        self.follow_interval_entry.insert(0, "5")
         
         # tipsを最初から表示しておく
         tips_text1 = 'Ratio = 1f : Gaussian, Ratio = 0f : Lorentzian'
-        self.tips1 = ttk.Label(self.root, text=tips_text1).grid(row=2+self.num_peak+1, column=self.columnshift+1+1+5+1, columnspan = 5, sticky="NSEW")
+        self.tips1 = ttk.Label(self.root, text=tips_text1).grid(row=2+self.visible_peaks+1, column=self.columnshift+1+1+5+1, columnspan = 5, sticky="NSEW")
         tips_text2 = 'Ratio = -1f : Pseudo Voigt, Ratio = free : Voigt'
-        self.tips2 = ttk.Label(self.root, text=tips_text2).grid(row=2+self.num_peak+2, column=self.columnshift+1+1+5+1, columnspan = 5, sticky="NSEW")
+        self.tips2 = ttk.Label(self.root, text=tips_text2).grid(row=2+self.visible_peaks+2, column=self.columnshift+1+1+5+1, columnspan = 5, sticky="NSEW")
         
     # clear ボタン
     def clear_param(self):
@@ -632,24 +954,11 @@ class FittingTool:
             bg_error_entry.delete(0, tk.END) # 各エントリーボックスをクリア
             bg_error_entry.config(state="readonly")
             
-        for row_entries in self.entries:
-            for entry in row_entries:
-                # エントリーボックスの状態を取得
-                current_state = entry.cget("state")
-                # "readonly"状態の場合、"normal"に変更してから削除
-                if current_state == "readonly":
-                    entry.config(state="normal")
-                    entry.delete(0, tk.END)
-                    entry.config(state="readonly")  # 再び"readonly"に戻す
-                else:
-                    entry.delete(0, tk.END)
-                    
-        for row_errors in self.error_entries:
-            for entry in row_errors:
-                # "readonly"状態の場合、"normal"に変更してから削除
-                entry.config(state="normal")
-                entry.delete(0, tk.END)
-                entry.config(state="readonly")  # 再び"readonly"に戻す
+        # ピークの表の中身 (チェックの状態はそのまま)
+        self.store_peak_rows()
+        self.peak_texts = [[""] * 5 for _ in range(self.num_peak)]
+        self.peak_error_texts = [[""] * 5 for _ in range(self.num_peak)]
+        self.show_peak_rows(store=False)
                 
         self.X2_entry[0].config(state="normal")  # 一時的に "normal" に変更
         self.X2_entry[0].delete(0, tk.END)
@@ -657,185 +966,711 @@ class FittingTool:
 
     def toggle_entry_state(self):
         """ チェックボックスの状態に応じてエントリの有効化・無効化 """
-        for i in range(self.num_peak):
-            state = "normal" if self.checkboxes[i].get() else "readonly"
-            for entry in self.entries[i]:
-                entry.config(state=state)
-    
-    # voigt関数の定義
-    def voigt(self, x, center, amplitude, fwhm_g, fwhm_l):
-        """FWHM から計算する Voigt 関数"""
-        sigma = fwhm_g / (2 * np.sqrt(2 * np.log(2)))  # ガウシアンの標準偏差
-        gamma = fwhm_l / 2                             # ローレンチアンの半値半幅
-        z = ((x - center) + 1j * gamma) / (sigma * np.sqrt(2))
-        return amplitude * np.real(wofz(z)) / (sigma * np.sqrt(2 * np.pi))
-    
-    def residual(self, params, x, y, y_err):
-        """ フィット関数の残差計算 """
-        # バックグラウンド項
-        bg_a = params['bg_a']
-        bg_b = params['bg_b']
-        bg_c = params['bg_c']
-        bg_d = params['bg_d']
-        bg_e = params['bg_e']
-        model = bg_a + bg_b * x + bg_c * x**2 + bg_d * x**3 + bg_e * x**4
-
-        # ガウシアン項とローレンチアン項
-        for i in range(self.num_peak):
-            if self.checkboxes[i].get():  # チェックボックスがオンの場合
-                ratio_param = params[f'ratio_{i+1}']
-                ratio = ratio_param.value  # 比率パラメータの値
-                ratio_fixed = not ratio_param.vary  # 固定されているかどうか
-                amp = params[f'area_{i+1}'].value
-                cen = params[f'center_{i+1}'].value
-
-                if ratio_fixed:  # 固定値の場合
-                    if ratio == 1:  # ガウシアンのみ
-                        Gwid = params[f'G_FWHM_{i+1}'].value
-                        model += amp * np.exp(-4 * np.log(2) * ((x - cen) / Gwid)**2) / (Gwid * (np.pi / (4 * np.log(2)))**0.5)
-                    elif ratio == 0:  # ローレンチアンのみ
-                        Lwid = params[f'L_FWHM_{i+1}'].value
-                        model += amp * 2 / np.pi * Lwid / (4 * (x - cen)**2 + Lwid**2)
-                    elif ratio == -1: # voigt関数
-                        Gwid = params[f'G_FWHM_{i+1}'].value
-                        Lwid = params[f'L_FWHM_{i+1}'].value
-                        model += self.voigt(x, cen, amp, Gwid, Lwid)
-                else:  # 可変値の場合
-                    # 擬フォークト関数
-                    Gwid = params[f'G_FWHM_{i+1}'].value
-                    Lwid = params[f'L_FWHM_{i+1}'].value
-                    Gaussian = amp * np.exp(-4 * np.log(2) * ((x - cen) / Gwid)**2) / (Gwid * (np.pi / (4 * np.log(2)))**0.5)
-                    lorentzian = amp * 2 / np.pi * Lwid / (4 * (x - cen)**2 + Lwid**2)
-                    model += ratio * Gaussian + (1 - ratio) * lorentzian
-
-        return (y - model) / y_err  # 残差を誤差で正規化して返す
+        self.show_peak_rows()
+
+    @staticmethod
+    def set_entry_text(entry, text, state):
+        """エントリーボックスの文字列を書き換えて state にする (readonly の場合も書き換える)"""
+        entry.config(state="normal")
+        entry.delete(0, tk.END)
+        entry.insert(0, text)
+        entry.config(state=state)
+
+    def store_peak_rows(self):
+        """表示中の行のチェックボックスとエントリーボックスの内容を表の中身に書き戻す"""
+        for k in range(min(self.visible_peaks, self.num_peak - self.peak_offset)):
+            i = self.peak_offset + k
+            self.peak_enabled[i] = self.checkboxes[k].get()
+            self.peak_texts[i] = [entry.get() for entry in self.entries[k]]
+
+    def show_peak_rows(self, offset=None, store=True):
+        """表の中身を offset 行目 (省略時は今の位置) から表示する
+
+        store が True の場合は表示中の内容を先に書き戻す (表の中身を直接書き換えた後は False にする)。
+        """
+        if store:
+            self.store_peak_rows()
+        offset = self.peak_offset if offset is None else offset
+        offset = max(0, min(offset, self.num_peak - self.visible_peaks))
+        self.peak_offset = offset
+        for k in range(self.visible_peaks):
+            i = offset + k
+            widgets = [self.check_buttons[k]] + self.entries[k] + self.error_entries[k]
+            # 行数が表示する行より少ない場合は余った行を隠す
+            if i >= self.num_peak:
+                for widget in widgets:
+                    widget.grid_remove()
+                continue
+            for widget in widgets:
+                widget.grid()
+            self.check_buttons[k].config(text=str(i+1))
+            self.checkboxes[k].set(self.peak_enabled[i])
+            state = "normal" if self.peak_enabled[i] else "readonly"
+            for entry, text in zip(self.entries[k], self.peak_texts[i]):
+                self.set_entry_text(entry, text, state)
+            for entry, text in zip(self.error_entries[k], self.peak_error_texts[i]):
+                self.set_entry_text(entry, text, "readonly")
+        self.peak_scrollbar.set(offset / self.num_peak, min(1.0, (offset + self.visible_peaks) / self.num_peak))
+
+    def scroll_peaks(self, *args):
+        """スクロールバーの操作 ('moveto', 位置 / 'scroll', 量, 'units' or 'pages') で表示する行を動かす"""
+        if args[0] == 'moveto':
+            offset = int(round(float(args[1]) * self.num_peak))
+        else:
+            offset = self.peak_offset + int(args[1]) * (self.visible_peaks if args[2] == 'pages' else 1)
+        self.show_peak_rows(offset)
+
+    def resize_peak_rows(self, n):
+        """ピークの表を n 行にする (減らした場合は後ろの行を消す)"""
+        self.store_peak_rows()
+        extra = n - self.num_peak
+        if extra > 0:
+            self.peak_enabled += [False] * extra
+            self.peak_texts += [[""] * 5 for _ in range(extra)]
+            self.peak_error_texts += [[""] * 5 for _ in range(extra)]
+        else:
+            del self.peak_enabled[n:], self.peak_texts[n:], self.peak_error_texts[n:]
+        self.num_peak = n
+        self.peak_count.set(str(n))
+        self.show_peak_rows(store=False)
+
+    def set_peak_count(self):
+        """peaks の欄の値をピークの表の行数にする"""
+        try:
+            n = max(1, int(self.peak_count.get()))
+        except ValueError:
+            n = self.num_peak
+        if n != self.num_peak:
+            self.resize_peak_rows(n)
+        else:
+            self.peak_count.set(str(n))
     
+    def auto_seed(self):
+        """読み込んだデータ (フィット範囲内) からピークを検出して初期値を入力する (末尾に f の付いた固定値は変更しない)"""
+        if not hasattr(self, 'x_data'):
+            messagebox.showinfo("Error", "Please load a CSV file first.")
+            return
+        try:
+            _, fit_range = self.file_fit_settings()
+            x_data, y_data = self.x_data, self.y_data
+            if fit_range is not None:
+                mask = (x_data >= fit_range[0]) & (x_data <= fit_range[1])
+                x_data, y_data = x_data[mask], y_data[mask]
+            peaks, bg = peak_detect.detect_peaks(x_data, y_data, self.num_peak)
+            if not peaks:
+                messagebox.showinfo("Auto Seed", "No peaks were found.")
+                return
+
+            def set_value(entry, value):
+                if not entry.get().strip().endswith('f'):
+                    entry.delete(0, tk.END)
+                    entry.insert(0, f"{value:.6g}")
+
+            # バックグラウンドの定数と1次の項
+            for entry, value in zip(self.bg_entries[:2], bg):
+                set_value(entry, value)
+            # 見つかった数だけチェックボックスをオンにする (表の中身に書き込んでから表示する)
+            self.store_peak_rows()
+            for i in range(self.num_peak):
+                self.peak_enabled[i] = i < len(peaks)
+            for i, peak in enumerate(peaks):
+                texts = self.peak_texts[i]
+                # ratio が空欄なら擬フォークト関数 (0.5) にする
+                if not texts[0].strip():
+                    texts[0] = "0.5"
+                ratio, ratio_fixed = fit_engine.parse_param(texts[0])
+                values = peak_detect.peak_values(peak, fit_engine.peak_kind(ratio, ratio_fixed), ratio)
+                for field, value in values.items():
+                    j = fit_engine.PEAK_FIELDS.index(field)
+                    if not texts[j].strip().endswith('f'):
+                        texts[j] = f"{value:.6g}"
+            self.show_peak_rows(store=False)
+        except Exception as e:
+            messagebox.showerror("Error", f"Peak detection failed: {e}")
+
+    def global_search(self):
+        """多点スタート / 差分進化で探索してから局所フィットで仕上げる (別スレッドで実行し、Cancel で打ち切れる)"""
+        if not hasattr(self, 'x_data'):
+            messagebox.showinfo("Error", "Please load a CSV file first.")
+            return
+        try:
+            spec = self.snapshot_model_spec()
+            _, fit_range = self.file_fit_settings()
+        except Exception as e:
+            messagebox.showerror("Error", f"Invalid parameters: {e}")
+            return
+        # 別スレッドで使う間に follow モードの追記で書き換わらないように、範囲がなくてもコピーする
+        mask = np.ones(len(self.x_data), dtype=bool)
+        if fit_range is not None:
+            mask = (self.x_data >= fit_range[0]) & (self.x_data <= fit_range[1])
+        x_data, y_data, y_error = self.x_data[mask], self.y_data[mask], self.y_error[mask]
+        method = self.search_method.get()
+
+        # 進捗表示と Cancel ボタン
+        cancel = threading.Event()
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Global Search")
+        progress_label = ttk.Label(progress_window, text=f"Searching ({method}) ...", width=50)
+        progress_label.pack(padx=10, pady=10)
+        ttk.Button(progress_window, text="Cancel", command=cancel.set).pack(pady=5)
+        progress_window.protocol("WM_DELETE_WINDOW", cancel.set)
+
+        state = {'progress': None, 'result': None, 'error': None}
+
+        def progress(n_done, n_candidates, best):
+            state['progress'] = (n_done, n_candidates, best)
+
+        def run():
+            try:
+                state['result'] = multistart.search(spec, x_data, y_data, y_error, method=method,
+                                                    cancel=cancel, progress=progress)
+            except Exception as e:
+                state['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def poll():
+            if state['progress'] is not None:
+                n_done, n_candidates, best = state['progress']
+                progress_label.config(text=f"{method}: {n_done} / {n_candidates} candidates, best χ^2 = {best:.6g}")
+            if thread.is_alive():
+                self.root.after(100, poll)
+                return
+            progress_window.destroy()
+            if state['error'] is not None:
+                messagebox.showerror("Error", f"Global search failed: {state['error']}")
+                return
+            search = state['result']
+            self.result = search.result
+            # 打ち切った場合は誤差が求まらなくてもそこまでの値を表示する
+            if self.result.stderr is None and search.stopped is None and self.result.stopped is None:
+                messagebox.showinfo("Error", "Fitting failed. Please check your data and initial parameters.")
+                return
+            self.display_fit_results(self.result)
+            self.plot_fitted_curve(x_data, self.result)
+            refined = ("The best candidate so far was refined." if self.result.stopped is None
+                       else "The best candidate so far is shown without refinement.")
+            if search.stopped is not None:
+                reason = "cancelled" if search.stopped == 'cancelled' else "time limit reached"
+                messagebox.showinfo("Global Search", f"Search stopped early ({reason}) after {search.n_done} candidates. "
+                                                     + refined)
+            elif self.result.stopped is not None:
+                messagebox.showinfo("Global Search", self.result.message)
+
+        poll()
+
+    def estimate_uncertainty(self):
+        """現在のフィット結果の不確かさをブートストラップ / MCMC で推定する (別スレッドで実行し、Cancel で打ち切れる)
+
+        ブートストラップの再フィットは Fit ボタンの解法 (loss, max nfev も) で行う。時間の上限は全体の Cancel で代える。
+        """
+        if not hasattr(self, 'result'):
+            messagebox.showinfo("Error", "Fitting results do not exist. Please perform fitting first.")
+            return
+        result = self.result
+        try:
+            _, fit_range = self.file_fit_settings()
+        except Exception as e:
+            messagebox.showerror("Error", f"Invalid fitting range: {e}")
+            return
+        try:
+            solver, options = self.fit_settings()
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        options.pop('time_budget', None)
+        # 別スレッドで使う間に follow モードの追記で書き換わらないように、範囲がなくてもコピーする
+        mask = np.ones(len(self.x_data), dtype=bool)
+        if fit_range is not None:
+            mask = (self.x_data >= fit_range[0]) & (self.x_data <= fit_range[1])
+        x_data, y_data, y_error = self.x_data[mask], self.y_data[mask], self.y_error[mask]
+        if len(x_data) != result.ndata:
+            messagebox.showinfo("Error", "The data or fitting range has changed since the last fit. Please fit again.")
+            return
+        method = self.uncertainty_method.get()
+
+        # 進捗表示と Cancel ボタン
+        cancel = threading.Event()
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Uncertainty")
+        progress_label = ttk.Label(progress_window, text=f"Sampling ({method}) ...", width=50)
+        progress_label.pack(padx=10, pady=10)
+        ttk.Button(progress_window, text="Cancel", command=cancel.set).pack(pady=5)
+        progress_window.protocol("WM_DELETE_WINDOW", cancel.set)
+
+        state = {'progress': None, 'samples': None, 'error': None}
+
+        def progress(n_done, n_tasks):
+            state['progress'] = (n_done, n_tasks)
+
+        def run():
+            try:
+                state['samples'] = uncertainty.estimate(result, x_data, y_data, y_error, method=method,
+                                                        cancel=cancel, progress=progress, solver=solver,
+                                                        solver_options=options)
+            except Exception as e:
+                state['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def poll():
+            if state['progress'] is not None:
+                n_done, n_tasks = state['progress']
+                progress_label.config(text=f"{method}: {n_done} / {n_tasks} tasks")
+            if thread.is_alive():
+                self.root.after(100, poll)
+                return
+            progress_window.destroy()
+            if state['error'] is not None:
+                messagebox.showerror("Error", f"Uncertainty estimation failed: {state['error']}")
+                return
+            samples = state['samples']
+            if samples.n_valid == 0:
+                messagebox.showinfo("Error", "No valid samples were obtained.")
+                return
+            # 保存するファイルの Error の隣に区間を書き込むため、フィット結果と組にして保持する
+            self.uncertainty = (result, samples)
+            lower, upper = samples.interval()
+            lines = [f"{method}: {samples.n_valid} samples" + (" (stopped early)" if samples.stopped else "")]
+            free = result.compiled.free
+            for i in free[:UNCERTAINTY_LINES]:
+                lines.append(f"{samples.names[i]}: {result.best_values[i]:.6g}  [{lower[i]:.6g}, {upper[i]:.6g}]")
+            if len(free) > UNCERTAINTY_LINES:
+                lines.append(f"... ({len(free) - UNCERTAINTY_LINES} more parameters in the saved CSV)")
+            lines.append(f"\nIntervals ({100 * uncertainty.LEVEL:.1f}%) are added to the saved CSV. Save the samples (.npz)?")
+            if messagebox.askyesno("Uncertainty", "\n".join(lines)):
+                filename = filedialog.asksaveasfilename(defaultextension=".npz", filetypes=[("NumPy files", "*.npz")])
+                if filename:
+                    samples.save(filename)
+
+        poll()
+
+    def interval_columns(self, result):
+        """不確かさの推定があれば (下限, 上限) の配列 (compiled.names の順) を、なければ None を返す"""
+        if getattr(self, 'uncertainty', None) is None or self.uncertainty[0] is not result:
+            return None
+        return self.uncertainty[1].interval()
+
+    def snapshot_model_spec(self):
+        """GUIのエントリーボックスの状態を読み取り、フィットエンジン用の ModelSpec を作成する"""
+        # バックグラウンドパラメータの取得
+        bg_texts = [entry.get() for entry in self.bg_entries]
+        # チェックボックスがオンのピークのみ取得
+        self.store_peak_rows()
+        peak_texts = [(i+1, texts) for i, (enabled, texts) in enumerate(zip(self.peak_enabled, self.peak_texts))
+                      if enabled]
+        return fit_engine.spec_from_entries(bg_texts, peak_texts)
+
+    def fit_settings(self):
+        """Fit ボタンの解法とその引数 (loss, max_nfev, time_budget) を返す (数値が不正なら ValueError)"""
+        solver = self.solver_method.get()
+        options = {'loss': self.loss_method.get()} if solver == 'trf' else {}
+        try:
+            if self.time_budget_entry.get().strip():
+                options['time_budget'] = float(self.time_budget_entry.get())
+            if self.max_nfev_entry.get().strip():
+                options['max_nfev'] = int(float(self.max_nfev_entry.get()))
+        except ValueError as e:
+            raise ValueError(f"Invalid time limit or max nfev: {e}") from None
+        return solver, options
+
     def fit_data(self):
-        # バックグラウンドパラメータの取得と処理
-        bg_a = self.bg_entries[0].get()
-        bg_b = self.bg_entries[1].get()
-        bg_c = self.bg_entries[2].get()
-        bg_d = self.bg_entries[3].get()
-        bg_e = self.bg_entries[4].get()
-
-        # バックグラウンドパラメータの 'f' を取り除く処理
-        bg_a_value, bg_a_fixed = self.process_param(bg_a)
-        bg_b_value, bg_b_fixed = self.process_param(bg_b)
-        bg_c_value, bg_c_fixed = self.process_param(bg_c)
-        bg_d_value, bg_d_fixed = self.process_param(bg_d)
-        bg_e_value, bg_e_fixed = self.process_param(bg_e)
-        
-        # 各ピークに対するパラメータの取得とフィッティング
-        peak_params = {}
-        for i in range(self.num_peak):  # 最大self.num_peak個のピークに対して
-            if self.checkboxes[i].get():  # チェックボックスがオンの場合のみ
-                ratio = self.entries[i][0].get()
-                area = self.entries[i][1].get()
-                center = self.entries[i][2].get()
-                # 'f'がついている場合、'f'を取り除いて数値として設定
-                ratio_value, ratio_fixed = self.process_param(ratio)
-                center_value, center_fixed = self.process_param(center)
-                area_value, area_fixed = self.process_param(area)
-                # 'f'がついている場合、固定する処理を追加
-                peak_params[f'ratio_{i+1}'] = (ratio_value, ratio_fixed)
-                peak_params[f'center_{i+1}'] = (center_value, center_fixed)
-                peak_params[f'area_{i+1}'] = (area_value, area_fixed)
-                
-                if ratio_fixed == True and int(ratio_value)==1:
-                    G_fwhm = self.entries[i][3].get()
-                    G_FWHM_value, G_FWHM_fixed = self.process_param(G_fwhm)
-                    peak_params[f'G_FWHM_{i+1}'] = (G_FWHM_value, G_FWHM_fixed)
-                elif ratio_fixed == True and int(ratio_value)==0:
-                    L_fwhm = self.entries[i][4].get()
-                    L_FWHM_value, L_FWHM_fixed = self.process_param(L_fwhm)
-                    peak_params[f'L_FWHM_{i+1}'] = (L_FWHM_value, L_FWHM_fixed)
-                elif ratio_fixed == True and int(ratio_value)==-1:
-                    G_fwhm = self.entries[i][3].get()
-                    G_FWHM_value, G_FWHM_fixed = self.process_param(G_fwhm)
-                    peak_params[f'G_FWHM_{i+1}'] = (G_FWHM_value, G_FWHM_fixed)
-                    L_fwhm = self.entries[i][4].get()
-                    L_FWHM_value, L_FWHM_fixed = self.process_param(L_fwhm)
-                    peak_params[f'L_FWHM_{i+1}'] = (L_FWHM_value, L_FWHM_fixed)
-                else:
-                    G_fwhm = self.entries[i][3].get()
-                    G_FWHM_value, G_FWHM_fixed = self.process_param(G_fwhm)
-                    peak_params[f'G_FWHM_{i+1}'] = (G_FWHM_value, G_FWHM_fixed)
-                    L_fwhm = self.entries[i][4].get()
-                    L_FWHM_value, L_FWHM_fixed = self.process_param(L_fwhm)
-                    peak_params[f'L_FWHM_{i+1}'] = (L_FWHM_value, L_FWHM_fixed)
-            else:
-                continue
-        
-        # フィット範囲を取得
-        fit_range1 = float(self.fit_range_entries[0].get()) if self.fit_range_entries[0].get() else None
-        fit_range2 = float(self.fit_range_entries[1].get()) if self.fit_range_entries[1].get() else None
+        """フィットする (別スレッドで実行し、Cancel や時間の上限で打ち切るとそれまでの最良の値を表示する)"""
+        # GUIの状態を一度だけ読み取ってフィットエンジンに渡す (パラメータ、解法と上限、フィット範囲)
+        try:
+            spec = self.snapshot_model_spec()
+            solver, options = self.fit_settings()
+            fit_range1 = float(self.fit_range_entries[0].get()) if self.fit_range_entries[0].get() else None
+            fit_range2 = float(self.fit_range_entries[1].get()) if self.fit_range_entries[1].get() else None
+        except Exception as e:
+            messagebox.showerror("Error", f"Invalid parameters: {e}")
+            return
 
-        # フィルタリングされたデータを作成
+        # フィルタリングされたデータを作成 (範囲が指定されていない場合は全データを使用)。
+        # follow モードではフィット中に追記で配列が書き換わらないように、範囲がなくてもコピーする
+        mask = np.ones(len(self.x_data), dtype=bool)
         if fit_range1 is not None and fit_range2 is not None:
             mask = (self.x_data >= fit_range1) & (self.x_data <= fit_range2)
-            x_data = self.x_data[mask]
-            y_data = self.y_data[mask]
-            y_error = self.y_error[mask]
-        else:
-            # 範囲が指定されていない場合は全データを使用
-            x_data = self.x_data
-            y_data = self.y_data
-            y_error = self.y_error
-        
-        # lmfitの最小化処理
-        pfit = Parameters()
-
-        # バックグラウンドパラメータを追加（固定値かどうかをチェック）
-        pfit.add('bg_a', value=bg_a_value, vary=not bg_a_fixed)
-        pfit.add('bg_b', value=bg_b_value, vary=not bg_b_fixed)
-        pfit.add('bg_c', value=bg_c_value, vary=not bg_c_fixed)
-        pfit.add('bg_d', value=bg_d_value, vary=not bg_d_fixed)
-        pfit.add('bg_e', value=bg_e_value, vary=not bg_e_fixed)
-
-        # ガウシアンのピークパラメータを追加
-        for key, value in peak_params.items():
-            pfit.add(key, value=value[0], vary=not value[1])
+        x_data, y_data, y_error = self.x_data[mask], self.y_data[mask], self.y_error[mask]
         
-        # 追加されたパラメータの中で、最小値を設定
-        for param_name in pfit:
-            if "G_FWHM" in param_name:  # "G_FWHM"がパラメータ名に含まれている場合
-                pfit[param_name].min = 0.0  # 最小値を0に設定
-            if "L_FWHM" in param_name:  # "L_FWHM"がパラメータ名に含まれている場合
-                pfit[param_name].min = 0.0  # 最小値を0に設定
-            """
-            if "ratio" in param_name:  # "ratio"がパラメータ名に含まれている場合
-                if pfit[ratio] == -1:
-                    pass
-                else:
-                    pfit[param_name].min = 0.0  # 最小値を0に設定
-                    pfit[param_name].max = 1.0  # 最大値を1に設定
-            """
-            if "area" in param_name:  # "area"がパラメータ名に含まれている場合
-                pfit[param_name].min = 0.0  # 最小値を0に設定
-        #print(pfit.pretty_print())
-        # 最小化処理
-        mini = Minimizer(self.residual, pfit, fcn_args=(x_data, y_data, y_error))
-        self.result = mini.leastsq()
-        
-        # フィッティング失敗を確認
-        if self.result.params['bg_a'].stderr is None:
-            #self.show_error_message("Fitting failed. Please check your data and initial parameters.")
-            messagebox.showinfo("Error", "Fitting failed. Please check your data and initial parameters.")
-            return  # フィット結果を表示せず終了
-        else:
+        # 最小化処理 (面積とFWHMの最小値は0)。同じデータ・初期値のフィット結果は保存済みのものを使う
+        window_rtol = fit_engine.WINDOW_RTOL if self.windowed_var.get() else None
+
+        # 進捗表示と Cancel ボタン (フィット中は Fit ボタンを押せないようにする)
+        cancel = threading.Event()
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Fit")
+        ttk.Label(progress_window, text=f"Fitting ({solver}) ...", width=50).pack(padx=10, pady=10)
+        ttk.Button(progress_window, text="Cancel", command=cancel.set).pack(pady=5)
+        progress_window.protocol("WM_DELETE_WINDOW", cancel.set)
+        self.fit_button.config(state="disabled")
+
+        state = {'result': None, 'error': None}
+
+        def run():
+            try:
+                state['result'], _ = fit_cache.cached_fit(spec, x_data, y_data, y_error, solver=solver,
+                                                          window_rtol=window_rtol, bg_basis=self.bg_basis.get(),
+                                                          cancel=cancel, **options)
+            except Exception as e:
+                state['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def poll():
+            if thread.is_alive():
+                self.root.after(100, poll)
+                return
+            progress_window.destroy()
+            self.fit_button.config(state="normal")
+            if state['error'] is not None:
+                messagebox.showerror("Error", f"Fitting failed: {state['error']}")
+                return
+            self.result = state['result']
+            stopped = self.result.stopped is not None
+
+            # フィッティング失敗を確認 (上限や Cancel で打ち切った場合は、誤差が求まらなくてもそこまでの値を表示する)
+            if self.result.stderr is None and not stopped:
+                #self.show_error_message("Fitting failed. Please check your data and initial parameters.")
+                messagebox.showinfo("Error", "Fitting failed. Please check your data and initial parameters.")
+                return  # フィット結果を表示せず終了
             # フィット結果をエントリーボックスに表示
-            self.display_fit_results(self.result, bg_a_fixed, bg_b_fixed, bg_c_fixed, bg_d_fixed, bg_e_fixed,peak_params)
-            
+            self.display_fit_results(self.result)
+
             # フィット結果をグラフに表示
             self.plot_fitted_curve(x_data, self.result)
+            if stopped:
+                messagebox.showinfo("Fit", self.result.message)
 
-    def process_param(self, param):
-        """パラメータの 'f' を処理する関数"""
-        if isinstance(param, str) and param.endswith("f"):
-            value = float(param[:-1])  # 'f'を取り除いて値を設定
-            return value, True  # 固定値として設定
-        else:
-            return float(param), False  # 固定しない値として設定
+        poll()
+
+    def toggle_follow(self):
+        """follow モードの開始と終了
+
+        読み込んだファイルを FOLLOW_POLL_MS ごとに確かめ、追記された行だけを読んで x_data, y_data, y_error に加え、
+        グラフのデータ点だけを置き換える。フィット結果があれば refit every [s] の間隔で前の結果から再フィットする。
+        """
+        if not self.follow_var.get():
+            # poll_follow は follow_token が変わると止まる。再フィット中なら打ち切って結果は使わない
+            self.follow_token = None
+            if getattr(self, 'follow_fit', None) is not None:
+                self.follow_cancel.set()
+                self.follow_fit = None
+                self.fit_button.config(state="normal")
+            return
+        if not hasattr(self, 'data_source'):
+            messagebox.showerror("Error", "Load a CSV file before following it.")
+            self.follow_var.set(False)
+            return
+        if self.tail is None:
+            file_path, columns, offset = self.data_source
+            try:
+                self.tail = csv_loader.TailReader(file_path, columns, self.x_data, self.y_data, self.y_error, offset)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Error", f"Failed to follow {file_path}: {e}")
+                self.follow_var.set(False)
+                return
+            self.x_data, self.y_data, self.y_error = self.tail.x, self.tail.y, self.tail.y_error
+        self.follow_cancel = threading.Event()
+        # 再フィットの最後の失敗 (表示するのは follow を始めてから最初の失敗だけ)
+        self.follow_error = None
+        self.follow_fit_time = time.monotonic()
+        self.follow_token = token = object()
+        self.poll_follow(token)
+
+    def poll_follow(self, token):
+        """follow モードで FOLLOW_POLL_MS ごとに追記を読み、再フィットを始めたり結果を表示したりする"""
+        if self.follow_token is not token:
+            return
+        try:
+            n_lines = self.tail.read()
+        except (OSError, ValueError) as e:
+            self.follow_var.set(False)
+            self.toggle_follow()
+            messagebox.showerror("Error", f"Stopped following the file: {e}")
+            return
+        if n_lines:
+            self.append_follow_data()
+        self.step_follow_fit()
+        self.root.after(FOLLOW_POLL_MS, lambda: self.poll_follow(token))
+
+    def append_follow_data(self):
+        """追記された点を x_data, y_data, y_error に加え、グラフのデータ点を置き換える (図は作り直さない)"""
+        old = self.x_data, self.y_data
+        self.x_data, self.y_data, self.y_error = self.tail.x, self.tail.y, self.tail.y_error
+        if len(old[0]) == 0 or len(self.x_data) == 0:
+            return
+
+        # 自動で入れた値 (データの最小・最大) のままの軸範囲とフィット範囲は、データに合わせて広げる
+        def follow(entry, old_value, new_value):
+            if entry.get() != f"{old_value:.4f}" or f"{new_value:.4f}" == f"{old_value:.4f}":
+                return False
+            entry.delete(0, tk.END)
+            entry.insert(0, f"{new_value:.4f}")
+            return True
+
+        (old_x, old_y), x, y = old, self.x_data, self.y_data
+        axis_changed = [follow(self.range_entries[0], np.max(old_y), np.max(y)),
+                        follow(self.range_entries[1], np.min(old_y), np.min(y)),
+                        follow(self.range_entries[2], np.min(old_x), np.min(x)),
+                        follow(self.range_entries[3], np.max(old_x), np.max(x))]
+        range_changed = [follow(self.fit_range_entries[0], np.min(old_x), np.min(x)),
+                         follow(self.fit_range_entries[1], np.max(old_x), np.max(x))]
+
+        # データ点 (errorbar の点と誤差棒) の配列だけを置き換える
+        for container in self.ax.containers:
+            if isinstance(container, ErrorbarContainer) and container.get_label() == "Data":
+                data_line, _, bar_lines = container.lines
+                data_line.set_data(x, y)
+                if bar_lines:
+                    bar_lines[0].set_segments(np.stack([np.column_stack([x, y - self.y_error]),
+                                                        np.column_stack([x, y + self.y_error])], axis=1))
+        if any(range_changed):
+            self.update_vline(draw=False)
+        if any(axis_changed):
+            self.update_axis_range(draw=False)
+        self.canvas.draw_idle()
+
+    def step_follow_fit(self):
+        """follow モードの再フィット (別スレッド)。終わっていれば結果を表示し、間隔が空いていれば次を始める
+
+        前の結果 (self.result) のモデルと最良の値から始め、解法と打ち切りの条件は Fit ボタンと同じ。
+        Fit ボタンのフィット中は行わない。
+        """
+        if self.follow_fit is not None:
+            thread, state, x_data = self.follow_fit
+            if thread.is_alive():
+                return
+            self.follow_fit = None
+            self.fit_button.config(state="normal")
+            if state['error'] is not None:
+                # 次の間隔でもう一度行う。同じ follow の間は最初の失敗だけを表示する
+                if self.follow_error is None:
+                    messagebox.showerror("Error", f"Refit in follow mode failed (it will be retried): {state['error']}")
+                self.follow_error = state['error']
+                return
+            result = state['result']
+            if result is not None and (result.stderr is not None or result.stopped is not None):
+                self.result = result
+                self.display_fit_results(result)
+                self.plot_fitted_curve(x_data, result)
+            return
+        if not hasattr(self, 'result') or self.follow_fitted_offset == self.tail.offset:
+            return
+        if str(self.fit_button.cget('state')) == "disabled":
+            return
+        try:
+            interval = float(self.follow_interval_entry.get())
+            solver, options = self.fit_settings()
+            fit_range1 = float(self.fit_range_entries[0].get()) if self.fit_range_entries[0].get() else None
+            fit_range2 = float(self.fit_range_entries[1].get()) if self.fit_range_entries[1].get() else None
+        except ValueError:
+            return
+        if time.monotonic() - self.follow_fit_time < interval:
+            return
+
+        # フィット中に追記で配列が書き換わらないようにコピーする
+        mask = np.ones(len(self.x_data), dtype=bool)
+        if fit_range1 is not None and fit_range2 is not None:
+            mask = (self.x_data >= fit_range1) & (self.x_data <= fit_range2)
+        x_data, y_data, y_error = self.x_data[mask], self.y_data[mask], self.y_error[mask]
+        window_rtol = fit_engine.WINDOW_RTOL if self.windowed_var.get() else None
+        compiled = fit_engine.CompiledModel(self.result.compiled.spec, window_rtol=window_rtol, bg_basis=self.bg_basis.get())
+        start = self.result.best_values
+        cancel = self.follow_cancel
+        state = {'result': None, 'error': None}
+
+        def run():
+            try:
+                state['result'] = solvers.fit(compiled, x_data, y_data, y_error, solver=solver, start=start,
+                                              cancel=cancel, **options)
+            except Exception as e:
+                state['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.follow_fit = (thread, state, x_data)
+        self.follow_fit_time = time.monotonic()
+        self.follow_fitted_offset = self.tail.offset
+        self.fit_button.config(state="disabled")
+
+    def fit_sequential(self):
+        """複数のファイルを順番にフィットし、前のスキャンの結果を次の初期値にする (初期値はエントリーボックスの値)
+
+        解法・windowed・バックグラウンドの基底・打ち切りの条件 (ファイルごと) は Fit ボタンと同じ。
+        別スレッドで実行し、Cancel で止めると残りのファイルは Status を cancelled にして保存する。
+        """
+        file_paths = filedialog.askopenfilenames(filetypes=[("CSV Files", "*.csv")])
+        if not file_paths:
+            return
+        # ファイル名の順 (数字は数値順) に並べる
+        file_paths = sorted(file_paths, key=batch_fit.natural_key)
+
+        try:
+            spec = self.snapshot_model_spec()
+            columns, fit_range = self.file_fit_settings()
+            solver, solver_options = self.fit_settings()
+        except Exception as e:
+            messagebox.showerror("Error", f"Sequential fitting failed: {e}")
+            return
+
+        # 結果の保存先 (ファイルごとに1行)
+        filename = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        if not filename:
+            return
+        window_rtol = fit_engine.WINDOW_RTOL if self.windowed_var.get() else None
+
+        # 進捗表示と Cancel ボタン
+        cancel = threading.Event()
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Sequential Fit")
+        progress_label = ttk.Label(progress_window, text=f"Fitting 0 / {len(file_paths)} files ({solver}) ...", width=50)
+        progress_label.pack(padx=10, pady=10)
+        ttk.Button(progress_window, text="Cancel", command=cancel.set).pack(pady=5)
+        progress_window.protocol("WM_DELETE_WINDOW", cancel.set)
+        self.sequential_button.config(state="disabled")
+
+        state = {'progress': 0, 'output': None, 'error': None}
+
+        def progress(n_done, n_files):
+            state['progress'] = n_done
+
+        def run():
+            try:
+                state['output'] = batch_fit.run_sequential(file_paths, spec, columns, fit_range, filename,
+                                                           window_rtol=window_rtol, bg_basis=self.bg_basis.get(),
+                                                           solver=solver, solver_options=solver_options,
+                                                           progress=progress, cancel=cancel)
+            except Exception as e:
+                state['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def poll():
+            if thread.is_alive():
+                progress_label.config(text=f"Fitting {state['progress']} / {len(file_paths)} files ({solver}) ...")
+                self.root.after(100, poll)
+                return
+            progress_window.destroy()
+            self.sequential_button.config(state="normal")
+            if state['error'] is not None:
+                messagebox.showerror("Error", f"Sequential fitting failed: {state['error']}")
+                return
+            n_ok, n_failed, last = state['output']
+            cancelled = "\n(cancelled: the remaining files were not fitted)" if cancel.is_set() else ""
+            if last is None:
+                messagebox.showinfo("Error", "Fitting failed. Please check your data and initial parameters." + cancelled)
+                return
+
+            # 最後に成功したスキャンを表示する
+            self.show_file_result(last[0], columns, fit_range, last[1])
+            messagebox.showinfo("Sequential Fit", f"{n_ok} files fitted, {n_failed} failed or not fitted.\n"
+                                                  f"Results saved to {filename}" + cancelled)
+
+        poll()
+
+    def fit_global(self):
+        """複数のファイルを同時にフィットする (指定したパラメータは全ファイルで共通、初期値はエントリーボックスの値)
+
+        独自の Levenberg-Marquardt 法で解くので解法・windowed・バックグラウンドの基底は使わず、
+        打ち切りの条件 (フィット全体) だけ Fit ボタンと同じ。別スレッドで実行し、Cancel でそれまでの値を表示する。
+        """
+        file_paths = filedialog.askopenfilenames(filetypes=[("CSV Files", "*.csv")])
+        if not file_paths:
+            return
+        file_paths = sorted(file_paths, key=batch_fit.natural_key)
+        shared = simpledialog.askstring("Global Fit", "Shared parameters (comma separated, e.g. G_FWHM_1, L_FWHM):",
+                                        parent=self.root)
+        if shared is None:
+            return
+
+        try:
+            spec = self.snapshot_model_spec()
+            columns, fit_range = self.file_fit_settings()
+            _, options = self.fit_settings()
+            shared = [name.strip() for name in shared.split(',') if name.strip()]
+            # 名前の確認 (保存先を聞く前に)
+            global_fit.shared_indices(fit_engine.CompiledModel(spec), shared)
+        except Exception as e:
+            messagebox.showerror("Error", f"Global fitting failed: {e}")
+            return
+
+        filename = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        if not filename:
+            return
+
+        # 進捗表示と Cancel ボタン
+        cancel = threading.Event()
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Global Fit")
+        ttk.Label(progress_window, text=f"Fitting {len(file_paths)} files together ...", width=50).pack(padx=10, pady=10)
+        ttk.Button(progress_window, text="Cancel", command=cancel.set).pack(pady=5)
+        progress_window.protocol("WM_DELETE_WINDOW", cancel.set)
+        self.global_button.config(state="disabled")
+
+        state = {'output': None, 'error': None}
+
+        def run():
+            try:
+                state['output'] = batch_fit.run_global(file_paths, spec, columns, fit_range, filename, shared,
+                                                       max_nfev=options.get('max_nfev'),
+                                                       time_budget=options.get('time_budget'), cancel=cancel)
+            except Exception as e:
+                state['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def poll():
+            if thread.is_alive():
+                self.root.after(100, poll)
+                return
+            progress_window.destroy()
+            self.global_button.config(state="normal")
+            if state['error'] is not None:
+                messagebox.showerror("Error", f"Global fitting failed: {state['error']}")
+                return
+            n_ok, n_failed, fitted, result = state['output']
+            # 打ち切った場合は誤差が求まらなくてもそこまでの値を表示する
+            if result is None or (result.results[0].stderr is None and result.stopped is None):
+                messagebox.showinfo("Error", "Fitting failed. Please check your data and initial parameters.")
+                return
+
+            # 最初のファイルを表示する
+            self.show_file_result(fitted[0], columns, fit_range, result.results[0])
+            stopped = f"\n{result.message}" if result.stopped is not None else ""
+            messagebox.showinfo("Global Fit", f"{n_ok} files fitted, {n_failed} failed (reduced χ^2 = {result.redchi:.4f}).\n"
+                                              f"Results saved to {filename}" + stopped)
+
+        poll()
+
+    def file_fit_settings(self):
+        """列番号 (0始まり) とフィット範囲 (指定がなければ None) を返す"""
+        columns = tuple(int(float(entry.get()))-1 for entry in self.data_column_entry)
+        fit_range1 = float(self.fit_range_entries[0].get()) if self.fit_range_entries[0].get() else None
+        fit_range2 = float(self.fit_range_entries[1].get()) if self.fit_range_entries[1].get() else None
+        fit_range = (fit_range1, fit_range2) if fit_range1 is not None and fit_range2 is not None else None
+        return columns, fit_range
+
+    def show_file_result(self, file_path, columns, fit_range, result):
+        """ファイルのデータとフィット結果を表示する (逐次フィット・グローバルフィットの後)"""
+        self.result = result
+        data = data_cache.cached_load_xye(file_path, *columns)
+        self.file_name = os.path.basename(file_path)
+        self.X_title = data.header[columns[0]]
+        self.Y_title = data.header[columns[1]]
+        self.set_loaded_data(file_path, columns, data)
+        x_data = self.x_data
+        if fit_range is not None:
+            x_data = x_data[(x_data >= fit_range[0]) & (x_data <= fit_range[1])]
+        self.ax.clear()
+        self.ax.errorbar(self.x_data, self.y_data, yerr=self.y_error, fmt='o', label="Data", color='blue')
+        self.display_fit_results(result)
+        self.plot_fitted_curve(x_data, result)
 
     def plot_fitted_curve(self, x_data, result):
         # 現在の軸範囲を取得
@@ -855,57 +1690,23 @@ class FittingTool:
         
         self.ax.clear()
         """ フィッティング結果をプロットに追加 """
-        # バックグラウンドのフィット
-        bg_a = result.params['bg_a'].value
-        bg_b = result.params['bg_b'].value
-        bg_c = result.params['bg_c'].value
-        bg_d = result.params['bg_d'].value
-        bg_e = result.params['bg_e'].value
-        y_fit = bg_a + bg_b * fit_x_data + bg_c * fit_x_data**2 + bg_d * fit_x_data**3 + bg_e * fit_x_data**4
+        # パラメータのベクトルから全ピークをまとめて計算する
+        compiled = result.compiled
+        p = result.best_values
+        bg_model = compiled.background(p, fit_x_data)
+        peak_curves = compiled.peak_curves(p, fit_x_data)
 
         # バックグラウンド関数を破線でプロット
-        self.ax.plot(fit_x_data, y_fit, 'r--', label="Background fit", color='yellow')
+        self.ax.plot(fit_x_data, bg_model, 'r--', label="Background fit", color='yellow')
         
-        # 各ピークのガウスフィットまたはローレンチアンフィット
-        # ガウスフィットやローレンチアンフィットの条件分岐
-        for i in range(self.num_peak):
-            if f'center_{i+1}' in result.params:
-                ratio = result.params.get(f'ratio_{i+1}', None)
-                amp = result.params[f'area_{i+1}'].value
-                cen = result.params[f'center_{i+1}'].value
-                Gwid = result.params.get(f'G_FWHM_{i+1}', None)
-                Lwid = result.params.get(f'L_FWHM_{i+1}', None)
-
-                # バックグラウンドの項
-                bg_model = (bg_a + bg_b * fit_x_data + bg_c * fit_x_data**2 +
-                            bg_d * fit_x_data**3 + bg_e * fit_x_data**4)
-
-                # ピークフィット関数の計算
-                if ratio is not None and ratio.value == -1 and Gwid is not None and Lwid is not None:  # ratioが-1の場合はVoigt関数
-                    peak_y = self.voigt(fit_x_data, cen, amp, Gwid.value, Lwid.value)
-                elif Gwid is not None and Lwid is not None:  # 両方存在する場合は擬フォークト関数
-                    ratio = ratio.value  # ratioがNoneでなく、かつTrueの場合に値を設定
-                    peak_y = (ratio * amp * np.exp(-4 * np.log(2) * ((fit_x_data - cen) / Gwid.value)**2) / 
-                            (Gwid.value * (np.pi / (4 * np.log(2)))**0.5) +
-                            (1 - ratio) * amp * 2 / np.pi * Lwid.value / 
-                            (4 * (fit_x_data - cen)**2 + Lwid.value**2))
-                elif Gwid is not None:  # Gwidのみ存在する場合はガウシアン
-                    peak_y = amp * np.exp(-4 * np.log(2) * ((fit_x_data - cen) / Gwid.value)**2) / \
-                            (Gwid.value * (np.pi / (4 * np.log(2)))**0.5)
-                elif Lwid is not None:  # Lwidのみ存在する場合はローレンチアン
-                    peak_y = amp * 2 / np.pi * Lwid.value / (4 * (fit_x_data - cen)**2 + Lwid.value**2)
-                else:
-                    continue  # 両方とも存在しない場合はスキップ
-
-                # ピーク + バックグラウンド
-                peak_yandBG = bg_model + peak_y
-                #print(peak_yandBG)
-
-                # 個別のピーク関数を破線でプロット
-                self.ax.plot(fit_x_data, peak_yandBG, 'b--', label=f"Peak {i+1} fit", color='black')
+        # 各ピーク + バックグラウンドを破線でプロット (ピークが表示する行数より多い場合、凡例は1つにまとめる)
+        many = len(compiled.spec.peaks) > self.visible_peaks
+        for k, (peak, peak_y) in enumerate(zip(compiled.spec.peaks, peak_curves)):
+            label = ("Peak fits" if k == 0 else None) if many else f"Peak {peak.number} fit"
+            self.ax.plot(fit_x_data, bg_model + peak_y, 'b--', label=label, color='black')
 
-                # フィット曲線に加算
-                y_fit += peak_y
+        # フィット曲線
+        y_fit = bg_model + peak_curves.sum(axis=0)
 
         # グラフを更新
         self.ax.errorbar(self.x_data, self.y_data, yerr=self.y_error, fmt='o', label="Data", color='blue')
@@ -938,139 +1739,43 @@ class FittingTool:
         
         self.canvas.draw()
 
-    def display_fit_results(self, result, bg_a_fixed, bg_b_fixed, bg_c_fixed, bg_d_fixed, bg_e_fixed, peak_params):
-        """ フィット結果をエントリーボックスに表示 """
+    def display_fit_results(self, result):
+        """ フィット結果をエントリーボックスに表示 (値と誤差はパラメータのベクトルから、固定の 'f' は result.compiled.spec から)
+
+        誤差が求まっていない場合 (途中で打ち切った場合) は誤差を空欄にする。
+        """
+        compiled = result.compiled
+        spec = compiled.spec
+        best, stderr = result.best_values, result.stderr
+        if stderr is None:
+            stderr = np.full(len(best), np.nan)
         # χ^2を表示
-        self.X2_entry[0].config(state="normal")  # 一時的に "normal" に変更
-        self.X2_entry[0].delete(0, tk.END)
-        self.X2_entry[0].insert(0, f"{result.redchi:.4f}")
-        self.X2_entry[0].config(state="readonly")
+        self.set_entry_text(self.X2_entry[0], f"{result.redchi:.4f}", "readonly")
         
-        # バックグラウンドパラメータの結果を表示
-        for entry in self.bg_entries:
-            entry.config(state="normal")  # 一時的に "normal" に変更
-        self.bg_entries[0].delete(0, tk.END)
-        self.bg_entries[1].delete(0, tk.END)
-        self.bg_entries[2].delete(0, tk.END)
-        self.bg_entries[3].delete(0, tk.END)
-        self.bg_entries[4].delete(0, tk.END)
-        self.bg_entries[0].insert(0, f"{result.params['bg_a'].value:.4f}"+ ('f' if bg_a_fixed else ''))
-        self.bg_entries[1].insert(0, f"{result.params['bg_b'].value:.4f}"+ ('f' if bg_b_fixed else ''))
-        self.bg_entries[2].insert(0, f"{result.params['bg_c'].value:.4f}"+ ('f' if bg_c_fixed else ''))
-        self.bg_entries[3].insert(0, f"{result.params['bg_d'].value:.4f}"+ ('f' if bg_d_fixed else ''))
-        self.bg_entries[4].insert(0, f"{result.params['bg_e'].value:.4f}"+ ('f' if bg_e_fixed else ''))
-
-        # 誤差の表示（readonlyに設定）
-        for entry in self.bg_errors:
-            entry.config(state="normal")  # 一時的に "normal" に変更
-        self.bg_errors[0].delete(0, tk.END)
-        self.bg_errors[1].delete(0, tk.END)
-        self.bg_errors[2].delete(0, tk.END)
-        self.bg_errors[3].delete(0, tk.END)
-        self.bg_errors[4].delete(0, tk.END)
-        self.bg_errors[0].insert(0, f"{result.params['bg_a'].stderr:.4f}")
-        self.bg_errors[1].insert(0, f"{result.params['bg_b'].stderr:.4f}")
-        self.bg_errors[2].insert(0, f"{result.params['bg_c'].stderr:.4f}")
-        self.bg_errors[3].insert(0, f"{result.params['bg_d'].stderr:.4f}")
-        self.bg_errors[4].insert(0, f"{result.params['bg_e'].stderr:.4f}")
-
-        # ピーク関数のパラメータの結果を表示
-        for i in range(self.num_peak):
-            if self.checkboxes[i].get():
-                # 各ピークの結果をエントリに設定
-                ratio = result.params[f'ratio_{i+1}'].value
-                amp = result.params[f'area_{i+1}'].value
-                cen = result.params[f'center_{i+1}'].value
-                #Gwid = result.params[f'G_FWHM_{i+1}'].value
-                #Lwid = result.params[f'L_FWHM_{i+1}'].value
-                
-                ratio_param = result.params[f'ratio_{i+1}']
-                ratio_fixed = not ratio_param.vary  # 固定されているかどうか
-                
-                # cが付いている場合、末尾に 'f' を追加して表示
-                ratio_value, ratio_fixed = peak_params[f'ratio_{i+1}']
-                area_value, area_fixed = peak_params[f'area_{i+1}']
-                center_value, center_fixed = peak_params[f'center_{i+1}']
-                # 'f'が付いている場合、末尾に 'f' を追加して表示
-                ratio_str = f"{ratio:.4f}" + ('f' if ratio_fixed else '')
-                area_str = f"{amp:.4f}" + ('f' if area_fixed else '')
-                center_str = f"{cen:.4f}" + ('f' if center_fixed else '')
-                # 結果をエントリに設定
-                for entry in self.entries[i]:
-                    entry.config(state="normal")  # 一時的に "normal" に変更
-                self.entries[i][0].delete(0, tk.END)
-                self.entries[i][1].delete(0, tk.END)
-                self.entries[i][2].delete(0, tk.END)
-                self.entries[i][3].delete(0, tk.END)
-                self.entries[i][4].delete(0, tk.END)
-                self.entries[i][0].insert(0, ratio_str)
-                self.entries[i][1].insert(0, area_str)
-                self.entries[i][2].insert(0, center_str)
-                # 誤差の表示（readonlyに設定）
-                for error_entry in self.error_entries[i]:
-                    error_entry.config(state="normal")  # 一時的に "normal" に変更
-                self.error_entries[i][0].delete(0, tk.END)
-                self.error_entries[i][1].delete(0, tk.END)
-                self.error_entries[i][2].delete(0, tk.END)
-                self.error_entries[i][3].delete(0, tk.END)
-                self.error_entries[i][4].delete(0, tk.END)
-                # 誤差をstderrから取得して表示
-                self.error_entries[i][0].insert(0, f"{result.params[f'ratio_{i+1}'].stderr:.4f}")
-                self.error_entries[i][1].insert(0, f"{result.params[f'area_{i+1}'].stderr:.4f}")
-                self.error_entries[i][2].insert(0, f"{result.params[f'center_{i+1}'].stderr:.4f}")
-                
-                if ratio_fixed:  # 固定値の場合
-                    if ratio == 1:  # ガウシアンのみ
-                        Gwid = result.params[f'G_FWHM_{i+1}'].value
-                        G_FWHM_value, G_FWHM_fixed = peak_params[f'G_FWHM_{i+1}']
-                        G_FWHM_str = f"{Gwid:.4f}" + ('f' if G_FWHM_fixed else '')
-                        self.entries[i][3].insert(0, G_FWHM_str)
-                        self.error_entries[i][3].insert(0, f"{result.params[f'G_FWHM_{i+1}'].stderr:.4f}")
-                    elif ratio == 0:  # ローレンチアンのみ
-                        Lwid = result.params[f'L_FWHM_{i+1}'].value
-                        L_FWHM_value, L_FWHM_fixed = peak_params[f'L_FWHM_{i+1}']
-                        L_FWHM_str = f"{Lwid:.4f}" + ('f' if L_FWHM_fixed else '')
-                        self.entries[i][4].insert(0, L_FWHM_str)
-                        self.error_entries[i][4].insert(0, f"{result.params[f'L_FWHM_{i+1}'].stderr:.4f}")
-                    elif ratio == -1:  # voigtの場合
-                        # voigt関数の場合、FWHMを変換する必要がある。
-                        #sigma = fwhm_g / (2 * np.sqrt(2 * np.log(2)))  # ガウシアンの標準偏差
-                        #gamma = fwhm_l / 2 
-                        
-                        Gwid = result.params[f'G_FWHM_{i+1}'].value
-                        Lwid = result.params[f'L_FWHM_{i+1}'].value
-                        G_FWHM_value, G_FWHM_fixed = peak_params[f'G_FWHM_{i+1}']
-                        L_FWHM_value, L_FWHM_fixed = peak_params[f'L_FWHM_{i+1}']
-                        G_FWHM_str = f"{Gwid:.4f}" + ('f' if G_FWHM_fixed else '')
-                        L_FWHM_str = f"{Lwid:.4f}" + ('f' if L_FWHM_fixed else '')
-                        G_FWHM_stderr = result.params[f'G_FWHM_{i+1}'].stderr
-                        L_FWHM_stderr = result.params[f'L_FWHM_{i+1}'].stderr
-                        self.entries[i][3].insert(0, G_FWHM_str)
-                        self.entries[i][4].insert(0, L_FWHM_str)  
-                        self.error_entries[i][3].insert(0, f"{G_FWHM_stderr:.4f}")
-                        self.error_entries[i][4].insert(0, f"{L_FWHM_stderr:.4f}")
-
-                else:  # pseudo voigtの場合
-                    Gwid = result.params[f'G_FWHM_{i+1}'].value
-                    Lwid = result.params[f'L_FWHM_{i+1}'].value
-                    G_FWHM_value, G_FWHM_fixed = peak_params[f'G_FWHM_{i+1}']
-                    L_FWHM_value, L_FWHM_fixed = peak_params[f'L_FWHM_{i+1}']
-                    G_FWHM_str = f"{Gwid:.4f}" + ('f' if G_FWHM_fixed else '')
-                    L_FWHM_str = f"{Lwid:.4f}" + ('f' if L_FWHM_fixed else '')
-                    self.entries[i][3].insert(0, G_FWHM_str)
-                    self.entries[i][4].insert(0, L_FWHM_str)
-                    self.error_entries[i][3].insert(0, f"{result.params[f'G_FWHM_{i+1}'].stderr:.4f}")
-                    self.error_entries[i][4].insert(0, f"{result.params[f'L_FWHM_{i+1}'].stderr:.4f}")
-
-                # 最後にエントリを "readonly" に戻す（誤差のみに適用）
-                for error_entry in self.error_entries[i]:
-                    error_entry.config(state="readonly")
-
-        # 最後にバックグラウンドのエントリを "readonly" に戻す（誤差部分はreadonlyにする）
-        for entry in self.bg_entries:
-            entry.config(state="normal")
-        for entry in self.bg_errors:
-            entry.config(state="readonly")  # 誤差部分のみ readonly に戻す
+        # バックグラウンドパラメータの結果を表示（誤差は readonly）
+        for k, (entry, error_entry) in enumerate(zip(self.bg_entries, self.bg_errors)):
+            self.set_entry_text(entry, f"{best[k]:.4f}" + ('f' if spec.bg_fixed[k] else ''), "normal")
+            self.set_entry_text(error_entry, f"{stderr[k]:.4f}" if np.isfinite(stderr[k]) else "", "readonly")
+
+        # ピーク関数のパラメータの結果を表の中身に書き込んでから表示する (使わない項目は空欄)
+        self.store_peak_rows()
+        # フィット中に peaks の欄で表を小さくした場合は、結果のピークが入るように広げる (広げた行はオンにする)
+        n_rows = max((peak.number for peak in spec.peaks), default=0)
+        if n_rows > self.num_peak:
+            old_rows = self.num_peak
+            self.resize_peak_rows(n_rows)
+            for peak in spec.peaks:
+                if peak.number > old_rows:
+                    self.peak_enabled[peak.number-1] = True
+        values = compiled.peak_table(best)
+        errors = compiled.peak_table(stderr)
+        for k, peak in enumerate(spec.peaks):
+            used = [value is not None for value in peak.values]
+            self.peak_texts[peak.number-1] = [f"{values[k, j]:.4f}" + ('f' if peak.fixed[j] else '') if used[j] else ""
+                                              for j in range(len(fit_engine.PEAK_FIELDS))]
+            self.peak_error_texts[peak.number-1] = [f"{errors[k, j]:.4f}" if used[j] and np.isfinite(errors[k, j]) else ""
+                                                    for j in range(len(fit_engine.PEAK_FIELDS))]
+        self.show_peak_rows(store=False)
     
     def save_fitting_results0(self):
         """
@@ -1081,7 +1786,7 @@ class FittingTool:
             if not hasattr(self, 'result'):
                 raise AttributeError("Fitting results do not exist. Please perform fitting first.")
             result = self.result
-            fit_params = result.params
+            p = result.best_values
 
             # 元データ
             x_data = self.x_data
@@ -1090,14 +1795,14 @@ class FittingTool:
             x_fit = self.fit_x_data
 
             # フィッティング曲線の計算
-            y_fit = self.calculate_fit_curve(x_fit, fit_params)
+            y_fit = self.calculate_fit_curve(x_fit, p)
 
             # バックグラウンド曲線の計算
-            y_bg = self.calculate_background_curve(x_fit, fit_params)
+            y_bg = self.calculate_background_curve(x_fit, p)
 
             # 各ガウシアン曲線の計算
-            # peak_curves = self.calculate_peak_curves(x_fit, fit_params) # BG無
-            peak_curves = self.calculate_peak_and_BG_curves0(x_fit, fit_params) # BG無
+            # peak_curves = self.calculate_peak_curves(x_fit, p) # BG無
+            peak_curves = self.calculate_peak_and_BG_curves0(x_fit, p) # BG無
 
             # 保存ダイアログ
             filename = filedialog.asksaveasfilename(defaultextension=".csv",
@@ -1113,20 +1818,23 @@ class FittingTool:
                 # Chi-squaredとパラメータ用のデータを準備
                 param_rows = [['Chi-squared', chi2_value, '']]
                 #param_rows.append(['Parameter', 'Value', 'Error'])
-                for param_name, param in fit_params.items():
-                    param_rows.append([param_name, param.value, param.stderr])
+                # パラメータのベクトルと名前を並べる (名前を使うのはここだけ)
+                compiled = result.compiled
+                stderr = result.stderr
+                for i, param_name in enumerate(compiled.names):
+                    param_rows.append([param_name, p[i], None if stderr is None else stderr[i]])
+                # 不確かさを推定した場合は Error の隣にパーセンタイル区間を追加
+                param_headers = ['Parameter', 'Value', 'Error']
+                intervals = self.interval_columns(result)
+                if intervals is not None:
+                    level = f"{100 * uncertainty.LEVEL:.1f}%"
+                    param_headers += [f'Lower ({level})', f'Upper ({level})']
+                    param_rows[0] += ['', '']
+                    for row, lower, upper in zip(param_rows[1:], *intervals):
+                        row += [lower, upper]
                     
-                # パラメータ名リストを用意（例として fit_params のキーを使用）
-                param_names = fit_params.keys()
-                
-                # ピーク番号を抽出（"peak_" または数字を含む名前を対象）
-                peak_numbers = sorted(
-                    set(
-                        int(match.group(1))
-                        for name in param_names
-                        if (match := re.search(r'_(\d+)', name))
-                    )
-                )
+                # ピーク番号 (チェックボックスの番号、peak_curves の順番)
+                peak_numbers = [peak.number for peak in compiled.spec.peaks]
 
                 # データ列の準備
                 data_headers = ['','x_data', 'y_data', 'yerr_data', 'x_fit', 'y_fit', 'y_bg']  # 空列を追加
@@ -1135,26 +1843,26 @@ class FittingTool:
 
                 # 各データ列を同じ長さにするため調整
                 max_length = max(len(x_data), len(x_fit))
-                x_data = list(x_data) + [""] * (max_length - len(x_data))
-                y_data = list(y_data) + [""] * (max_length - len(y_data))
-                yerr_data = list(yerr_data) + [""] * (max_length - len(yerr_data))
-                x_fit = list(x_fit) + [""] * (max_length - len(x_fit))
-                y_fit = list(y_fit) + [""] * (max_length - len(y_fit))
-                y_bg = list(y_bg) + [""] * (max_length - len(y_bg))
-                peak_curves = [list(peak) + [""] * (max_length - len(peak)) for peak in peak_curves]
+                x_data = np.asarray(x_data).tolist() + [""] * (max_length - len(x_data))
+                y_data = np.asarray(y_data).tolist() + [""] * (max_length - len(y_data))
+                yerr_data = np.asarray(yerr_data).tolist() + [""] * (max_length - len(yerr_data))
+                x_fit = np.asarray(x_fit).tolist() + [""] * (max_length - len(x_fit))
+                y_fit = np.asarray(y_fit).tolist() + [""] * (max_length - len(y_fit))
+                y_bg = np.asarray(y_bg).tolist() + [""] * (max_length - len(y_bg))
+                peak_curves = [peak.tolist() + [""] * (max_length - len(peak)) for peak in peak_curves]
 
                 # データ列を行ごとにまとめる
                 data_rows = list(zip(x_data, y_data, yerr_data, x_fit, y_fit, y_bg, *peak_curves))
 
                 # ヘッダー行を作成
-                header_row = ['Parameter', 'Value', 'Error'] + data_headers
+                header_row = param_headers + data_headers
 
                 # ヘッダー行を書き込み
                 writer.writerow(header_row)
 
                 # パラメータ行とデータ行を列方向に統合して書き込み
                 for i in range(max(max_length, len(param_rows))):
-                    param_part = param_rows[i] if i < len(param_rows) else [""] * 3
+                    param_part = param_rows[i] if i < len(param_rows) else [""] * len(param_headers)
                     data_part = list(data_rows[i]) if i < len(data_rows) else [""] * len(data_headers)
                     writer.writerow(param_part + [""] + data_part)  # 空列を追加
                 
@@ -1173,7 +1881,7 @@ class FittingTool:
                 raise AttributeError("Fitting results do not exist. Please perform fitting first.")
 
             result = self.result
-            fit_params = result.params
+            p = result.best_values
 
             # 元データ
             x_data = self.x_data
@@ -1182,14 +1890,14 @@ class FittingTool:
             x_fit = self.fit_x_data
 
             # フィッティング曲線の計算
-            y_fit = self.calculate_fit_curve(x_fit, fit_params)
+            y_fit = self.calculate_fit_curve(x_fit, p)
 
             # バックグラウンド曲線の計算
-            y_bg = self.calculate_background_curve(x_fit, fit_params)
+            y_bg = self.calculate_background_curve(x_fit, p)
 
             # 各ガウシアン曲線の計算
-            # peak_curves = self.calculate_peak_curves(x_fit, fit_params) # BG無
-            peak_curves = self.calculate_peak_and_BG_curves1(x_fit, fit_params) # BG有
+            # peak_curves = self.calculate_peak_curves(x_fit, p) # BG無
+            peak_curves = self.calculate_peak_and_BG_curves1(x_fit, p) # BG有
 
             # 保存ダイアログ
             filename = filedialog.asksaveasfilename(defaultextension=".csv",
@@ -1205,20 +1913,23 @@ class FittingTool:
                 # Chi-squaredとパラメータ用のデータを準備
                 param_rows = [['Chi-squared', chi2_value, '']]
                 #param_rows.append(['Parameter', 'Value', 'Error'])
-                for param_name, param in fit_params.items():
-                    param_rows.append([param_name, param.value, param.stderr])
+                # パラメータのベクトルと名前を並べる (名前を使うのはここだけ)
+                compiled = result.compiled
+                stderr = result.stderr
+                for i, param_name in enumerate(compiled.names):
+                    param_rows.append([param_name, p[i], None if stderr is None else stderr[i]])
+                # 不確かさを推定した場合は Error の隣にパーセンタイル区間を追加
+                param_headers = ['Parameter', 'Value', 'Error']
+                intervals = self.interval_columns(result)
+                if intervals is not None:
+                    level = f"{100 * uncertainty.LEVEL:.1f}%"
+                    param_headers += [f'Lower ({level})', f'Upper ({level})']
+                    param_rows[0] += ['', '']
+                    for row, lower, upper in zip(param_rows[1:], *intervals):
+                        row += [lower, upper]
                     
-                # パラメータ名リストを用意（例として fit_params のキーを使用）
-                param_names = fit_params.keys()
-                
-                # ピーク番号を抽出（"peak_" または数字を含む名前を対象）
-                peak_numbers = sorted(
-                    set(
-                        int(match.group(1))
-                        for name in param_names
-                        if (match := re.search(r'_(\d+)', name))
-                    )
-                )
+                # ピーク番号 (チェックボックスの番号、peak_curves の順番)
+                peak_numbers = [peak.number for peak in compiled.spec.peaks]
 
                 # データ列の準備
                 data_headers = ['','x_data', 'y_data', 'yerr_data', 'x_fit', 'y_fit', 'y_bg']  # 空列を追加
@@ -1227,26 +1938,26 @@ class FittingTool:
 
                 # 各データ列を同じ長さにするため調整
                 max_length = max(len(x_data), len(x_fit))
-                x_data = list(x_data) + [""] * (max_length - len(x_data))
-                y_data = list(y_data) + [""] * (max_length - len(y_data))
-                yerr_data = list(yerr_data) + [""] * (max_length - len(yerr_data))
-                x_fit = list(x_fit) + [""] * (max_length - len(x_fit))
-                y_fit = list(y_fit) + [""] * (max_length - len(y_fit))
-                y_bg = list(y_bg) + [""] * (max_length - len(y_bg))
-                peak_curves = [list(peak) + [""] * (max_length - len(peak)) for peak in peak_curves]
+                x_data = np.asarray(x_data).tolist() + [""] * (max_length - len(x_data))
+                y_data = np.asarray(y_data).tolist() + [""] * (max_length - len(y_data))
+                yerr_data = np.asarray(yerr_data).tolist() + [""] * (max_length - len(yerr_data))
+                x_fit = np.asarray(x_fit).tolist() + [""] * (max_length - len(x_fit))
+                y_fit = np.asarray(y_fit).tolist() + [""] * (max_length - len(y_fit))
+                y_bg = np.asarray(y_bg).tolist() + [""] * (max_length - len(y_bg))
+                peak_curves = [peak.tolist() + [""] * (max_length - len(peak)) for peak in peak_curves]
 
                 # データ列を行ごとにまとめる
                 data_rows = list(zip(x_data, y_data, yerr_data, x_fit, y_fit, y_bg, *peak_curves))
 
                 # ヘッダー行を作成
-                header_row = ['Parameter', 'Value', 'Error'] + data_headers
+                header_row = param_headers + data_headers
 
                 # ヘッダー行を書き込み
                 writer.writerow(header_row)
 
                 # パラメータ行とデータ行を列方向に統合して書き込み
                 for i in range(max(max_length, len(param_rows))):
-                    param_part = param_rows[i] if i < len(param_rows) else [""] * 3
+                    param_part = param_rows[i] if i < len(param_rows) else [""] * len(param_headers)
                     data_part = list(data_rows[i]) if i < len(data_rows) else [""] * len(data_headers)
                     writer.writerow(param_part + [""] + data_part)  # 空列を追加
                 
@@ -1255,233 +1966,42 @@ class FittingTool:
         except Exception as e:
             messagebox.showerror("Error", f"An error occurred while saving.: {e}")
 
-    def calculate_fit_curve(self, x_data, params):
+    def calculate_fit_curve(self, x_data, p):
         """
-        フィッティング曲線を計算する。
+        フィッティング曲線を計算する (p は全パラメータのベクトル)。
         """
-        return [self.model(params, x) for x in x_data]
+        return self.model(p, np.asarray(x_data))
 
-    def calculate_background_curve(self, x_data, params):
+    def calculate_background_curve(self, x_data, p):
         """
         バックグラウンド曲線を計算する。
         """
-        bg_a = params['bg_a'].value
-        bg_b = params['bg_b'].value
-        bg_c = params['bg_c'].value
-        bg_d = params['bg_d'].value
-        bg_e = params['bg_e'].value
-        return [bg_a + bg_b * x + bg_c * (x**2) + bg_d * (x**3) + bg_e * (x**4) for x in x_data]
-
-    def model(self, params, x):
+        return self.result.compiled.background(p, np.asarray(x_data, dtype=float))
+
+    def model(self, p, x):
         """
         モデル関数：バックグラウンド + ガウシアン/ローレンチアン/擬フォークトの合計を計算する。
         """
-        # バックグラウンド部分
-        bg_a = params['bg_a'].value
-        bg_b = params['bg_b'].value
-        bg_c = params['bg_c'].value
-        bg_d = params['bg_d'].value
-        bg_e = params['bg_e'].value
-        background = bg_a + bg_b * x + bg_c * (x**2) + bg_d * (x**3) + bg_e * (x**4)
-
-        # ピークの合計
-        peak_sum = 0
-        for i in range(1, self.num_peak+1):  # 最大self.num_peak個のピーク
-            ratio_key = f'ratio_{i}'
-            area_key = f'area_{i}'
-            center_key = f'center_{i}'
-            G_FWHM_key = f'G_FWHM_{i}'
-            L_FWHM_key = f'L_FWHM_{i}'
-
-            # ピークパラメータが存在する場合のみ処理
-            if area_key in params and center_key in params:
-                amplitude = params[area_key].value
-                center = params[center_key].value
-                ratio = params[ratio_key].value if ratio_key in params else 0.5  # デフォルト0.5
-                Gwidth = params[G_FWHM_key].value if G_FWHM_key in params else None
-                Lwidth = params[L_FWHM_key].value if L_FWHM_key in params else None
-
-                # 条件分岐による関数選択
-                if ratio is not None and ratio == -1:  # ratioが-1の場合はVoigt関数
-                    peak = self.voigt(x, center, amplitude, Gwidth, Lwidth)
-                elif Gwidth is not None and Lwidth is not None:  # 擬フォークト関数
-                    peak = (ratio * amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / 
-                            (Gwidth * (np.pi / (4 * np.log(2)))**0.5) +
-                            (1 - ratio) * amplitude * 2 / np.pi * Lwidth / 
-                            (4 * (x - center)**2 + Lwidth**2))
-                elif Gwidth is not None:  # ガウシアン関数
-                    peak = amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / \
-                        (Gwidth * (np.pi / (4 * np.log(2)))**0.5)
-                elif Lwidth is not None:  # ローレンチアン関数
-                    peak = amplitude * 2 / np.pi * Lwidth / (4 * (x - center)**2 + Lwidth**2)
-                else:
-                    continue  # パラメータ不足の場合はスキップ
-
-                # ピークを合計に加算
-                peak_sum += peak
-
-        return background + peak_sum
+        # 同じ種類のピークをまとめて計算する
+        return self.result.compiled.evaluate(p, np.asarray(x, dtype=float))
 
-    def calculate_peak_curves(self, x_data, params):
+    def calculate_peak_curves(self, x_data, p):
         """
         各ピーク（ガウシアン、ローレンチアン、擬フォークト）曲線を計算する。
         """
-        
-        curves = []
-        for i in range(1, self.num_peak+1):  # 最大self.num_peak個のピークを想定
-            ratio_key = f'ratio_{i}'
-            area_key = f'area_{i}'
-            center_key = f'center_{i}'
-            G_FWHM_key = f'G_FWHM_{i}'
-            L_FWHM_key = f'L_FWHM_{i}'
-
-            if area_key in params and center_key in params:
-                amplitude = params[area_key].value
-                center = params[center_key].value
-                ratio = params[ratio_key].value if ratio_key in params else 0.5  # デフォルト値 0.5
-                Gwidth = params[G_FWHM_key].value if G_FWHM_key in params else None
-                Lwidth = params[L_FWHM_key].value if L_FWHM_key in params else None
-
-                # 条件分岐で関数選択
-                if ratio is not None and ratio == -1:  # ratioが-1の場合はVoigt関数
-                    curve = self.voigt(x_data, center, amplitude, Gwidth, Lwidth)
-                elif Gwidth is not None and Lwidth is not None:  # 擬フォークト関数
-                    curve = [
-                        ratio * amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / 
-                        (Gwidth * (np.pi / (4 * np.log(2)))**0.5) + 
-                        (1 - ratio) * amplitude * 2 / np.pi * Lwidth / 
-                        (4 * (x - center)**2 + Lwidth**2)
-                        for x in x_data
-                    ]
-                elif Gwidth is not None:  # ガウシアン関数
-                    curve = [
-                        amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / 
-                        (Gwidth * (np.pi / (4 * np.log(2)))**0.5)
-                        for x in x_data
-                    ]
-                elif Lwidth is not None:  # ローレンチアン関数
-                    curve = [
-                        amplitude * 2 / np.pi * Lwidth / (4 * (x - center)**2 + Lwidth**2)
-                        for x in x_data
-                    ]
-                else:
-                    continue  # パラメータ不足の場合はスキップ
-
-                # 計算した曲線をリストに追加
-                curves.append(curve)
-
-        return curves
-
-    def calculate_peak_and_BG_curves0(self, x_data, params):
-        bg_a = params['bg_a'].value
-        bg_b = params['bg_b'].value
-        bg_c = params['bg_c'].value
-        bg_d = params['bg_d'].value
-        bg_e = params['bg_e'].value
-        peaks = []
-
-        for i in range(1, self.num_peak+1):  # 最大self.num_peak個のガウシアンを想定
-            ratio_key = f'ratio_{i}'
-            area_key = f'area_{i}'
-            center_key = f'center_{i}'
-            G_FWHM_key = f'G_FWHM_{i}'
-            L_FWHM_key = f'L_FWHM_{i}'
-
-            # 必要なパラメータがparamsに存在するか確認
-            if ratio_key in params and area_key in params and center_key in params:
-                ratio = params[ratio_key].value
-                amplitude = params[area_key].value
-                center = params[center_key].value
-
-                # G_FWHMとL_FWHMが存在する場合のみ、それぞれの値を取得
-                Gwidth = params[G_FWHM_key].value if G_FWHM_key in params else None
-                Lwidth = params[L_FWHM_key].value if L_FWHM_key in params else None
-
-                if ratio is not None and ratio == -1:  # ratioが-1の場合はVoigt関数
-                    peak = self.voigt(x_data, center, amplitude, Gwidth, Lwidth)
-                elif Gwidth is not None and Lwidth is not None:
-                    # 擬フォークト関数の計算
-                    peak = [
-                        ratio * amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / (Gwidth * (np.pi / (4 * np.log(2)))**(1 / 2)) +
-                        (1 - ratio) * amplitude * 2 / np.pi * Lwidth / (4 * (x - center)**2 + Lwidth**2) for x in x_data
-                    ]
-                elif Gwidth is not None:
-                    # ガウシアンのみ
-                    peak = [
-                        amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / (Gwidth * (np.pi / (4 * np.log(2)))**(1 / 2)) for x in x_data
-                    ]
-                elif Lwidth is not None:
-                    # ローレンチアンのみ
-                    peak = [
-                        amplitude * 2 / np.pi * Lwidth / (4 * (x - center)**2 + Lwidth**2) for x in x_data
-                    ]
-                else:
-                    # G_FWHMもL_FWHMも存在しない場合は空リストを追加
-                    peak = []
-
-                # ガウシアンをリストに追加
-                peaks.append(peak)
+        return self.result.compiled.peak_curves(p, np.asarray(x_data, dtype=float))
 
-        return peaks
+    def calculate_peak_and_BG_curves0(self, x_data, p):
+        # 各ピーク (BG無)
+        return self.calculate_peak_curves(x_data, p)
     
-    def calculate_peak_and_BG_curves1(self, x_data, params):
-        bg_a = params['bg_a'].value
-        bg_b = params['bg_b'].value
-        bg_c = params['bg_c'].value
-        bg_d = params['bg_d'].value
-        bg_e = params['bg_e'].value
-        peaks = []
-
-        for i in range(1, self.num_peak+1):  # 最大self.num_peak個のガウシアンを想定
-            ratio_key = f'ratio_{i}'
-            area_key = f'area_{i}'
-            center_key = f'center_{i}'
-            G_FWHM_key = f'G_FWHM_{i}'
-            L_FWHM_key = f'L_FWHM_{i}'
-
-            # 必要なパラメータがparamsに存在するか確認
-            if ratio_key in params and area_key in params and center_key in params:
-                ratio = params[ratio_key].value
-                amplitude = params[area_key].value
-                center = params[center_key].value
-
-                # G_FWHMとL_FWHMが存在する場合のみ、それぞれの値を取得
-                Gwidth = params[G_FWHM_key].value if G_FWHM_key in params else None
-                Lwidth = params[L_FWHM_key].value if L_FWHM_key in params else None
-
-                if ratio is not None and ratio == -1:  # ratioが-1の場合はVoigt関数
-                    peak_func = self.voigt(x_data, center, amplitude, Gwidth, Lwidth)
-                    BG_func = [bg_a + bg_b * x + bg_c * (x**2) + bg_d * (x**3) + bg_e * (x**4) for x in x_data]
-                    peak = peak_func + BG_func
-                elif Gwidth is not None and Lwidth is not None:
-                    # 擬フォークト関数
-                    peak = [
-                        ratio * amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / (Gwidth * (np.pi / (4 * np.log(2)))**(1 / 2)) +
-                        (1 - ratio) * amplitude * 2 / np.pi * Lwidth / (4 * (x - center)**2 + Lwidth**2) +
-                        bg_a + bg_b * x + bg_c * (x**2) + bg_d * (x**3) + bg_e * (x**4) for x in x_data
-                    ]
-                elif Gwidth is not None:
-                    # ガウシアンのみ
-                    peak = [
-                        amplitude * np.exp(-4 * np.log(2) * ((x - center) / Gwidth)**2) / (Gwidth * (np.pi / (4 * np.log(2)))**(1 / 2)) +
-                        bg_a + bg_b * x + bg_c * (x**2) + bg_d * (x**3) + bg_e * (x**4) for x in x_data
-                    ]
-                elif Lwidth is not None:
-                    # ローレンチアンのみ
-                    peak = [
-                        amplitude * 2 / np.pi * Lwidth / (4 * (x - center)**2 + Lwidth**2) +
-                        bg_a + bg_b * x + bg_c * (x**2) + bg_d * (x**3) + bg_e * (x**4) for x in x_data
-                    ]
-                else:
-                    # G_FWHMもL_FWHMも存在しない場合は空リストを追加
-                    peak = []
-
-                # ガウシアンをリストに追加
-                peaks.append(peak)
-
-        return peaks
+    def calculate_peak_and_BG_curves1(self, x_data, p):
+        # 各ピーク + バックグラウンド
+        return self.calculate_peak_curves(x_data, p) + self.calculate_background_curve(x_data, p)
 
 if __name__ == "__main__":
+    # pyinstaller で作った exe からプロセスプールを使うため
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = FittingTool(root)
     root.mainloop()
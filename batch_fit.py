@@ -0,0 +1,396 @@
+"""多数の CSV ファイルを GUI なしでまとめてフィットする
+
+    python batch_fit.py "data/*.csv" --template template.csv --columns 1 2 3 --range 10 50 -o results.csv
+
+列番号は GUI の X / Y / Yerror の欄と同じく 1 始まり。フィット範囲を省略すると全範囲を使う。
+テンプレートは GUI のエントリーボックスと同じ書式 ('1.0f' なら固定値) の CSV で、
+1列目が 'bg' の行はバックグラウンド (a, b, c, d, e)、1列目が整数の行はその番号のピーク
+(ratio, area, center, G_FWHM, L_FWHM) とする。それ以外の行 (見出しや '#' で始まる行) は無視する。
+
+    name,ratio/a,area/b,center/c,G_FWHM/d,L_FWHM/e
+    bg,0,0,0f,0f,0f
+    1,0.5,10,25,1,1
+    2,1f,5,30,1,1f
+
+各ファイルは ProcessPoolExecutor で並列にフィットし、結果はファイルごとに1行書き出す。
+--sequential を付けると温度・磁場などの系列としてファイル名の順 (数字は数値順) に1つずつフィットし、
+前のスキャンの結果を次の初期値にする (fit_engine.fit_series)。
+--auto-seed を付けると (並列モードで) ファイルごとにピークを自動検出して初期値にする (peak_detect.seed_spec)。
+並列モードでは結果をキャッシュ (fit_cache) に保存するので、途中で止まった後のやり直しでは
+フィット済みのファイルを読み込むだけで済む。--no-cache で使わない。
+--global を付けると全ファイルを同時にフィットし、--shared で指定したパラメータ
+('G_FWHM_1' や、全ピーク共通なら 'G_FWHM') を全ファイルで共通にする (global_fit.fit_global)。
+"""
+import argparse
+import csv
+import functools
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import csv_loader
+import faddeeva
+import fit_cache
+import fit_engine
+import global_fit
+import peak_detect
+import solvers
+import trf_fit
+
+# ワーカープロセスごとに一度だけ作るモデルと、ピークの自動検出の方法 (None なら検出しない)、結果のキャッシュ、解法とその引数
+_worker_model = None
+_worker_seed_method = None
+_worker_cache = None
+_worker_solver = solvers.DEFAULT_SOLVER
+_worker_solver_options = {}
+
+
+def read_template(path):
+    """テンプレート CSV を読み込んで ModelSpec を返す"""
+    bg_texts = None
+    peak_texts = []
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if not row or row[0].strip().startswith('#'):
+                continue
+            label = row[0].strip()
+            texts = [text.strip() for text in row[1:6]]
+            if label.lower() == 'bg':
+                bg_texts = texts
+            elif label.isdigit():
+                peak_texts.append((int(label), texts))
+    if bg_texts is None or len(bg_texts) < len(fit_engine.BG_NAMES):
+        raise ValueError(f"{path}: a 'bg' row with {len(fit_engine.BG_NAMES)} values is required.")
+    for number, texts in peak_texts:
+        if len(texts) < len(fit_engine.PEAK_FIELDS):
+            raise ValueError(f"{path}: peak {number} needs {len(fit_engine.PEAK_FIELDS)} values.")
+    if not peak_texts:
+        raise ValueError(f"{path}: no peak rows found.")
+    return fit_engine.spec_from_entries(bg_texts, sorted(peak_texts))
+
+
+def read_columns(path, x_col, y_col, err_col):
+    """CSV から x, y, y_error を読み込む (列番号は0始まり、GUI の load_csv と同じ csv_loader.load_xye)"""
+    data = csv_loader.load_xye(path, x_col, y_col, err_col)
+    return data.x, data.y, data.y_error
+
+
+def result_header(spec):
+    """結果ファイルの見出し"""
+    names = fit_engine.CompiledModel(spec).names
+    header = ['File', 'Status', 'Message', 'Start', 'nfev', 'Chi-squared']
+    for name in names:
+        header += [name, f'{name} Error']
+    return header
+
+
+def _init_worker(spec, voigt_backend, voigt_rtol, seed_method=None, cache=None, solver=solvers.DEFAULT_SOLVER,
+                 window_rtol=None, bg_basis=None, solver_options=None):
+    """ワーカープロセスの初期化 (モデルを一度だけ作る)"""
+    global _worker_model, _worker_seed_method, _worker_cache, _worker_solver, _worker_solver_options
+    _worker_model = fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    _worker_seed_method = seed_method
+    _worker_cache = cache
+    _worker_solver = solver
+    _worker_solver_options = solver_options or {}
+
+
+def read_fit_data(path, columns, fit_range):
+    """フィットに使う x, y, y_error (フィット範囲内) を読み込む"""
+    x_data, y_data, y_error = read_columns(path, *columns)
+    if fit_range is not None:
+        mask = (x_data >= fit_range[0]) & (x_data <= fit_range[1])
+        x_data, y_data, y_error = x_data[mask], y_data[mask], y_error[mask]
+    if len(x_data) == 0:
+        raise ValueError("No data points in the fit range.")
+    return x_data, y_data, y_error
+
+
+def result_row(path, result, start='template', nfev=None):
+    """FitResult から結果ファイルの1行を作る (上限や cancel で打ち切った場合の Status は 'stopped')"""
+    if result.stopped is not None:
+        status, message = 'stopped', result.message
+    elif result.stderr is None:
+        status, message = 'failed', "Fitting failed. Please check your data and initial parameters."
+    else:
+        status, message = ('ok' if result.success else 'failed'), result.message
+    row = [path, status, message, start, result.nfev if nfev is None else nfev, result.redchi]
+    for i in range(len(result.compiled.names)):
+        row += [result.best_values[i], '' if result.stderr is None else result.stderr[i]]
+    return row
+
+
+def error_row(path, error, n_params, status='error'):
+    """読み込みやフィットで例外が起きたファイル (status が 'cancelled' の場合はフィットしなかったファイル) の行"""
+    return [path, status, str(error), '', '', ''] + [''] * (2 * n_params)
+
+
+def fit_file(path, columns, fit_range):
+    """1ファイルをフィットして結果の1行を返す (ワーカープロセスで実行)"""
+    compiled = _worker_model
+    try:
+        x_data, y_data, y_error = read_fit_data(path, columns, fit_range)
+        start = None
+        if _worker_seed_method is not None:
+            seeded = peak_detect.seed_spec(compiled.spec, x_data, y_data, _worker_seed_method)
+            start = fit_engine.CompiledModel(seeded).values
+        if _worker_cache is not None:
+            result = fit_cache.cached_fit(compiled, x_data, y_data, y_error, _worker_cache, solver=_worker_solver,
+                                          start=start, **_worker_solver_options)[0]
+        else:
+            result = solvers.fit(compiled, x_data, y_data, y_error, solver=_worker_solver, start=start,
+                                 **_worker_solver_options)
+    except Exception as e:
+        return error_row(path, e, len(compiled.names))
+    return result_row(path, result, 'template' if start is None else 'auto seed')
+
+
+def natural_key(path):
+    """ファイル名の中の数字を数値として比較するためのキー (scan_9 < scan_10)"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path)]
+
+
+def find_files(patterns):
+    """glob パターンに一致するファイルを重複なしで名前順 (数字は数値順) に返す"""
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(pattern, recursive=True))
+    return sorted(files, key=natural_key)
+
+
+def run(files, spec, columns, fit_range, output, workers=None, voigt_backend=None, voigt_rtol=None,
+        seed_method=None, cache=None, solver=solvers.DEFAULT_SOLVER, window_rtol=None, bg_basis=None,
+        solver_options=None):
+    """files をフィットして結果を output に書き出す。(成功数, 失敗数) を返す
+
+    seed_method ('prominence' / 'cwt') を指定するとファイルごとにピークを検出して初期値にする。
+    cache (fit_cache.FitCache) を指定すると結果を保存し、保存済みの結果はフィットせずに使う。
+    solver は解法 (solvers.SOLVERS のキー)、solver_options はその解法に渡す引数 (trf_fit.fit の loss など、
+    ファイルごとの打ち切りの条件 max_nfev, time_budget)。
+    window_rtol はピークを計算する範囲の許容値、
+    bg_basis はバックグラウンドの基底 (fit_engine.CompiledModel)。
+    """
+    workers = workers or os.cpu_count() or 1
+    # 小さいファイルが多い場合のプロセス間通信の回数を減らす
+    chunksize = max(1, len(files) // (4 * workers))
+    n_ok = 0
+    with open(output, mode='w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(result_header(spec))
+        if workers == 1:
+            _init_worker(spec, voigt_backend, voigt_rtol, seed_method, cache, solver, window_rtol, bg_basis,
+                         solver_options)
+            rows = (fit_file(path, columns, fit_range) for path in files)
+            for row in rows:
+                writer.writerow(row)
+                n_ok += row[1] == 'ok'
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(spec, voigt_backend, voigt_rtol, seed_method, cache, solver,
+                                               window_rtol, bg_basis, solver_options)) as executor:
+                n = len(files)
+                rows = executor.map(fit_file, files, [columns] * n, [fit_range] * n, chunksize=chunksize)
+                for row in rows:
+                    writer.writerow(row)
+                    n_ok += row[1] == 'ok'
+    return n_ok, len(files) - n_ok
+
+
+def run_sequential(files, spec, columns, fit_range, output, chi2_jump=fit_engine.CHI2_JUMP,
+                   voigt_backend=None, voigt_rtol=None, window_rtol=None, bg_basis=None,
+                   solver=solvers.DEFAULT_SOLVER, solver_options=None, progress=None, cancel=None):
+    """files を順番にフィットし、前のスキャンの結果を次の初期値にする
+
+    (成功数, 失敗数, 最後に成功した (ファイル, FitResult)) を返す。
+    読み込めないファイルは飛ばして次のファイルに進む。solver, solver_options は run と同じ (time_budget と
+    max_nfev はファイルごとの上限)。progress を指定すると1ファイルごとに progress(済んだファイル数, ファイル数) を呼ぶ。
+    cancel (threading.Event など) がセットされるとフィット中のファイルを打ち切り、残りのファイルは Status を
+    'cancelled' にして書き出す。
+    """
+    compiled = fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    rows = {}
+    readable = []
+
+    def datasets():
+        for path in files:
+            try:
+                data = read_fit_data(path, columns, fit_range)
+            except Exception as e:
+                rows[path] = error_row(path, e, len(compiled.names))
+                continue
+            readable.append(path)
+            yield data
+
+    last = None
+    solve = functools.partial(solvers.fit, solver=solver)
+    options = dict(solver_options or {})
+    if cancel is not None:
+        options['cancel'] = cancel
+    # fit_series はデータを1つ読むごとに結果を返すので、i 番目の結果は readable[i] のファイル
+    for i, step in enumerate(fit_engine.fit_series(compiled, datasets(), chi2_jump, solve, **options)):
+        path = readable[i]
+        rows[path] = result_row(path, step.result, step.start, step.nfev)
+        if rows[path][1] == 'ok':
+            last = (path, step.result)
+        if progress is not None:
+            progress(len(rows), len(files))
+    for path in files:
+        if path not in rows:
+            rows[path] = error_row(path, "Not fitted (cancelled).", len(compiled.names), 'cancelled')
+
+    with open(output, mode='w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(result_header(spec))
+        for path in files:
+            writer.writerow(rows[path])
+    n_ok = sum(rows[path][1] == 'ok' for path in files)
+    return n_ok, len(files) - n_ok, last
+
+
+def run_global(files, spec, columns, fit_range, output, shared=(), voigt_backend=None, voigt_rtol=None,
+               max_nfev=None, time_budget=None, cancel=None):
+    """files を同時にフィットし、shared のパラメータを全ファイルで共通にする
+
+    (成功数, 失敗数, フィットしたファイルのリスト, GlobalFitResult) を返す。
+    読み込めないファイルは除いてフィットする。max_nfev, time_budget, cancel は global_fit.fit_global に渡す
+    (打ち切った場合は全ファイルの Status が 'stopped')。
+    """
+    n_params = len(fit_engine.CompiledModel(spec).names)
+    rows = {}
+    readable = []
+    datasets = []
+    for path in files:
+        try:
+            datasets.append(read_fit_data(path, columns, fit_range))
+        except Exception as e:
+            rows[path] = error_row(path, e, n_params)
+            continue
+        readable.append(path)
+
+    result = None
+    if datasets:
+        result = global_fit.fit_global(spec, datasets, shared, max_nfev=max_nfev, voigt_backend=voigt_backend,
+                                       voigt_rtol=voigt_rtol, time_budget=time_budget, cancel=cancel)
+        for path, dataset_result in zip(readable, result.results):
+            rows[path] = result_row(path, dataset_result, 'global', result.nfev)
+
+    with open(output, mode='w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(result_header(spec))
+        for path in files:
+            writer.writerow(rows[path])
+    n_ok = sum(rows[path][1] == 'ok' for path in files)
+    return n_ok, len(files) - n_ok, readable, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit many CSV files with the same parameter template.")
+    parser.add_argument('files', nargs='+', help="CSV files or glob patterns (quote them to let Python expand)")
+    parser.add_argument('-t', '--template', required=True, help="parameter template CSV ('value' or 'valuef' = fixed)")
+    parser.add_argument('-c', '--columns', type=int, nargs=3, default=[1, 2, 3], metavar=('X', 'Y', 'YERR'),
+                        help="column indices of X, Y and Yerror (1-based, default: 1 2 3)")
+    parser.add_argument('-r', '--range', type=float, nargs=2, default=None, metavar=('XMIN', 'XMAX'),
+                        help="fit range (default: all data)")
+    parser.add_argument('-o', '--output', default='batch_results.csv', help="output CSV (one row per file)")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--voigt-backend', choices=faddeeva.BACKENDS, default=None,
+                        help="Faddeeva backend for the Voigt profile")
+    parser.add_argument('--voigt-rtol', type=float, default=None,
+                        help="relative tolerance of the rational Voigt backend "
+                             f"(default: VOIGT_RTOL or {faddeeva.DEFAULT_RTOL:g})")
+    parser.add_argument('-s', '--sequential', action='store_true',
+                        help="fit the files in order, starting each fit from the previous result")
+    parser.add_argument('--chi2-jump', type=float, default=fit_engine.CHI2_JUMP,
+                        help="in sequential mode, refit from the template when the reduced chi-squared "
+                             "exceeds this factor times the previous one (default: %(default)s)")
+    parser.add_argument('-a', '--auto-seed', nargs='?', const='prominence', default=None,
+                        choices=peak_detect.METHODS,
+                        help="detect peaks in each file and use them as initial values (default method: prominence)")
+    parser.add_argument('-g', '--global', dest='global_fit', action='store_true',
+                        help="fit all files simultaneously (parameters listed in --shared are common to all files)")
+    parser.add_argument('--shared', nargs='*', default=[], metavar='NAME',
+                        help="shared parameters in global mode, e.g. G_FWHM_1 or G_FWHM (all peaks)")
+    parser.add_argument('--solver', choices=tuple(solvers.SOLVERS), default=solvers.DEFAULT_SOLVER,
+                        help="fitting method in the parallel and sequential modes (varpro: solve areas and background linearly; "
+                             "sparse: sparse-Jacobian trust region for many separated peaks; "
+                             "clusters: fit non-overlapping peak groups separately, then polish; "
+                             "trf: bounded trust region with an optional robust --loss)")
+    parser.add_argument('--loss', choices=trf_fit.LOSSES, default='linear',
+                        help="loss of the trf solver (soft_l1, huber, cauchy: less sensitive to spikes and dead channels)")
+    parser.add_argument('--f-scale', type=float, default=trf_fit.F_SCALE,
+                        help="residuals (in units of Yerror) above this are treated as outliers by the loss "
+                             "(default: %(default)s)")
+    parser.add_argument('--ftol', type=float, default=trf_fit.FTOL, help="trf solver tolerance on the cost change")
+    parser.add_argument('--xtol', type=float, default=trf_fit.XTOL, help="trf solver tolerance on the step size")
+    parser.add_argument('--gtol', type=float, default=trf_fit.GTOL, help="trf solver tolerance on the gradient")
+    parser.add_argument('-w', '--window-rtol', type=float, nargs='?', const=fit_engine.WINDOW_RTOL, default=None,
+                        help="evaluate each peak only where it exceeds RTOL x its height "
+                             f"(default RTOL: {fit_engine.WINDOW_RTOL:g}; long sorted data with narrow peaks)")
+    parser.add_argument('--bg-basis', choices=fit_engine.BG_BASES, default=fit_engine.MONOMIAL,
+                        help="basis of the background inside the fit (chebyshev: better conditioned for "
+                             "large x; results are still reported as x^k coefficients)")
+    parser.add_argument('--max-nfev', type=int, default=None,
+                        help="maximum number of function evaluations per file (in the global mode: for the whole fit)")
+    parser.add_argument('--time-budget', type=float, default=None, metavar='SECONDS',
+                        help="stop each file's fit after this many seconds and report the best parameters so far "
+                             "with the status 'stopped' (in the global mode: for the whole fit)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="do not read or write the fit result cache (parallel mode)")
+    args = parser.parse_args(argv)
+    if args.auto_seed and (args.sequential or args.global_fit):
+        parser.error("--auto-seed is only available in the parallel mode.")
+    if args.solver != solvers.DEFAULT_SOLVER and args.global_fit:
+        parser.error("--solver is not available in the global mode.")
+    solver_options = {}
+    if args.solver == 'trf':
+        solver_options = {'loss': args.loss, 'f_scale': args.f_scale, 'ftol': args.ftol, 'xtol': args.xtol,
+                          'gtol': args.gtol}
+    elif (args.loss, args.f_scale, args.ftol, args.xtol, args.gtol) != \
+            ('linear', trf_fit.F_SCALE, trf_fit.FTOL, trf_fit.XTOL, trf_fit.GTOL):
+        parser.error("--loss, --f-scale, --ftol, --xtol and --gtol need --solver trf.")
+    if args.window_rtol is not None and args.global_fit:
+        parser.error("--window-rtol is not available in the global mode.")
+    if args.bg_basis != fit_engine.MONOMIAL and args.global_fit:
+        parser.error("--bg-basis is not available in the global mode.")
+    if args.max_nfev is not None:
+        solver_options['max_nfev'] = args.max_nfev
+    if args.time_budget is not None:
+        solver_options['time_budget'] = args.time_budget
+
+    files = find_files(args.files)
+    if not files:
+        parser.error("no files matched.")
+    spec = read_template(args.template)
+    if args.global_fit:
+        try:
+            global_fit.shared_indices(fit_engine.CompiledModel(spec), args.shared)
+        except ValueError as e:
+            parser.error(str(e))
+    columns = tuple(index - 1 for index in args.columns)
+
+    start = time.perf_counter()
+    if args.global_fit:
+        n_ok, n_failed, _, _ = run_global(files, spec, columns, args.range, args.output, args.shared,
+                                          args.voigt_backend, args.voigt_rtol, args.max_nfev, args.time_budget)
+    elif args.sequential:
+        n_ok, n_failed, _ = run_sequential(files, spec, columns, args.range, args.output, args.chi2_jump,
+                                           args.voigt_backend, args.voigt_rtol, window_rtol=args.window_rtol,
+                                           bg_basis=args.bg_basis, solver=args.solver,
+                                           solver_options=solver_options)
+    else:
+        n_ok, n_failed = run(files, spec, columns, args.range, args.output, args.workers, args.voigt_backend,
+                             args.voigt_rtol, seed_method=args.auto_seed, cache=None if args.no_cache else fit_cache.FitCache(),
+                             solver=args.solver, window_rtol=args.window_rtol, bg_basis=args.bg_basis,
+                             solver_options=solver_options)
+    elapsed = time.perf_counter() - start
+    print(f"{len(files)} files ({n_ok} ok, {n_failed} failed) in {elapsed:.2f} s -> {args.output}", file=sys.stderr)
+    return 0 if n_failed == 0 else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""重ならないピークのまとまり (クラスタ) ごとのフィット
+
+スペクトルが平らな部分で区切られた重なったピークの組からなる場合、組どうしはほとんど影響しないので、
+中心 ± widths × FWHM の範囲が重なるピークを同じクラスタにまとめ、クラスタごとにその周り (隣のクラスタとの間の中点まで)
+の x だけで局所的なバックグラウンド (テンプレートのバックグラウンド + 1次式) と一緒にプロセスプールで並列にフィットする。
+クラスタの結果をつなぎ、可変のバックグラウンドの項を線形最小二乗で合わせてから、全範囲で一度だけ仕上げる
+(初期値が最適値に近いので数回の反復で終わる)。仕上げは、問題が大きい場合はクラスタどうしが重ならないので
+ヤコビアンが疎になることを使って sparse_fit.fit で、小さい場合は fit_engine.fit (leastsq) で行う。
+"""
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import fit_engine
+import sparse_fit
+
+# 中心 ± この倍数 × FWHM の範囲が重なるピークを同じクラスタにする
+CLUSTER_WIDTHS = 3.0
+# max_nfev がある場合、1つのクラスタにこの回数ずつ回せなければクラスタごとのフィットはせずに仕上げだけ行う
+CLUSTER_MIN_NFEV = 10
+# データ数 × 可変パラメータ数^2 (leastsq の1回の反復の計算量) がこれを超える場合は仕上げを sparse_fit.fit で行う
+SPARSE_POLISH_SIZE = 1e9
+
+
+def peak_ranges(compiled, p, widths=CLUSTER_WIDTHS):
+    """各ピーク (spec.peaks の順) の範囲 (中心 - widths × FWHM, 中心 + widths × FWHM) を2つの配列で返す
+
+    FWHM はガウシアン・ローレンチアンはそのまま、Voigt 関数は和、擬 Voigt 関数は広い方。
+    """
+    table = compiled.peak_table(p)
+    center = table[:, fit_engine.PEAK_FIELDS.index('center')]
+    # 使わない項目 (NaN) は0にするので、ガウシアン・ローレンチアンは和がそのピークの FWHM になる
+    fwhm_g = np.abs(np.nan_to_num(table[:, fit_engine.PEAK_FIELDS.index('G_FWHM')]))
+    fwhm_l = np.abs(np.nan_to_num(table[:, fit_engine.PEAK_FIELDS.index('L_FWHM')]))
+    kinds = np.array([plan[0] for plan in compiled.peak_plan], dtype=object)
+    fwhm = np.where(kinds == fit_engine.PSEUDO_VOIGT, np.maximum(fwhm_g, fwhm_l), fwhm_g + fwhm_l)
+    return center - widths * fwhm, center + widths * fwhm
+
+
+def partition(compiled, p, widths=CLUSTER_WIDTHS):
+    """範囲が重なるピークをまとめて、(ピークの位置のリスト, 範囲の下端, 上端) のリストを返す (下端の順)"""
+    lower, upper = peak_ranges(compiled, p, widths)
+    clusters = []
+    for k in np.argsort(lower, kind='stable'):
+        if clusters and lower[k] <= clusters[-1][2]:
+            positions, lo, hi = clusters[-1]
+            clusters[-1] = (positions + [int(k)], lo, max(hi, upper[k]))
+        else:
+            clusters.append(([int(k)], lower[k], upper[k]))
+    return clusters
+
+
+def local_spec(compiled, p, positions):
+    """クラスタのピーク (p の値) と局所的なバックグラウンドの ModelSpec を作る
+
+    バックグラウンドはテンプレートの値から始め、可変の項があれば定数と1次の項だけを動かす
+    (狭い範囲では高次の項は区別できない)。
+    """
+    peaks = []
+    for k in positions:
+        peak = compiled.spec.peaks[k]
+        values = tuple(None if i < 0 else float(p[i]) for i in compiled.peak_plan[k][1:])
+        peaks.append(peak._replace(values=values))
+    bg_values = tuple(float(v) for v in p[:len(fit_engine.BG_NAMES)])
+    if np.any(compiled.vary[:len(fit_engine.BG_NAMES)]):
+        bg_fixed = (False, False) + (True,) * (len(fit_engine.BG_NAMES) - 2)
+    else:
+        bg_fixed = (True,) * len(fit_engine.BG_NAMES)
+    return fit_engine.ModelSpec(bg_values, bg_fixed, tuple(peaks))
+
+
+def _fit_cluster(spec, x, y, y_err, voigt_backend, voigt_rtol, window_rtol, time_budget=None, cancel=None,
+                 max_nfev=None):
+    """1つのクラスタのフィット (ワーカープロセスで実行)。(ピークのパラメータ名と値の辞書, 関数評価の回数) を返す"""
+    compiled = fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, fit_engine.CHEBYSHEV)
+    try:
+        result = fit_engine.fit(compiled, x, y, y_err, max_nfev=max_nfev, time_budget=time_budget, cancel=cancel)
+    except ValueError:
+        return {}, 0
+    names = compiled.names[len(fit_engine.BG_NAMES):]
+    values = result.best_values[len(fit_engine.BG_NAMES):]
+    return dict(zip(names, values)), result.nfev
+
+
+def fit(spec, x, y, y_err, max_nfev=None, voigt_backend=None, voigt_rtol=None, start=None, window_rtol=None,
+        bg_basis=None, widths=CLUSTER_WIDTHS, workers=None, time_budget=None, cancel=None):
+    """クラスタごとに並列にフィットしてから全範囲で仕上げて FitResult を返す
+
+    引数は fit_engine.fit と同じ。widths はクラスタに分ける範囲 (FWHM の倍数)、workers はプロセス数
+    (省略時は CPU 数。プロセスプールのワーカーの中では1)。max_nfev はクラスタのフィットと仕上げを合わせた
+    関数評価の上限で、(クラスタ数 + 1) 等分ずつを各クラスタのフィットに、残りを仕上げに使う (CLUSTER_MIN_NFEV 回
+    ずつもなければクラスタのフィットはしない。クラスタのフィットで使い切ったら仕上げずに stopped='nfev' で返す)。
+    nfev はクラスタのフィットと仕上げの関数評価の合計。time_budget, cancel はクラスタのフィットと仕上げを
+    合わせた打ち切りの条件で、クラスタのフィットの途中で打ち切った場合は終わったクラスタの値をつないで返す。
+    """
+    compiled = spec if isinstance(spec, fit_engine.CompiledModel) else \
+        fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+    free = compiled.free
+    if start is None:
+        start = compiled.values
+    else:
+        start = compiled.full_vector(np.clip(np.asarray(start, dtype=float)[free], compiled.lower[free], compiled.upper[free]))
+    if workers is None:
+        # batch_fit などのワーカープロセスの中ではさらにプロセスを作らない
+        workers = 1 if multiprocessing.parent_process() is not None else os.cpu_count() or 1
+
+    clusters = partition(compiled, start, widths)
+    # クラスタの x の範囲は隣のクラスタとの間の中点まで (裾と局所的なバックグラウンドを決めるため、データを重複なく分ける)
+    edges = [(hi + lo) / 2 for (_, _, hi), (_, lo, _) in zip(clusters[:-1], clusters[1:])]
+    tasks = []
+    for (positions, _, _), lo, hi in zip(clusters, [-np.inf] + edges, edges + [np.inf]):
+        inside = (x >= lo) & (x < hi)
+        spec_k = local_spec(compiled, start, positions)
+        # 点が可変パラメータより少ないクラスタはフィットせずに仕上げに任せる
+        if np.count_nonzero(inside) > len(fit_engine.CompiledModel(spec_k).free):
+            tasks.append((spec_k, x[inside], y[inside], y_err[inside],
+                          compiled.voigt_backend, compiled.voigt_rtol, compiled.window_rtol))
+    # 大きいクラスタから始める (最後に大きな仕事が残らないように)
+    tasks.sort(key=lambda task: len(task[0].peaks), reverse=True)
+    # 関数評価の回数の上限はクラスタのフィットと仕上げで等分する (time_budget は残りの時間を渡す)。
+    # 1つのクラスタに数回ずつでは (MINPACK は反復の終わりで回数を確かめるので超えもして) 仕上げの分が残らない
+    cluster_nfev = None if max_nfev is None else max_nfev // (len(tasks) + 1)
+    if cluster_nfev is not None and cluster_nfev < CLUSTER_MIN_NFEV:
+        tasks = []
+
+    budget = fit_engine.FitBudget(time_budget, cancel)
+    p = start.copy()
+    nfev = 0
+    if len(clusters) > 1:
+        outputs = []
+        stopped = None
+        try:
+            if workers > 1 and len(tasks) > 1:
+                # cancel は別のプロセスに渡せないので、ここで待ちながら確かめる
+                executor = ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+                try:
+                    pending = {executor.submit(_fit_cluster, *task, budget.remaining(), max_nfev=cluster_nfev)
+                               for task in tasks}
+                    while pending:
+                        done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                        outputs += [future.result() for future in done]
+                        budget.raise_if_stopped()
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
+            else:
+                for task in tasks:
+                    outputs.append(_fit_cluster(*task, budget.remaining(), cancel, max_nfev=cluster_nfev))
+                    budget.raise_if_stopped()
+        except fit_engine.FitStopped as stop:
+            stopped = stop.reason
+        for values, n in outputs:
+            for name, value in values.items():
+                p[compiled.index[name]] = value
+            nfev += n
+        p[free] = np.clip(p[free], compiled.lower[free], compiled.upper[free])
+        p = _match_background(compiled, p, x, y, y_err)
+        if stopped is not None:
+            return fit_engine.FitResult(compiled, p, compiled.residual(p, x, y, y_err), None, nfev, False,
+                                        budget.message(stopped), start, stopped)
+
+    polish_nfev = None if max_nfev is None else max_nfev - nfev
+    if polish_nfev is not None and polish_nfev <= 0:
+        return fit_engine.FitResult(compiled, p, compiled.residual(p, x, y, y_err), None, nfev, False,
+                                    f'Fit aborted: number of function evaluations > {max_nfev}.', start, 'nfev')
+    polish = sparse_fit.fit if len(x) * len(free)**2 > SPARSE_POLISH_SIZE else fit_engine.fit
+    result = polish(compiled, x, y, y_err, max_nfev=polish_nfev, start=p, time_budget=budget.remaining(), cancel=cancel)
+    result.nfev += nfev
+    result.init_values = start
+    return result
+
+
+def _match_background(compiled, p, x, y, y_err):
+    """ピークを p に固定して、可変のバックグラウンドの項を重み付き線形最小二乗で求めた p を返す"""
+    bg_free = [k for k in range(len(fit_engine.BG_NAMES)) if compiled.vary[k]]
+    if not bg_free:
+        return p
+    p = p.copy()
+    p[bg_free] = 0.0
+    b = (y - compiled.evaluate(p, x)) / y_err
+    a = np.array([x**k for k in bg_free]).T / y_err[:, None]
+    # x^k は列の大きさがそろわないので正規化してから解く
+    norms = np.sqrt(np.einsum('ij,ij->j', a, a))
+    norms[norms == 0] = 1.0
+    coef = np.linalg.lstsq(a / norms, b, rcond=None)[0] / norms
+    if np.all(np.isfinite(coef)):
+        p[bg_free] = coef
+    return p
@@ -0,0 +1,371 @@
+"""CSV の数値の列の高速な読み込み
+
+csv.reader で全行を文字列のリストにしてから1セルずつ float() にすると、10^6 行のファイルでは数秒かかり、
+メモリも数値の数倍使う。ここではファイルをバイト列のまま CHUNK_BYTES ずつ (行の途中で切らないように) 読み、
+(空欄があれば 'nan' で埋めてから) numpy.loadtxt (C の実装) で指定した列だけを float64 にする。
+列の数が行によって違う場合や空行がある場合は、区切り (',' と改行) の位置から各セルの行と列を
+numpy で求めて、指定した列のセルだけを固定長のバイト列の配列にまとめてから一度に float64 に変換する。
+値の扱いは従来の csv.reader と float() による読み込みと同じ: 空欄と列が足りない行は NaN、空行はすべて NaN の行
+('nan', 'inf' などの表記と前後の空白はそのまま読める)、空白だけのセルや数値でないセルは ValueError。
+引用符 (") を含む部分は従来通り csv.reader で読む。
+追記されていくファイルは TailReader で前に読んだ位置から後ろだけを読める。
+"""
+import csv
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# 一度に読むバイト数
+CHUNK_BYTES = 1 << 22
+
+# header は見出しの行 (文字列のリスト)、columns は指定した列の float64 の配列のリスト、
+# n_rows はデータの行数、elapsed は読み込みにかかった時間 [s]、offset は読んだバイト数 (ファイルの先頭から)
+ColumnData = namedtuple('ColumnData', ['header', 'columns', 'n_rows', 'elapsed', 'offset'])
+# load_xye の結果 (x, y, y_error は y が NaN の行を除いたもの)。cached は data_cache から読んだかどうか
+XYEData = namedtuple('XYEData', ['header', 'x', 'y', 'y_error', 'n_rows', 'elapsed', 'cached', 'offset'],
+                     defaults=(False, None))
+
+
+
+class LoadCancelled(Exception):
+    """cancel で読み込みを打ち切った"""
+
+
+_COMMA = ord(',')
+_NEWLINE = ord('\n')
+
+
+def parse_header(line):
+    """見出しの行 (バイト列) を文字列のリストにする"""
+    line = line.decode('utf-8').rstrip('\r\n')
+    return next(csv.reader([line]), [])
+
+
+def read_header(path):
+    """見出しの行だけを読む"""
+    with open(path, 'rb') as f:
+        return parse_header(f.readline())
+
+
+def _to_float(buf, starts, ends):
+    """buf[starts[i]:ends[i]] のセルを float64 の配列にする (空欄は NaN、空白だけのセルは float() と同じ ValueError)"""
+    lengths = ends - starts
+    if len(lengths) == 0:
+        return np.empty(0)
+    # 空欄を b'nan' にするので3文字以上
+    width = max(3, int(lengths.max()))
+    offsets = np.arange(width)
+    inside = offsets < lengths[:, None]
+    chars = buf[np.minimum(starts[:, None] + offsets, len(buf) - 1)]
+    chars = np.where(inside, chars, 0).astype(np.uint8)
+    strings = np.ascontiguousarray(chars).view(f'S{width}').ravel()
+    strings[lengths == 0] = b'nan'
+    try:
+        return strings.astype(np.float64)
+    except ValueError:
+        # float() と同じ形のメッセージにする
+        for string in strings:
+            float(string.decode('utf-8', 'replace'))
+        raise
+
+
+def _parse_csv_rows(chunk, columns):
+    """引用符を含む部分を csv.reader で読む (従来の読み込みと同じ)"""
+    rows = list(csv.reader(io.StringIO(chunk.decode('utf-8'), newline='')))
+
+    def column(index):
+        return np.array([float(row[index]) if len(row) > index and row[index] != '' else np.nan
+                         for row in rows])
+
+    return np.array([column(index) for index in columns]).reshape(len(columns), len(rows))
+
+
+def _fill_blanks(chunk):
+    """空欄 (行頭・行末・区切りの間) を 'nan' で埋める"""
+    # ',,,' のように続く場合は1回目で1つおきにしか埋まらないので2回置き換える
+    chunk = chunk.replace(b',,', b',nan,').replace(b',,', b',nan,')
+    chunk = chunk.replace(b'\n,', b'\nnan,').replace(b',\n', b',nan\n')
+    return b'nan' + chunk if chunk.startswith(b',') else chunk
+
+
+def _parse_cells(chunk, columns):
+    """区切りの位置から各セルの行と列を求めて columns の列を読む (列の数が行によって違う場合や空行がある場合)"""
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    newline = buf == _NEWLINE
+    # 各セルの終わり (区切りの位置) と始まり
+    ends = np.flatnonzero(newline | (buf == _COMMA))
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    # セルの行番号と列番号
+    row_end = newline[ends]
+    n_rows = int(np.count_nonzero(row_end))
+    row = np.zeros(len(ends), dtype=np.intp)
+    row[1:] = np.cumsum(row_end[:-1])
+    first = np.flatnonzero(np.concatenate(([True], row_end[:-1])))
+    col = np.arange(len(ends)) - first[row]
+    out = np.full((len(columns), n_rows), np.nan)
+    for j, index in enumerate(columns):
+        cells = np.flatnonzero(col == index)
+        out[j, row[cells]] = _to_float(buf, starts[cells], ends[cells])
+    return out
+
+
+def parse_chunk(chunk, columns):
+    """改行で終わる CSV のデータ行 (バイト列) から columns の列を (列数 × 行数) の配列にする"""
+    if b'\r' in chunk:
+        chunk = chunk.replace(b'\r', b'')
+    if b'"' in chunk:
+        return _parse_csv_rows(chunk, columns)
+    if not chunk:
+        return np.empty((len(columns), 0))
+    # numpy.loadtxt は空行を読み飛ばすので、空行があれば (すべて NaN の行にするため) セルごとに読む
+    if chunk.startswith(b'\n') or b'\n\n' in chunk:
+        return _parse_cells(chunk, columns)
+    # 空欄がなければそのまま、あれば 'nan' で埋めてから読む (空欄を探すより失敗してからやり直す方が速い)
+    for fill in (False, True):
+        try:
+            return np.loadtxt(io.BytesIO(_fill_blanks(chunk) if fill else chunk), dtype=np.float64, delimiter=',',
+                              comments=None, usecols=columns, ndmin=2).T
+        except ValueError:
+            pass
+    # 列の数が行によって違う、など (空白だけのセルや数値でないセルはここで ValueError)
+    return _parse_cells(chunk, columns)
+
+
+def read_columns(path, columns, chunk_bytes=CHUNK_BYTES, progress=None, cancel=None):
+    """CSV (1行目は見出し) の columns (0始まりの列番号のリスト) の列を読んで ColumnData を返す
+
+    progress を指定するとチャンクを読むたびに progress(読んだバイト数, ファイルのバイト数) を呼ぶ。
+    cancel (is_set() を持つもの) がセットされるとチャンクの間で LoadCancelled を投げる。
+    """
+    t0 = time.perf_counter()
+    columns = [int(index) for index in columns]
+    if any(index < 0 for index in columns):
+        raise ValueError(f"Invalid column number: {min(columns) + 1}")
+    parts = []
+    with open(path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        first = f.readline()
+        if not first:
+            raise ValueError(f"Empty CSV file: {path}")
+        header = parse_header(first)
+        rest = b''
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            rest = block[cut:]
+            if cut:
+                parts.append(parse_chunk(block[:cut], columns))
+            if progress is not None:
+                progress(f.tell(), total)
+            if cancel is not None and cancel.is_set():
+                raise LoadCancelled(path)
+        if rest:
+            parts.append(parse_chunk(rest + b'\n', columns))
+        # 読んでいる間に追記された場合はそこまで
+        offset = f.tell()
+    data = np.concatenate(parts, axis=1) if parts else np.empty((len(columns), 0))
+    return ColumnData(header, list(data), data.shape[1], time.perf_counter() - t0, offset)
+
+
+def load_xye(path, x_col, y_col, err_col, chunk_bytes=CHUNK_BYTES, progress=None, cancel=None):
+    """x, y, y_error の列を読んで XYEData を返す (GUI の読み込みと batch_fit で共通の扱い)
+
+    y_error が 1e-10 以下の点は 1 にし、y が NaN の行は除く。progress, cancel は read_columns と同じ。
+    """
+    data = read_columns(path, (x_col, y_col, err_col), chunk_bytes, progress, cancel)
+    x_data, y_data, y_error = _xye(*data.columns)
+    return XYEData(data.header, x_data, y_data, y_error, data.n_rows, data.elapsed, False, data.offset)
+
+
+def _xye(x_data, y_data, y_error):
+    """読んだ x, y, y_error の列に load_xye の扱いをする"""
+    # y_error が 1e-10 以下の場合は 1 に置き換え
+    y_error = np.where(y_error <= 1e-10, 1, y_error)
+    # y_data が NaN の行を削除
+    valid = ~np.isnan(y_data)
+    return x_data[valid], y_data[valid], y_error[valid]
+
+
+class RowIndex:
+    """データ行の先頭のバイト位置の索引 (プレビューで任意の行だけを読むため)
+
+    ファイルの先頭から CHUNK_BYTES ずつ改行の位置を numpy で探し、必要な行まで (build では最後まで) 作る。
+    別のスレッドで build しながら rows で読めるように、索引の読み書きはロックする
+    (rows(..., wait=False) なら索引を作らずに、作り終わった範囲だけを返す)。
+    """
+
+    def __init__(self, path, chunk_bytes=CHUNK_BYTES):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            first = f.readline()
+        self.header = parse_header(first)
+        # 行の境界 (i 行目は bounds[i] から bounds[i + 1] まで)。容量を倍々に増やす配列の先頭 _n 個を使う
+        self._bounds = np.empty(1024, dtype=np.int64)
+        self._bounds[0] = len(first)
+        self._n = 1
+        self._scanned = len(first)
+        self.complete = self._scanned >= self.size
+        self._lock = threading.Lock()
+
+    @property
+    def n_rows(self):
+        """今までに索引を作った行数"""
+        return self._n - 1
+
+    def estimated_rows(self):
+        """全体の行数 (索引を作り終わっていなければ、作った部分の1行の平均のバイト数から見積もる)"""
+        with self._lock:
+            n_rows = self.n_rows
+            if self.complete or n_rows == 0:
+                return n_rows
+            row_bytes = (self._bounds[self._n - 1] - self._bounds[0]) / n_rows
+            return max(n_rows, int(round((self.size - self._bounds[0]) / row_bytes)))
+
+    def _append(self, bounds):
+        n = self._n + len(bounds)
+        if n > len(self._bounds):
+            grown = np.empty(max(n, 2 * len(self._bounds)), dtype=np.int64)
+            grown[:self._n] = self._bounds[:self._n]
+            self._bounds = grown
+        self._bounds[self._n:n] = bounds
+        self._n = n
+
+    def _scan(self, f):
+        """次のチャンクの改行を探して索引に加える"""
+        f.seek(self._scanned)
+        block = f.read(self.chunk_bytes)
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == _NEWLINE)
+        self._append(self._scanned + newlines + 1)
+        self._scanned += len(block)
+        if not block or self._scanned >= self.size:
+            # 改行で終わらない最後の行
+            if self._bounds[self._n - 1] < self._scanned:
+                self._append([self._scanned])
+            self.complete = True
+
+    def ensure(self, n_rows, progress=None, cancel=None):
+        """n_rows 行 (またはファイルの最後) まで索引を作る。progress, cancel は read_columns と同じ"""
+        if self.complete or self.n_rows >= n_rows:
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                with self._lock:
+                    if self.complete or self.n_rows >= n_rows:
+                        return
+                    self._scan(f)
+                if progress is not None:
+                    progress(self._scanned, self.size)
+                if cancel is not None and cancel.is_set():
+                    raise LoadCancelled(self.path)
+
+    def build(self, progress=None, cancel=None):
+        """ファイルの最後まで索引を作る"""
+        self.ensure(np.inf, progress, cancel)
+
+    def rows(self, start, stop, wait=True):
+        """start 行目から stop 行目の手前までを文字列のリストのリストで返す (0始まり、空行は [])
+
+        wait=False なら索引を作らずに、索引を作り終わった行だけを返す (GUI のスレッドで待たないため)。
+        """
+        if wait:
+            self.ensure(stop)
+        with self._lock:
+            stop = min(stop, self.n_rows)
+            if start >= stop:
+                return []
+            begin, end = int(self._bounds[start]), int(self._bounds[stop])
+        with open(self.path, 'rb') as f:
+            f.seek(begin)
+            text = f.read(end - begin).decode('utf-8', 'replace')
+        return [next(csv.reader([line]), []) for line in text.splitlines()][:stop - start]
+
+
+class TailReader:
+    """追記されていくファイルの新しい行だけを読んで x, y, y_error に加える (測定中のファイルを追いかける)
+
+    load_xye の結果 (x, y, y_error と offset) から始め、read のたびに前に読んだ位置からファイルの最後の改行までを
+    parse_chunk で読み、load_xye と同じ扱いをして後ろに加える (前の行は読み直さない)。x, y, y_error は
+    容量を倍々に増やす配列の先頭の部分。改行で終わっていない最後の行は書きかけかもしれないので、
+    load_xye で読んでいた場合も、改行が書かれたときに読み直して置き換える。
+    """
+
+    def __init__(self, path, columns, x, y, y_error, offset=None):
+        self.path = path
+        self.columns = [int(index) for index in columns]
+        n = len(x)
+        self._data = np.empty((3, max(1024, 2 * n)))
+        self._data[:, :n] = (x, y, y_error)
+        self._n = n
+        self.offset = os.path.getsize(path) if offset is None else int(offset)
+        # 最後の行の点の数 (改行で終わっていない行を読んでいた場合、その行を読み直すときに置き換える)
+        self._pending = 0
+        with open(path, 'rb') as f:
+            header_end = len(f.readline())
+            if self.offset > header_end:
+                f.seek(self.offset - 1)
+                if f.read(1) != b'\n':
+                    start = self._line_start(f, header_end)
+                    f.seek(start)
+                    partial = f.read(self.offset - start)
+                    self._pending = min(n, len(_xye(*parse_chunk(partial + b'\n', self.columns))[0]))
+                    self.offset = start
+
+    def _line_start(self, f, header_end):
+        """offset の手前の最後の改行の次の位置"""
+        end = self.offset
+        while end > header_end:
+            begin = max(header_end, end - CHUNK_BYTES)
+            f.seek(begin)
+            cut = f.read(end - begin).rfind(b'\n')
+            if cut >= 0:
+                return begin + cut + 1
+            end = begin
+        return header_end
+
+    @property
+    def x(self):
+        return self._data[0, :self._n]
+
+    @property
+    def y(self):
+        return self._data[1, :self._n]
+
+    @property
+    def y_error(self):
+        return self._data[2, :self._n]
+
+    def read(self):
+        """追記された行 (改行まで) を読んで加え、読んだ行数を返す (ファイルが短くなった場合は ValueError)"""
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.offset:
+                raise ValueError(f"{self.path} became shorter than the part already read")
+            f.seek(self.offset)
+            block = f.read(size - self.offset)
+        cut = block.rfind(b'\n') + 1
+        if not cut:
+            return 0
+        self.offset += cut
+        block = block[:cut]
+        x, y, y_error = _xye(*parse_chunk(block, self.columns))
+        self._n -= self._pending
+        self._pending = 0
+        n = self._n + len(x)
+        if n > self._data.shape[1]:
+            grown = np.empty((3, max(n, 2 * self._data.shape[1])))
+            grown[:, :self._n] = self._data[:, :self._n]
+            self._data = grown
+        self._data[:, self._n:n] = (x, y, y_error)
+        self._n = n
+        return block.count(b'\n')
@@ -0,0 +1,196 @@
+"""読み込んだデータ (CSV の x, y, y_error の列) のディスクキャッシュ
+
+大きな CSV を開き直すたびに文字列から読み直さないように、最初に読んだときに csv_loader.load_xye の結果
+(y が NaN の行を除いた x, y, y_error) を npy ファイル (3 × 点数の float64) に、見出しの行などを json ファイルに保存し、
+次からは npy ファイルをメモリマップして (コピーせずに) 返す。キーはファイルの絶対パス・更新時刻 (mtime)・
+サイズと列番号なので、ファイルを書き換えると読み直す。
+
+Windows ではメモリマップ中のファイルは置き換えも削除もできないので、npy ファイルは書くたびに別の名前
+(<キー>-<ランダムな文字列>.npy) にし、json ファイルにその名前を書く。どの json からも指されていない古い npy ファイルは
+evict のたびに (プロセスで最初に使うときにも) 消してみて、消せなければ次の機会に回す。
+
+fit_cache と同じく、合計サイズが上限を超えたら最後に使った時刻 (npy ファイルの mtime) の古いものから消す。
+消せなかったファイルはログに書き、合計サイズには数えない。
+ディレクトリと上限は環境変数 DATA_CACHE_DIR, DATA_CACHE_SIZE_MB で変えられる。
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import csv_loader
+
+DEFAULT_DIR = os.environ.get('DATA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'multi_peak_fitting', 'data'))
+DEFAULT_SIZE_MB = float(os.environ.get('DATA_CACHE_SIZE_MB', '2048'))
+# キーや保存する内容 (load_xye の扱い、ファイルの名前の付け方) を変えたら上げる
+KEY_VERSION = 3
+# どの json からも指されていない npy ファイルを消すまでの時間 [s] (別のプロセスが書いている途中のものは消さない)
+STALE_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+# 古い npy ファイルを消してみたディレクトリ (プロセスで最初に使うときに一度だけ)
+_cleaned = set()
+
+
+class DataCache:
+    """キーごとに x, y, y_error を npy ファイル、見出しを json ファイルとして保存するキャッシュ"""
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = DEFAULT_DIR if directory is None else directory
+        self.max_bytes = int(DEFAULT_SIZE_MB * 2**20) if max_bytes is None else int(max_bytes)
+
+    def key(self, path, columns):
+        """ファイルの絶対パス・mtime・サイズと列番号からキー (16進の文字列) を作る"""
+        stat = os.stat(path)
+        h = hashlib.sha256()
+        h.update(repr((KEY_VERSION, os.path.realpath(path), stat.st_mtime_ns, stat.st_size,
+                       tuple(int(index) for index in columns))).encode())
+        return h.hexdigest()
+
+    def _json_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _read_info(self, key):
+        """key の json ファイルの内容 (npy は npy ファイルの名前)"""
+        with open(self._json_path(key), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        if not isinstance(info, dict) or os.path.basename(str(info['npy'])) != info['npy']:
+            raise ValueError(f"Invalid data cache entry: {key}")
+        return info
+
+    def get(self, key):
+        """保存された結果を (メモリマップした) csv_loader.XYEData にして返す (なければ None)"""
+        t0 = time.perf_counter()
+        try:
+            info = self._read_info(key)
+            npy_path = os.path.join(self.directory, info['npy'])
+            # asarray はコピーせずに ndarray として参照する (読み取り専用)
+            data = np.asarray(np.load(npy_path, mmap_mode='r', allow_pickle=False))
+            # 最後に使った時刻を更新する (LRU)
+            os.utime(npy_path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if data.ndim != 2 or data.shape[0] != 3:
+            return None
+        return csv_loader.XYEData(info['header'], data[0], data[1], data[2], info['n_rows'],
+                                  time.perf_counter() - t0, True, info['offset'])
+
+    def put(self, key, data):
+        """load_xye の結果を保存し、上限を超えた分と古い npy ファイルを消す"""
+        os.makedirs(self.directory, exist_ok=True)
+        # npy は新しい名前のファイルに書き (メモリマップ中の前のファイルには触れない)、書き終えてから json で指す
+        fd, npy_path = tempfile.mkstemp(prefix=key + '-', suffix='.npy', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.vstack([data.x, data.y, data.y_error]))
+            info = json.dumps({'header': list(data.header), 'n_rows': int(data.n_rows), 'offset': data.offset,
+                               'npy': os.path.basename(npy_path)}).encode()
+            self._write(self._json_path(key), lambda f: f.write(info))
+        except OSError:
+            self._remove(npy_path)
+            raise
+        self.evict()
+
+    def _write(self, path, write):
+        """別のプロセスが読みかけのファイルを壊さないように、一時ファイルに write(f) で書いてから置き換える"""
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            self._remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _remove(path):
+        """path を消して、消せたか (もうなければ True) を返す"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # 別のプロセスが先に消した
+            return True
+        except OSError as e:
+            # Windows ではメモリマップ中のファイルは消せない (次の evict でもう一度消してみる)
+            logger.warning("Could not remove data cache file %s: %s", path, e)
+            return False
+        return True
+
+    def evict(self):
+        """どの json からも指されていない npy ファイルを消し、合計サイズが max_bytes 以下になるまで
+        最後に使った時刻の古いものから消す (消せなかった npy ファイルは合計サイズに数えない)"""
+        _cleaned.add(self.directory)
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        # キーごとに json が指している npy ファイル
+        current = {}
+        for name in names:
+            if name.endswith('.json'):
+                key = name[:-len('.json')]
+                try:
+                    current[self._read_info(key)['npy']] = key
+                except OSError:
+                    continue
+                except (ValueError, KeyError, TypeError):
+                    # 前の版の json など (json は置き換えで書くので、書きかけのものはない)
+                    self._remove(os.path.join(self.directory, name))
+        entries = []
+        now = time.time()
+        for name in names:
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name in current:
+                entries.append((stat.st_mtime, stat.st_size, name))
+            elif now - stat.st_mtime > STALE_SECONDS or self.max_bytes < 0:
+                self._remove(path)
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # 先に json を消して、その後に npy を消す (npy を消せなければ古い npy として次の機会に消す)
+            if self._remove(self._json_path(current[name])):
+                self._remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self):
+        """キャッシュをすべて消す"""
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        self.evict()
+        self.max_bytes = max_bytes
+
+
+def cached_load_xye(path, x_col, y_col, err_col, cache=None, progress=None, cancel=None):
+    """キャッシュにあればメモリマップした結果を、なければ csv_loader.load_xye の結果を保存して返す
+
+    返す XYEData の cached はキャッシュから取ったかどうか。キャッシュの読み書きに失敗しても読み込みは行う。
+    progress, cancel は csv_loader.read_columns に渡す (キャッシュから取る場合は使わない)。
+    """
+    cache = DataCache() if cache is None else cache
+    # 前に消せなかった古い npy ファイルを、プロセスで最初に使うときに消してみる
+    if cache.directory not in _cleaned:
+        cache.evict()
+    try:
+        key = cache.key(path, (x_col, y_col, err_col))
+    except OSError:
+        key = None
+    data = None if key is None else cache.get(key)
+    if data is not None:
+        return data
+    data = csv_loader.load_xye(path, x_col, y_col, err_col, progress=progress, cancel=cancel)
+    if key is not None:
+        try:
+            cache.put(key, data)
+        except OSError:
+            pass
+    return data
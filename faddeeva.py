@@ -0,0 +1,178 @@
+"""Voigt 関数用の Faddeeva 関数 w(z) (Im z >= 0)
+
+backend は以下から選ぶ。
+    'wofz'     : scipy.special.wofz (厳密)
+    'rational' : Weideman の有理近似 + 遠方は Laplace の連分数 (Humlíček と同様の領域分割)。
+                 rtol (|Δw|/|w| の許容値) から項数を決める
+    'table'    : テイラー係数の表から補間する (|Δw|/|w| ≲ 1e-9)。表は最初に使うときにプロセスごとに一度作る
+
+配置先ごとに環境変数 VOIGT_BACKEND, VOIGT_RTOL で既定値を変えられる。
+精度と速度の比較は voigt_report.py で確認する。
+"""
+import os
+
+import numpy as np
+from scipy.special import wofz
+
+BACKENDS = ('wofz', 'rational', 'table')
+DEFAULT_BACKEND = os.environ.get('VOIGT_BACKEND', 'wofz')
+DEFAULT_RTOL = float(os.environ.get('VOIGT_RTOL', '1e-6'))
+
+INV_SQRTPI = 1 / np.sqrt(np.pi)
+
+# |x| + y がこの値以上の点は連分数で計算する
+FAR_FIELD = 8.0
+# (許容誤差, 項数) : |x| + y >= FAR_FIELD での連分数の誤差 (wofz との比較で測定)
+CONTINUED_FRACTION_TERMS = ((5e-4, 1), (2.5e-5, 2), (1.5e-6, 3), (1.2e-7, 4), (1.2e-9, 6), (2e-11, 8), (0, 12))
+# (許容誤差, N) : Weideman の近似の誤差 (上半面全体での最大値)
+WEIDEMAN_TERMS = ((3.1e-4, 8), (1.3e-5, 12), (4.4e-7, 16), (1.5e-8, 20), (4.3e-10, 24), (3.2e-13, 32), (0, 40))
+
+# テイラー係数の表 : 刻み幅, 次数, 範囲 (0 <= x, y <= TABLE_RANGE)
+TABLE_STEP = 0.2
+TABLE_ORDER = 8
+TABLE_RANGE = 16.0
+TABLE_RTOL = 1e-9
+# 表の外 (|x| + y > TABLE_RANGE) の連分数の項数 (誤差 2e-10)
+TABLE_FAR_TERMS = 4
+
+
+def _terms_for(rtol, table):
+    """許容誤差を満たす最小の項数を返す"""
+    for error, terms in table:
+        if error <= rtol:
+            return terms
+    return table[-1][1]
+
+
+def continued_fraction(z, terms):
+    """Laplace の連分数 w = i/sqrt(pi) / (z - 1/2 / (z - 1 / (z - 3/2 / ...))) (|z| が大きい領域用)"""
+    r = np.zeros_like(z)
+    for n in range(terms, 0, -1):
+        r = (n / 2) / (z - r)
+    return 1j * INV_SQRTPI / (z - r)
+
+
+def weideman_coefficients(n):
+    """Weideman (1994) の有理近似の係数"""
+    m = 2 * n
+    k = np.arange(-m + 1, m)
+    length = np.sqrt(n / np.sqrt(2))
+    t = length * np.tan(k * np.pi / m / 2)
+    f = np.concatenate([[0.0], np.exp(-t**2) * (length**2 + t**2)])
+    a = np.real(np.fft.fft(np.fft.fftshift(f))) / (2 * m)
+    return length, a[1:n + 1][::-1]
+
+
+def weideman(z, coefficients):
+    """Weideman の有理近似 w(z) = 2 p(Z) / (L - iz)^2 + 1/sqrt(pi) / (L - iz)"""
+    length, a = coefficients
+    denom = length - 1j * z
+    big_z = (length + 1j * z) / denom
+    p = np.full(z.shape, a[0], dtype=complex)
+    for c in a[1:]:
+        p *= big_z
+        p += c
+    p *= 2 / denom
+    p += INV_SQRTPI
+    p /= denom
+    return p
+
+
+class RationalFaddeeva:
+    """有理近似による w(z)。遠方 (|x| + y >= FAR_FIELD) は連分数、近傍は Weideman の近似"""
+
+    def __init__(self, rtol=DEFAULT_RTOL):
+        self.rtol = rtol
+        self.far_terms = _terms_for(rtol, CONTINUED_FRACTION_TERMS)
+        self.coefficients = weideman_coefficients(_terms_for(rtol, WEIDEMAN_TERMS))
+
+    def __call__(self, z, out=None):
+        out = np.empty(z.shape, dtype=complex) if out is None else out
+        far = np.abs(z.real) + z.imag >= FAR_FIELD
+        if np.all(far):
+            out[...] = continued_fraction(z, self.far_terms)
+            return out
+        near = ~far
+        z_near = z[near]
+        out[far] = continued_fraction(z[far], self.far_terms)
+        out[near] = weideman(z_near, self.coefficients)
+        return out
+
+
+class TableFaddeeva:
+    """テイラー係数の表による w(z)
+
+    格子点 z0 での w の n 階微分を漸化式 w^(n+1) = -2 z w^(n) - 2n w^(n-1) で求めて
+    おき、最も近い格子点からの多項式で補間する。表の外は連分数で計算する。
+    """
+
+    def __init__(self, step=TABLE_STEP, order=TABLE_ORDER, limit=TABLE_RANGE):
+        self.step = step
+        self.rtol = TABLE_RTOL
+        self.far_terms = TABLE_FAR_TERMS
+        nodes = np.arange(0, limit + step / 2, step)
+        self.size = len(nodes)
+        z0 = (nodes[None, :] + 1j * nodes[:, None]).ravel()
+        coef = np.empty((order + 1, len(z0)), dtype=complex)
+        coef[0] = wofz(z0)
+        coef[1] = -2 * z0 * coef[0] + 2j * INV_SQRTPI
+        for n in range(1, order):
+            coef[n + 1] = -2 * z0 * coef[n] - 2 * n * coef[n - 1]
+        factorial = 1.0
+        for n in range(2, order + 1):
+            factorial *= n
+            coef[n] /= factorial
+        # 格子点ごとに係数を並べる (高次から)
+        self.coef = np.ascontiguousarray(coef[::-1].T)
+
+    def __call__(self, z, out=None):
+        z_flat = z.ravel()
+        x = np.abs(z_flat.real)
+        y = z_flat.imag
+        ix = np.rint(x / self.step).astype(np.intp)
+        iy = np.rint(y / self.step).astype(np.intp)
+        inside = (ix < self.size) & (iy < self.size)
+        w = np.empty(z_flat.shape, dtype=complex)
+        far = ~inside
+        if np.any(far):
+            w[far] = continued_fraction(x[far] + 1j * y[far], self.far_terms)
+        ix, iy = ix[inside], iy[inside]
+        d = (x[inside] - ix * self.step) + 1j * (y[inside] - iy * self.step)
+        coef = self.coef[iy * self.size + ix]
+        acc = coef[:, 0].copy()
+        for n in range(1, coef.shape[1]):
+            acc *= d
+            acc += coef[:, n]
+        w[inside] = acc
+        # w(-x + iy) = conj(w(x + iy))
+        negative = z_flat.real < 0
+        w[negative] = np.conj(w[negative])
+        if out is None:
+            return w.reshape(z.shape)
+        out[...] = w.reshape(z.shape)
+        return out
+
+
+def exact(z, out=None):
+    """scipy.special.wofz による厳密な w(z)"""
+    return wofz(z, out=out)
+
+
+_cache = {}
+
+
+def get_backend(name=None, rtol=None):
+    """backend の名前と許容誤差から w(z) を計算する関数を返す"""
+    name = DEFAULT_BACKEND if name is None else name
+    rtol = DEFAULT_RTOL if rtol is None else rtol
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown Voigt backend: {name} (choose from {', '.join(BACKENDS)})")
+    key = (name, rtol if name == 'rational' else None)
+    if key not in _cache:
+        if name == 'wofz':
+            _cache[key] = exact
+        elif name == 'rational':
+            _cache[key] = RationalFaddeeva(rtol)
+        else:
+            _cache[key] = TableFaddeeva()
+    return _cache[key]
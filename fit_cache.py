@@ -0,0 +1,160 @@
+"""フィット結果のディスクキャッシュ
+
+同じデータ (フィット範囲で切り出した x, y, y_error) を同じテンプレート (値・固定・下限) と
+同じ設定でフィットした結果は同じなので、それらのハッシュ (SHA-256) をキーにして結果を保存しておき、
+次からはフィットせずに返す。GUI を開き直した後や、途中で止まったバッチ処理のやり直しで使う。
+
+結果はキーごとに1つの npz ファイルとしてキャッシュのディレクトリに保存する (プロセス間で共有できる)。
+合計サイズが上限を超えたら、最後に使った時刻 (ファイルの mtime) の古いものから消す。
+ディレクトリと上限は環境変数 FIT_CACHE_DIR, FIT_CACHE_SIZE_MB で変えられる。
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+import faddeeva
+import fit_engine
+import solvers
+
+DEFAULT_DIR = os.environ.get('FIT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'multi_peak_fitting', 'fits'))
+DEFAULT_SIZE_MB = float(os.environ.get('FIT_CACHE_SIZE_MB', '64'))
+# キーの形式を変えたら上げる (古いキャッシュを使わないように)
+KEY_VERSION = 3
+
+
+class FitCache:
+    """キーごとに FitResult を npz ファイルとして保存するキャッシュ"""
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = DEFAULT_DIR if directory is None else directory
+        self.max_bytes = int(DEFAULT_SIZE_MB * 2**20) if max_bytes is None else int(max_bytes)
+
+    def key(self, compiled, x, y, y_err, **settings):
+        """データ・テンプレート・モデルの計算方法・設定からキー (16進の文字列) を作る"""
+        h = hashlib.sha256()
+        h.update(f"v{KEY_VERSION}".encode())
+        for array in (x, y, y_err):
+            array = np.ascontiguousarray(array, dtype=np.float64)
+            h.update(str(len(array)).encode())
+            h.update(array.tobytes())
+        h.update(repr(compiled.names).encode())
+        for array in (compiled.values, compiled.lower, compiled.upper, compiled.vary):
+            h.update(np.ascontiguousarray(array).tobytes())
+        # 既定値を埋めてから入れる (省略した場合と既定値を指定した場合を同じキーにする)
+        backend = faddeeva.DEFAULT_BACKEND if compiled.voigt_backend is None else compiled.voigt_backend
+        rtol = faddeeva.DEFAULT_RTOL if compiled.voigt_rtol is None else compiled.voigt_rtol
+        h.update(repr((backend, rtol if backend == 'rational' else None, compiled.window_rtol,
+                       compiled.bg_basis)).encode())
+        for name in sorted(settings):
+            value = settings[name]
+            # None は指定しなかった場合と同じ
+            if value is None:
+                continue
+            if isinstance(value, np.ndarray):
+                value = (value.dtype.str, value.shape, value.tobytes())
+            h.update(repr((name, value)).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key, compiled):
+        """保存された結果を FitResult にして返す (なければ None)"""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                stored = {name: data[name] for name in data.files}
+            # 最後に使った時刻を更新する (LRU)
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        if len(stored['best']) != len(compiled.names):
+            return None
+        covar = stored['covar'] if stored['has_covar'] else None
+        # stopped のない古いファイルは打ち切っていない扱い
+        stopped = str(stored['stopped']) if 'stopped' in stored and str(stored['stopped']) else None
+        return fit_engine.FitResult(compiled, stored['best'], stored['residual'], covar, int(stored['nfev']),
+                                    bool(stored['success']), str(stored['message']), stored['start'], stopped)
+
+    def put(self, key, result):
+        """結果を保存し、上限を超えた分を消す"""
+        os.makedirs(self.directory, exist_ok=True)
+        covar = result.covar if result.covar is not None else np.empty((0, 0))
+        # 別のプロセスが読みかけのファイルを壊さないように、一時ファイルに書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, best=result.best_values, residual=result.residual, covar=covar,
+                         has_covar=result.covar is not None, nfev=result.nfev, success=result.success,
+                         message=result.message, start=np.asarray(result.init_values, dtype=float),
+                         stopped=result.stopped or '')
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """合計サイズが max_bytes 以下になるまで最後に使った時刻の古いものから消す"""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # 別のプロセスが先に消した
+                pass
+            total -= size
+
+    def clear(self):
+        """キャッシュをすべて消す"""
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        self.evict()
+        self.max_bytes = max_bytes
+
+
+def cached_fit(spec, x, y, y_err, cache=None, **kwargs):
+    """キャッシュにあれば保存された結果を、なければ solvers.fit の結果を保存して返す。(FitResult, キャッシュから取ったか) を返す
+
+    voigt_backend, voigt_rtol, window_rtol, bg_basis は CompiledModel を作るのに使い (spec が CompiledModel の場合は
+    そちらの設定)、time_budget, cancel は solvers.fit にだけ渡し、それ以外の kwargs (solver を含む) は
+    solvers.fit にそのまま渡してキーにも入れる。時間の上限や cancel で打ち切った結果は保存しない。
+    キャッシュの読み書きに失敗してもフィットは行う。
+    """
+    cache = FitCache() if cache is None else cache
+    kwargs.setdefault('solver', solvers.DEFAULT_SOLVER)
+    model_settings = [kwargs.pop(name, None) for name in ('voigt_backend', 'voigt_rtol', 'window_rtol', 'bg_basis')]
+    limits = {name: kwargs.pop(name, None) for name in ('time_budget', 'cancel')}
+    compiled = spec if isinstance(spec, fit_engine.CompiledModel) else fit_engine.CompiledModel(spec, *model_settings)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+    key = cache.key(compiled, x, y, y_err, **kwargs)
+    result = cache.get(key, compiled)
+    if result is not None:
+        return result, True
+    result = solvers.fit(compiled, x, y, y_err, **kwargs, **limits)
+    if result.stopped in ('time', 'cancelled'):
+        return result, False
+    try:
+        cache.put(key, result)
+    except OSError:
+        pass
+    return result, False
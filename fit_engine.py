@@ -0,0 +1,1103 @@
+"""Tk に依存しないフィッティングエンジン
+
+Multi_Peak_Fitting.py の GUI、スクリプト、ワーカープロセスから共通に使う。
+モデル記述 (ModelSpec) を一度だけ平坦なパラメータベクトル上のインデックス表
+(CompiledModel) に変換しておき、残差計算の中では Tk 変数や文字列キーを参照しない。
+"""
+import time
+from collections import namedtuple
+
+import numpy as np
+from lmfit import Parameters
+from scipy.optimize import leastsq
+
+import faddeeva
+
+# バックグラウンド (定数, 1次, 2次, 3次, 4次) のパラメータ名
+BG_NAMES = ('bg_a', 'bg_b', 'bg_c', 'bg_d', 'bg_e')
+# フィットの中でバックグラウンドを表す基底 (パラメータ bg_a..bg_e はどちらでも x のべきの係数)
+MONOMIAL = 'monomial'
+CHEBYSHEV = 'chebyshev'
+BG_BASES = (MONOMIAL, CHEBYSHEV)
+# ピーク関数のパラメータ名 (GUIの列の順番)
+PEAK_FIELDS = ('ratio', 'area', 'center', 'G_FWHM', 'L_FWHM')
+
+# ピーク関数の種類 (ratio = 1f, 0f, -1f, それ以外)
+GAUSSIAN = 'gaussian'
+LORENTZIAN = 'lorentzian'
+VOIGT = 'voigt'
+PSEUDO_VOIGT = 'pseudo_voigt'
+
+# 種類ごとに使うパラメータ (lmfit の Parameters に登録していた順番)
+KIND_FIELDS = {
+    GAUSSIAN: ('ratio', 'center', 'area', 'G_FWHM'),
+    LORENTZIAN: ('ratio', 'center', 'area', 'L_FWHM'),
+    VOIGT: ('ratio', 'center', 'area', 'G_FWHM', 'L_FWHM'),
+    PSEUDO_VOIGT: ('ratio', 'center', 'area', 'G_FWHM', 'L_FWHM'),
+}
+
+# 最小値を0にするパラメータ
+NON_NEGATIVE_FIELDS = ('area', 'G_FWHM', 'L_FWHM')
+
+# number はチェックボックスの番号 (1始まり)。values, fixed は PEAK_FIELDS の順で、使わない項目は None
+PeakSpec = namedtuple('PeakSpec', ['number', 'kind', 'values', 'fixed'])
+ModelSpec = namedtuple('ModelSpec', ['bg_values', 'bg_fixed', 'peaks'])
+
+
+def parse_param(text):
+    """パラメータの 'f' を処理する関数 ('1.0f' なら固定値)"""
+    text = str(text).strip()
+    if text.endswith("f"):
+        return float(text[:-1]), True  # 固定値として設定
+    return float(text), False  # 固定しない値として設定
+
+
+def peak_kind(ratio, ratio_fixed):
+    """ratio の値と固定の有無からピーク関数の種類を決める"""
+    if ratio_fixed:
+        if ratio == 1:  # ガウシアンのみ
+            return GAUSSIAN
+        if ratio == 0:  # ローレンチアンのみ
+            return LORENTZIAN
+        if ratio == -1:  # voigt関数
+            return VOIGT
+    # ratio が可変、または上記以外の固定値の場合は擬フォークト関数
+    return PSEUDO_VOIGT
+
+
+def spec_from_entries(bg_texts, peak_texts):
+    """エントリーボックスの文字列から ModelSpec を作成する
+
+    bg_texts : バックグラウンド5項の文字列
+    peak_texts : (ピーク番号, [ratio, area, center, G_FWHM, L_FWHM] の文字列) のリスト
+    """
+    bg = [parse_param(text) for text in bg_texts]
+    peaks = []
+    for number, texts in peak_texts:
+        ratio_value, ratio_fixed = parse_param(texts[0])
+        kind = peak_kind(ratio_value, ratio_fixed)
+        values = [None] * len(PEAK_FIELDS)
+        fixed = [None] * len(PEAK_FIELDS)
+        for j, field in enumerate(PEAK_FIELDS):
+            if field in KIND_FIELDS[kind]:
+                values[j], fixed[j] = parse_param(texts[j])
+        peaks.append(PeakSpec(number, kind, tuple(values), tuple(fixed)))
+    return ModelSpec(tuple(v for v, _ in bg), tuple(f for _, f in bg), tuple(peaks))
+
+
+def peak_param_dict(spec):
+    """{'ratio_1': (値, 固定), ...} の形式に変換する (結果表示用)"""
+    peak_params = {}
+    for peak in spec.peaks:
+        for field in KIND_FIELDS[peak.kind]:
+            j = PEAK_FIELDS.index(field)
+            peak_params[f'{field}_{peak.number}'] = (peak.values[j], peak.fixed[j])
+    return peak_params
+
+
+# よく使う定数 (残差計算のたびに計算しない)
+GAUSS_A = 4 * np.log(2)                          # exp(-4 ln2 ((x-c)/FWHM)^2)
+GAUSS_NORM = (GAUSS_A / np.pi)**0.5              # 1 / (pi / (4 ln2))^0.5
+LORENTZ_NORM = 2 / np.pi
+SIGMA_PER_FWHM = 1 / (2 * np.sqrt(2 * np.log(2)))  # ガウシアンの標準偏差 / FWHM
+SQRT2 = np.sqrt(2)
+SQRT2PI = np.sqrt(2 * np.pi)
+SQRTPI = np.sqrt(np.pi)
+
+# 2次元バッファ (ピーク数 × x) の最大要素数。長いデータは x 方向に分割して計算する
+BUFFER_SIZE = 1 << 18
+# 計算範囲を限る場合 (window_rtol) の既定の許容値 : ピークの高さに対してこの割合より小さい裾は計算しない
+WINDOW_RTOL = 1e-4
+# G_FWHM / L_FWHM (または L_FWHM / G_FWHM) がこの値以下の Voigt 関数は
+# ローレンチアン (またはガウシアン) の閉じた式で計算する
+VOIGT_LIMIT = 1e-8
+# 範囲外のローレンチアンの裾の遠方を計算する格子の点数 (x の範囲を等分する。データ数より多くはしない)、
+# 中心から格子の間隔のこの倍数までは格子を使わずに x で直接計算する
+TAIL_GRID_MAX = 1024
+TAIL_NEAR_SPACINGS = 8
+
+
+def gaussian(x, center, area, fwhm):
+    """面積で規格化したガウシアン"""
+    return area * GAUSS_NORM / fwhm * np.exp(-GAUSS_A * ((x - center) / fwhm)**2)
+
+
+def lorentzian(x, center, area, fwhm):
+    """面積で規格化したローレンチアン"""
+    return area * LORENTZ_NORM * fwhm / (4 * (x - center)**2 + fwhm**2)
+
+
+def voigt_limits(fwhm_g, fwhm_l):
+    """Voigt 関数がローレンチアン (G_FWHM→0)、ガウシアン (L_FWHM→0) とみなせるかを返す"""
+    lorentz_limit = fwhm_g <= VOIGT_LIMIT * fwhm_l
+    gauss_limit = ~lorentz_limit & (fwhm_l <= VOIGT_LIMIT * fwhm_g)
+    return lorentz_limit, gauss_limit
+
+
+def voigt(x, center, area, fwhm_g, fwhm_l, faddeeva_func=faddeeva.exact):
+    """FWHM から計算する Voigt 関数 (faddeeva_func は faddeeva.get_backend で選ぶ)"""
+    lorentz_limit, gauss_limit = voigt_limits(fwhm_g, fwhm_l)
+    sigma = np.where(lorentz_limit, 1.0, fwhm_g) * SIGMA_PER_FWHM  # ガウシアンの標準偏差
+    gamma = fwhm_l / 2                                            # ローレンチアンの半値半幅
+    z = np.asarray(((x - center) + 1j * gamma) / (sigma * SQRT2))
+    value = area * faddeeva_func(z).real / (sigma * SQRT2PI)
+    # 極限では閉じた式に切り替える (G_FWHM = 0 で NaN にならないように)
+    with np.errstate(divide='ignore', invalid='ignore'):  # 使わない側の 0 除算は無視する
+        if np.any(lorentz_limit):
+            value = np.where(lorentz_limit, lorentzian(x, center, area, fwhm_l), value)
+        if np.any(gauss_limit):
+            value = np.where(gauss_limit, gaussian(x, center, area, fwhm_g), value)
+    return value
+
+
+def pseudo_voigt(x, ratio, center, area, fwhm_g, fwhm_l):
+    """擬フォークト関数 (ratio はガウシアンの割合)"""
+    return ratio * gaussian(x, center, area, fwhm_g) + (1 - ratio) * lorentzian(x, center, area, fwhm_l)
+
+
+# 以下はピーク関数の解析的な偏微分。 (d/d面積, d/d中心, d/dFWHM) の順に返す
+def gaussian_derivs(x, center, area, fwhm):
+    """ガウシアンの偏微分"""
+    u = (x - center) / fwhm
+    shape = GAUSS_NORM / fwhm * np.exp(-GAUSS_A * u**2)  # 面積1の形状
+    value = area * shape
+    return shape, value * 2 * GAUSS_A * u / fwhm, value * (2 * GAUSS_A * u**2 - 1) / fwhm
+
+
+def lorentzian_derivs(x, center, area, fwhm):
+    """ローレンチアンの偏微分"""
+    d = x - center
+    denom = 4 * d**2 + fwhm**2
+    shape = LORENTZ_NORM * fwhm / denom
+    return shape, area * LORENTZ_NORM * fwhm * 8 * d / denom**2, area * LORENTZ_NORM * (4 * d**2 - fwhm**2) / denom**2
+
+
+def voigt_derivs(x, center, area, fwhm_g, fwhm_l, faddeeva_func=faddeeva.exact):
+    """Voigt 関数の偏微分 (d/d面積, d/d中心, d/dG_FWHM, d/dL_FWHM)
+
+    Faddeeva 関数の微分 w'(z) = -2 z w(z) + 2i/sqrt(pi) を使う。
+    """
+    lorentz_limit, _ = voigt_limits(fwhm_g, fwhm_l)
+    sigma = np.where(lorentz_limit, 1.0, fwhm_g) * SIGMA_PER_FWHM
+    s = sigma * SQRT2
+    z = np.asarray(((x - center) + 0.5j * fwhm_l) / s)
+    w = faddeeva_func(z)
+    dw = -2 * z * w + 2j / SQRTPI
+    norm = 1 / (sigma * SQRT2PI)
+    shape = w.real * norm
+    d_center = -area * norm * dw.real / s
+    d_sigma = -area * norm * ((dw * z).real + w.real) / sigma
+    d_gamma = -area * norm * dw.imag / s  # Re(i w') = -Im(w')
+    derivs = shape, d_center, d_sigma * SIGMA_PER_FWHM, 0.5 * d_gamma
+    if np.any(lorentz_limit):
+        # G_FWHM→0 ではローレンチアンの偏微分 (G_FWHM については 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            l_area, l_center, l_fwhm = lorentzian_derivs(x, center, area, fwhm_l)
+        derivs = (np.where(lorentz_limit, l_area, shape), np.where(lorentz_limit, l_center, d_center),
+                  np.where(lorentz_limit, 0.0, derivs[2]), np.where(lorentz_limit, l_fwhm, derivs[3]))
+    return derivs
+
+
+class PeakGroup:
+    """同じ種類のピークをまとめて (ピーク数 × x) の2次元配列で計算する
+
+    作業用のバッファは一度確保したら反復の間ずっと使い回す。
+    """
+
+    def __init__(self, kind, positions, plans, faddeeva_func=faddeeva.exact):
+        self.kind = kind
+        self.faddeeva = faddeeva_func
+        self.positions = np.array(positions, dtype=int)  # spec.peaks の中での位置
+        columns = np.array([plan[1:] for plan in plans], dtype=int).reshape(len(plans), len(PEAK_FIELDS))
+        self.i_ratio, self.i_area, self.i_center, self.i_g, self.i_l = columns.T
+        self.size = len(plans)
+        self._buffers = None
+
+    def buffers(self, n):
+        """(ピーク数 × n) の作業用バッファを返す (足りない場合のみ確保し直す)"""
+        if self._buffers is None or self._buffers[0] < n:
+            if self.kind == VOIGT:
+                self._buffers = (n, None, None, np.empty((self.size, n), dtype=complex))
+            else:
+                self._buffers = (n, np.empty((self.size, n)), np.empty((self.size, n)), None)
+        return tuple(None if buffer is None else buffer[:, :n] for buffer in self._buffers[1:])
+
+    def add_to(self, p, x, model):
+        """グループ内の全ピークを model に加算する"""
+        if self.kind == VOIGT:
+            self.add_voigt_to(p, x, model)
+            return
+        center = p[self.i_center][:, None]
+        area = p[self.i_area]
+        block = max(1, min(len(x), BUFFER_SIZE // self.size))
+        for start in range(0, len(x), block):
+            xs = x[start:start + block]
+            d, t, z = self.buffers(len(xs))
+            np.subtract(xs, center, out=d)
+            np.square(d, out=d)  # (x-c)^2 はガウシアンとローレンチアンで共通
+            if self.kind != LORENTZIAN:
+                # ガウシアン成分 exp(-4 ln2 (x-c)^2 / G^2)
+                fwhm_g = p[self.i_g]
+                coef = area * GAUSS_NORM / fwhm_g
+                if self.kind == PSEUDO_VOIGT:
+                    coef = coef * p[self.i_ratio]
+                np.multiply(d, (-GAUSS_A / fwhm_g**2)[:, None], out=t)
+                np.exp(t, out=t)
+                model[start:start + len(xs)] += coef @ t
+            if self.kind != GAUSSIAN:
+                # ローレンチアン成分 1 / (4 (x-c)^2 + L^2) = 1/4 / ((x-c)^2 + L^2/4)
+                fwhm_l = p[self.i_l]
+                coef = area * LORENTZ_NORM * fwhm_l / 4
+                if self.kind == PSEUDO_VOIGT:
+                    coef = coef * (1 - p[self.i_ratio])
+                np.add(d, (fwhm_l**2 / 4)[:, None], out=t)
+                np.reciprocal(t, out=t)
+                model[start:start + len(xs)] += coef @ t
+
+    def add_voigt_to(self, p, x, model):
+        """Voigt 関数のグループを model に加算する"""
+        center = p[self.i_center]
+        area = p[self.i_area]
+        fwhm_g = p[self.i_g]
+        fwhm_l = p[self.i_l]
+        lorentz_limit, gauss_limit = voigt_limits(fwhm_g, fwhm_l)
+        regular = ~(lorentz_limit | gauss_limit)
+        if not np.all(regular):
+            # 極限のピークは閉じた式で計算する
+            model += lorentzian(x[None, :], center[lorentz_limit][:, None], area[lorentz_limit][:, None],
+                                fwhm_l[lorentz_limit][:, None]).sum(axis=0)
+            model += gaussian(x[None, :], center[gauss_limit][:, None], area[gauss_limit][:, None],
+                              fwhm_g[gauss_limit][:, None]).sum(axis=0)
+            center, area, fwhm_g, fwhm_l = center[regular], area[regular], fwhm_g[regular], fwhm_l[regular]
+        count = len(center)
+        if count == 0:
+            return
+        sigma = fwhm_g * SIGMA_PER_FWHM
+        s = (sigma * SQRT2)[:, None]
+        coef = area / (sigma * SQRT2PI)
+        block = max(1, min(len(x), BUFFER_SIZE // self.size))
+        for start in range(0, len(x), block):
+            xs = x[start:start + block]
+            z = self.buffers(len(xs))[2][:count]
+            np.subtract(xs, center[:, None], out=z.real)
+            np.divide(z.real, s, out=z.real)
+            np.divide(0.5 * fwhm_l[:, None], s, out=z.imag)
+            self.faddeeva(z, out=z)
+            model[start:start + len(xs)] += coef @ z.real
+
+    def curves(self, p, x):
+        """グループ内の各ピークを (ピーク数 × x) の配列で返す"""
+        x = x[None, :]
+        center = p[self.i_center][:, None]
+        area = p[self.i_area][:, None]
+        if self.kind == GAUSSIAN:
+            return gaussian(x, center, area, p[self.i_g][:, None])
+        if self.kind == LORENTZIAN:
+            return lorentzian(x, center, area, p[self.i_l][:, None])
+        if self.kind == VOIGT:
+            return voigt(x, center, area, p[self.i_g][:, None], p[self.i_l][:, None], self.faddeeva)
+        return pseudo_voigt(x, p[self.i_ratio][:, None], center, area, p[self.i_g][:, None], p[self.i_l][:, None])
+
+    def jacobian_into(self, p, x, jac):
+        """グループ内の各ピークの偏微分を jac の対応する行に書き込む"""
+        x = x[None, :]
+        center = p[self.i_center][:, None]
+        area = p[self.i_area][:, None]
+        if self.kind == GAUSSIAN:
+            jac[self.i_area], jac[self.i_center], jac[self.i_g] = gaussian_derivs(x, center, area, p[self.i_g][:, None])
+        elif self.kind == LORENTZIAN:
+            jac[self.i_area], jac[self.i_center], jac[self.i_l] = lorentzian_derivs(x, center, area, p[self.i_l][:, None])
+        elif self.kind == VOIGT:
+            jac[self.i_area], jac[self.i_center], jac[self.i_g], jac[self.i_l] = voigt_derivs(
+                x, center, area, p[self.i_g][:, None], p[self.i_l][:, None], self.faddeeva)
+        else:
+            # 擬フォークト関数 : ratio * G + (1 - ratio) * L
+            ratio = p[self.i_ratio][:, None]
+            g_area, g_center, g_fwhm = gaussian_derivs(x, center, area, p[self.i_g][:, None])
+            l_area, l_center, l_fwhm = lorentzian_derivs(x, center, area, p[self.i_l][:, None])
+            jac[self.i_ratio] = area * (g_area - l_area)
+            jac[self.i_area] = ratio * g_area + (1 - ratio) * l_area
+            jac[self.i_center] = ratio * g_center + (1 - ratio) * l_center
+            jac[self.i_g] = ratio * g_fwhm
+            jac[self.i_l] = (1 - ratio) * l_fwhm
+
+
+# CompiledModel.fold で前もって計算した成分。x : 計算に使った x, fixed, fixed_values : 固定パラメータの
+# インデックスと値, bg_folded : バックグラウンドが constant に入っているか, constant : 変わらない成分の和 (なければ None),
+# shape_areas, shapes : 形が固定で面積が可変のピークの面積のインデックスと面積1の形, groups : 形が変わるピークのグループ
+FoldedTerms = namedtuple('FoldedTerms', ['x', 'fixed', 'fixed_values', 'bg_folded', 'constant', 'shape_areas',
+                                         'shapes', 'groups'])
+
+
+class CompiledModel:
+    """ModelSpec を平坦なパラメータベクトルとインデックス表に変換したもの
+
+    voigt_backend, voigt_rtol は Voigt 関数の計算方法 (faddeeva.get_backend を参照)。
+    bg_basis は fit の中でバックグラウンドを動かす基底 (BG_BASES、ChebyshevBasis を参照)。
+    window_rtol を指定すると、x が昇順の場合に各ピークを高さの window_rtol 倍以上の範囲
+    (support_windows) だけで計算し、範囲外のローレンチアンの裾は漸近形 (∝ 面積 × L_FWHM / (x - center)^2) で補正する。
+    点数が多く細いピークのデータで速くなる。ピークの初期値の center が実際のピークから計算範囲以上
+    離れていると、そのピークはデータを見ずに動かなくなるので、初期値はピークの近くに置くこと。
+    """
+
+    def __init__(self, spec, voigt_backend=None, voigt_rtol=None, window_rtol=None, bg_basis=None):
+        if bg_basis not in (None,) + BG_BASES:
+            raise ValueError(f"Unknown background basis: {bg_basis} (choose from {', '.join(BG_BASES)})")
+        self.spec = spec
+        self.faddeeva = faddeeva.get_backend(voigt_backend, voigt_rtol)
+        self.voigt_backend = voigt_backend
+        self.voigt_rtol = voigt_rtol
+        self.window_rtol = window_rtol
+        self.bg_basis = bg_basis or MONOMIAL
+        names = list(BG_NAMES)
+        values = list(spec.bg_values)
+        fixed = list(spec.bg_fixed)
+        lower = [-np.inf] * len(BG_NAMES)
+
+        # ピークごとに (種類, ratio, area, center, G_FWHM, L_FWHM) のインデックスを記録 (使わない項目は -1)
+        self.peak_plan = []
+        for peak in spec.peaks:
+            index = {}
+            for field in KIND_FIELDS[peak.kind]:
+                j = PEAK_FIELDS.index(field)
+                index[field] = len(names)
+                names.append(f'{field}_{peak.number}')
+                values.append(peak.values[j])
+                fixed.append(peak.fixed[j])
+                lower.append(0.0 if field in NON_NEGATIVE_FIELDS else -np.inf)
+            self.peak_plan.append((peak.kind,) + tuple(index.get(field, -1) for field in PEAK_FIELDS))
+
+        self.names = names
+        # 名前からインデックスへの対応 (GUI の表示・保存など外側でだけ使う)
+        self.index = {name: i for i, name in enumerate(names)}
+        self.lower = np.array(lower, dtype=float)
+        self.upper = np.full(len(names), np.inf)
+        # 初期値が範囲外の場合は範囲内に収める
+        self.values = np.clip(np.array(values, dtype=float), self.lower, self.upper)
+        self.vary = ~np.array(fixed, dtype=bool)
+        self.free = np.flatnonzero(self.vary)
+
+        # 同じ種類のピークをまとめる
+        self.groups = []
+        for kind in (GAUSSIAN, LORENTZIAN, PSEUDO_VOIGT, VOIGT):
+            positions = [i for i, plan in enumerate(self.peak_plan) if plan[0] == kind]
+            if positions:
+                self.groups.append(PeakGroup(kind, positions, [self.peak_plan[i] for i in positions], self.faddeeva))
+        self._model_buffer = np.empty(0)
+        self._folded = None
+
+        # 計算範囲を限る場合に使う表
+        self._plan_columns = np.array([plan[1:] for plan in self.peak_plan], dtype=int).reshape(len(self.peak_plan), len(PEAK_FIELDS))
+        self._kinds = np.array([plan[0] for plan in self.peak_plan], dtype=object)
+        self._sorted_x = None
+
+    def fold(self, x):
+        """形が変わらない成分を x で前もって計算しておく (フィットの最初に一度呼ぶ)
+
+        center, FWHM, ratio がすべて固定のピークは面積1の形を、面積も固定のピークと
+        全項が固定のバックグラウンドはその和を保存し、evaluate / model_jacobian では
+        形が変わるピークだけを計算する。同じ x (同じ配列オブジェクト) で固定パラメータの値が
+        保存時と同じ場合にだけ使う。
+        """
+        folded = self._folded
+        if folded is not None and folded.x is x:
+            return
+        self._folded = None
+        fixed = np.flatnonzero(~self.vary)
+        shape_fixed = [all(i < 0 or not self.vary[i] for j, i in enumerate(plan[1:]) if PEAK_FIELDS[j] != 'area')
+                       for plan in self.peak_plan]
+        bg_folded = not np.any(self.vary[:len(BG_NAMES)])
+        if not bg_folded and not any(shape_fixed):
+            return
+        i_area = 1 + PEAK_FIELDS.index('area')
+        p = self.values.copy()
+        shape_positions = [k for k, plan in enumerate(self.peak_plan) if shape_fixed[k] and self.vary[plan[i_area]]]
+        constant_positions = [k for k, plan in enumerate(self.peak_plan) if shape_fixed[k] and not self.vary[plan[i_area]]]
+        shape_areas = np.array([self.peak_plan[k][i_area] for k in shape_positions], dtype=int)
+        p[shape_areas] = 1.0
+        if not shape_positions and not constant_positions:
+            curves = np.empty((0, len(x)))
+        else:
+            # 計算範囲を限る場合はフィットの中と同じ計算 (範囲と裾の補正) で保存する
+            curves = self.peak_curves(p, x, windowed=True)
+        constant = curves[constant_positions].sum(axis=0) if constant_positions else None
+        if bg_folded:
+            background = self.background(self.values, x, out=np.empty(len(x)))
+            constant = background if constant is None else constant + background
+        groups = []
+        for group in self.groups:
+            positions = [k for k in group.positions if not shape_fixed[k]]
+            if len(positions) == group.size:
+                groups.append(group)
+            elif positions:
+                groups.append(PeakGroup(group.kind, positions, [self.peak_plan[k] for k in positions], self.faddeeva))
+        self._folded = FoldedTerms(x, fixed, self.values[fixed].copy(), bg_folded, constant, shape_areas,
+                                   np.ascontiguousarray(curves[shape_positions]), groups)
+
+    def windowed(self, x):
+        """計算範囲を限って計算するか (window_rtol が指定されていて x が昇順の場合)"""
+        if not self.window_rtol:
+            return False
+        if self._sorted_x is None or self._sorted_x[0] is not x:
+            self._sorted_x = (x, bool(np.all(x[1:] >= x[:-1])))
+        return self._sorted_x[1]
+
+    def support_windows(self, p, x, positions=None, rtol=None):
+        """各ピーク (spec.peaks の位置 positions、省略時は全ピーク) の計算範囲 x[lo:hi] を (lo, hi, reach) で返す
+
+        ピークの高さの rtol (省略時は window_rtol) 倍以上の範囲 (中心 ± reach) を昇順の x の二分探索で求める。
+        """
+        rtol = self.window_rtol if rtol is None else rtol
+        positions = np.arange(len(self.peak_plan)) if positions is None else np.asarray(positions, dtype=int)
+        columns = self._plan_columns[positions]
+        kinds = self._kinds[positions]
+        center = p[columns[:, 2]]
+        fwhm_g = np.where(columns[:, 3] >= 0, p[columns[:, 3]], 0.0)
+        fwhm_l = np.where(columns[:, 4] >= 0, p[columns[:, 4]], 0.0)
+        # 中心から (FWHM / 2) のこの倍数で高さが rtol 倍になる
+        reach_g = 0.5 * np.abs(fwhm_g) * np.sqrt(np.log(1 / rtol) / np.log(2))
+        reach_l = 0.5 * np.abs(fwhm_l) * np.sqrt(1 / rtol - 1)
+        # Voigt 関数は畳み込みなので和、擬 Voigt 関数は広い方
+        reach = np.select([kinds == GAUSSIAN, kinds == LORENTZIAN, kinds == VOIGT],
+                          [reach_g, reach_l, reach_g + reach_l], np.maximum(reach_g, reach_l))
+        lo = np.searchsorted(x, center - reach, side='left')
+        hi = np.searchsorted(x, center + reach, side='right')
+        # 点の間隔より細いピークも両隣の点では計算する (範囲が空だと偏微分が0になって動かなくなる)
+        nearest = np.searchsorted(x, center)
+        lo = np.minimum(lo, np.maximum(nearest - 1, 0))
+        hi = np.maximum(hi, np.minimum(nearest + 1, len(x)))
+        return lo, hi, reach
+
+    def _window_curve(self, p, xs, k):
+        """ピーク k を計算範囲の x (xs) で計算する"""
+        kind, i_ratio, i_area, i_center, i_g, i_l = self.peak_plan[k]
+        if kind == GAUSSIAN:
+            return gaussian(xs, p[i_center], p[i_area], p[i_g])
+        if kind == LORENTZIAN:
+            return lorentzian(xs, p[i_center], p[i_area], p[i_l])
+        if kind == VOIGT:
+            return voigt(xs, p[i_center], p[i_area], p[i_g], p[i_l], self.faddeeva)
+        return pseudo_voigt(xs, p[i_ratio], p[i_center], p[i_area], p[i_g], p[i_l])
+
+    def _add_windowed(self, p, x, model, groups):
+        """groups のピークを計算範囲だけで model に加算し、範囲外のローレンチアンの裾を補正する"""
+        positions = np.concatenate([group.positions for group in groups]) if groups else np.empty(0, dtype=int)
+        lo, hi, reach = self.support_windows(p, x, positions)
+        for k, a, b in zip(positions, lo, hi):
+            if a < b:
+                model[a:b] += self._window_curve(p, x[a:b], k)
+        self._add_lorentz_tails(p, x, model, positions, lo, hi, reach)
+
+    def _windowed_curves(self, p, x):
+        """各ピークを _add_windowed と同じ計算 (計算範囲と範囲外の裾) で1つずつ計算する (ピーク数 × x)"""
+        positions = np.arange(len(self.peak_plan))
+        lo, hi, reach = self.support_windows(p, x, positions)
+        curves = np.zeros((len(positions), len(x)))
+        for k, a, b in zip(positions, lo, hi):
+            if a < b:
+                curves[k, a:b] = self._window_curve(p, x[a:b], k)
+            self._add_lorentz_tails(p, x, curves[k], positions[k:k + 1], lo[k:k + 1], hi[k:k + 1], reach[k:k + 1])
+        return curves
+
+    def _tail_peaks(self, p, positions, lo, hi, reach):
+        """ローレンチアン成分を持つピーク (Voigt, 擬 Voigt 関数を含む) の裾の係数
+
+        計算範囲の外の裾は中心からの距離 d の漸近形 coef / d^2 (coef = 面積 × L_FWHM / 2π × ローレンチアン成分の割合)
+        で近似する (計算範囲の外ではローレンチアンとの相対誤差が window_rtol 程度以下。Voigt 関数の裾もこの形)。
+        (位置, plan の列, ローレンチアン成分の割合, coef, lo, hi, reach) を返す。なければ None
+        """
+        lorentz = self._kinds[positions] != GAUSSIAN
+        if not np.any(lorentz):
+            return None
+        positions = positions[lorentz]
+        columns = self._plan_columns[positions]
+        # 擬 Voigt 関数はローレンチアン成分の割合だけ
+        weight = np.where(self._kinds[positions] == PSEUDO_VOIGT, 1 - p[columns[:, 0]], 1.0)
+        coef = weight * p[columns[:, 1]] * p[columns[:, 4]] * (LORENTZ_NORM / 4)
+        return positions, columns, weight, coef, lo[lorentz], hi[lorentz], reach[lorentz]
+
+    @staticmethod
+    def _outside_inverse(x, start, stop, center, lo, hi):
+        """x[start:stop] の各ピークの中心との距離の逆数 1/d を、計算範囲 [lo, hi) の中は0にして返す (ピーク数 × 点数)"""
+        index = np.arange(start, stop)
+        outside = (index < lo[:, None]) | (index >= hi[:, None])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(outside, 1.0 / (x[None, start:stop] - center[:, None]), 0.0)
+
+    def _add_lorentz_tails(self, p, x, model, positions, lo, hi, reach):
+        """計算範囲の外のローレンチアンの裾を model に加える (_tail_peaks の漸近形)
+
+        中心から max(reach + h, TAIL_NEAR_SPACINGS × h) より遠くは全ピークの和を間隔 h の粗い格子
+        (x の範囲を TAIL_GRID_MAX 点で等分) で計算して
+        x に線形補間し (1/d^2 はそこでは滑らかなので、補間の相対誤差は 1 / TAIL_NEAR_SPACINGS^2 程度)、
+        それより近く (格子点で区切る) は計算範囲の境界でちょうど切って x で直接計算する。
+        計算量は O(ピーク数 × 格子点数 + データ数 + 中心の近くの点数)。
+        """
+        tail = self._tail_peaks(p, positions, lo, hi, reach)
+        if tail is None:
+            return
+        _, columns, _, coef, lo, hi, reach = tail
+        center = p[columns[:, 2]]
+        # 格子はピークによらない (ピークの一部ずつ計算しても和が同じになるように)
+        n_grid = min(TAIL_GRID_MAX, len(x))
+        if n_grid < 2 or not x[-1] > x[0]:
+            n_grid = 1
+            near_lo, near_hi = np.full(len(coef), -1), np.full(len(coef), n_grid)
+            grid = np.full(1, x[0]) if len(x) else np.empty(0)
+        else:
+            grid = np.linspace(x[0], x[-1], n_grid)
+            step = grid[1] - grid[0]
+            near = np.maximum(reach + step, TAIL_NEAR_SPACINGS * step)
+            # 格子点 near_lo 以下と near_hi 以上が遠方 (中心の近くは格子点の間 (near_lo, near_hi))
+            # 計算範囲は必ず近くに入れる (中心がデータの外のピークでも端の点は計算範囲になる)
+            first, last = x[np.minimum(lo, len(x) - 1)], x[np.maximum(hi - 1, 0)]
+            near_lo = np.minimum(np.floor((center - near - x[0]) / step),
+                                 np.where(lo < hi, np.floor((first - x[0]) / step) - 1, np.inf))
+            near_hi = np.maximum(np.ceil((center + near - x[0]) / step),
+                                 np.where(lo < hi, np.ceil((last - x[0]) / step) + 1, -np.inf))
+            near_lo = np.clip(near_lo, -1, n_grid - 1).astype(int)
+            near_hi = np.clip(near_hi, 0, n_grid).astype(int)
+            index = np.arange(n_grid)
+            far = (index <= near_lo[:, None]) | (index >= near_hi[:, None])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                d = grid[None, :] - center[:, None]
+                tails = np.where(far, coef[:, None] / (d * d), 0.0)
+            model += np.interp(x, grid, tails.sum(axis=0))
+        for k in range(len(coef)):
+            left, right = near_lo[k], near_hi[k]
+            a = np.searchsorted(x, grid[left], side='right') if left >= 0 else 0
+            b = np.searchsorted(x, grid[right], side='left') if right < n_grid else len(x)
+            # 近くは直接計算する (計算範囲の境界でちょうど切る)
+            for part in (slice(a, min(lo[k], b)), slice(max(hi[k], a), b)):
+                if part.start < part.stop:
+                    d = x[part] - center[k]
+                    model[part] += coef[k] / (d * d)
+            # 遠方の格子点とその隣の近くの格子点の間には補間した値が入っているので除く
+            if 0 <= left < n_grid - 1:
+                edge = slice(a, np.searchsorted(x, grid[left + 1], side='left'))
+                model[edge] -= tails[k, left] * (grid[left + 1] - x[edge]) / step
+            if 0 < right < n_grid:
+                edge = slice(np.searchsorted(x, grid[right - 1], side='right'), b)
+                model[edge] -= tails[k, right] * (x[edge] - grid[right - 1]) / step
+
+    def _add_lorentz_tail_derivs(self, p, x, jac, positions, lo, hi, reach):
+        """計算範囲の外のローレンチアンの裾 (_tail_peaks の漸近形) の偏微分を jac に加える
+
+        偏微分はピークごとの行なので、格子を使わずに全点で直接計算する (ピークをまとめてブロックごとに計算する)。
+        """
+        tail = self._tail_peaks(p, positions, lo, hi, reach)
+        if tail is None:
+            return
+        positions, columns, weight, coef, lo, hi, _ = tail
+        area, fwhm = p[columns[:, 1]], p[columns[:, 4]]
+        center = p[columns[:, 2]]
+        pseudo = self._kinds[positions] == PSEUDO_VOIGT
+        block = max(1, min(len(x), BUFFER_SIZE // len(positions)))
+        for start in range(0, len(x), block):
+            stop = min(start + block, len(x))
+            inverse = self._outside_inverse(x, start, stop, center, lo, hi)
+            inverse2 = inverse * inverse
+            jac[columns[:, 1], start:stop] += (weight * fwhm * (LORENTZ_NORM / 4))[:, None] * inverse2
+            jac[columns[:, 2], start:stop] += (2 * coef)[:, None] * inverse2 * inverse
+            jac[columns[:, 4], start:stop] += (weight * area * (LORENTZ_NORM / 4))[:, None] * inverse2
+            if np.any(pseudo):
+                jac[columns[pseudo, 0], start:stop] -= (area * fwhm * (LORENTZ_NORM / 4))[pseudo, None] * inverse2[pseudo]
+
+    def _jacobian_windowed(self, p, x, jac, groups):
+        """groups のピークの偏微分を計算範囲だけで jac に書き込み、範囲外のローレンチアンの裾の偏微分を加える"""
+        positions = np.concatenate([group.positions for group in groups]) if groups else np.empty(0, dtype=int)
+        lo_all, hi_all, reach = self.support_windows(p, x, positions)
+        for k, lo, hi in zip(positions, lo_all, hi_all):
+            if lo >= hi:
+                continue
+            for i, deriv in self.window_derivs(p, x[lo:hi], k):
+                jac[i, lo:hi] = deriv
+        self._add_lorentz_tail_derivs(p, x, jac, positions, lo_all, hi_all, reach)
+
+    def window_derivs(self, p, xs, k):
+        """ピーク k の各パラメータでの偏微分を xs で計算して (パラメータのインデックス, 偏微分) のリストで返す"""
+        kind, i_ratio, i_area, i_center, i_g, i_l = self.peak_plan[k]
+        center, area = p[i_center], p[i_area]
+        if kind == GAUSSIAN:
+            return list(zip((i_area, i_center, i_g), gaussian_derivs(xs, center, area, p[i_g])))
+        if kind == LORENTZIAN:
+            return list(zip((i_area, i_center, i_l), lorentzian_derivs(xs, center, area, p[i_l])))
+        if kind == VOIGT:
+            return list(zip((i_area, i_center, i_g, i_l), voigt_derivs(xs, center, area, p[i_g], p[i_l], self.faddeeva)))
+        ratio = p[i_ratio]
+        g_area, g_center, g_fwhm = gaussian_derivs(xs, center, area, p[i_g])
+        l_area, l_center, l_fwhm = lorentzian_derivs(xs, center, area, p[i_l])
+        return [(i_ratio, area * (g_area - l_area)),
+                (i_area, ratio * g_area + (1 - ratio) * l_area),
+                (i_center, ratio * g_center + (1 - ratio) * l_center),
+                (i_g, ratio * g_fwhm),
+                (i_l, (1 - ratio) * l_fwhm)]
+
+    def _folded_for(self, p, x):
+        """fold で保存した値が p, x に使えれば返す"""
+        folded = self._folded
+        if folded is None or folded.x is not x or not np.array_equal(p[folded.fixed], folded.fixed_values):
+            return None
+        return folded
+
+    def full_vector(self, free_values):
+        """可変パラメータの値を埋め込んだ全パラメータのベクトルを返す"""
+        p = self.values.copy()
+        p[self.free] = free_values
+        return p
+
+    def vector_from_params(self, params):
+        """lmfit の Parameters から全パラメータのベクトルを作る"""
+        return np.array([params[name].value for name in self.names], dtype=float)
+
+    def background_basis(self, x):
+        """bg_basis が 'chebyshev' の場合に x の範囲の ChebyshevBasis を返す
+
+        チェビシェフ多項式の低次の項と x のべきの低次の項は同じ多項式を表すので、可変の項が
+        bg_a から続く場合 (例えば bg_a, bg_b が可変で残りが固定) だけ置き換える。それ以外は None (x のべき のまま)。
+        """
+        if self.bg_basis != CHEBYSHEV or len(x) == 0:
+            return None
+        vary = self.vary[:len(BG_NAMES)]
+        size = len(BG_NAMES) if np.all(vary) else int(np.argmin(vary))
+        lo, hi = np.min(x), np.max(x)
+        if size < 2 or np.any(vary[size:]) or not hi > lo:
+            return None
+        return ChebyshevBasis(lo, hi, size)
+
+    def peak_table(self, p):
+        """全パラメータのベクトル p を (ピーク数 × PEAK_FIELDS) の表にする (spec.peaks の順番、使わない項目は NaN)"""
+        table = np.full(self._plan_columns.shape, np.nan)
+        used = self._plan_columns >= 0
+        table[used] = p[self._plan_columns[used]]
+        return table
+
+    def background(self, p, x, out=None):
+        """バックグラウンド (4次多項式) を計算する"""
+        # ホーナー法 (((e x + d) x + c) x + b) x + a
+        out = np.multiply(x, p[4], out=out)
+        for k in (3, 2, 1):
+            out += p[k]
+            out *= x
+        out += p[0]
+        return out
+
+    def evaluate(self, p, x, out=None):
+        """バックグラウンド + 全ピークのモデルを計算する"""
+        folded = self._folded_for(p, x)
+        if folded is None:
+            model = self.background(p, x, out=out)
+            groups = self.groups
+        else:
+            if folded.bg_folded:
+                model = np.empty(len(x)) if out is None else out
+                model[:] = folded.constant
+            else:
+                model = self.background(p, x, out=out)
+                if folded.constant is not None:
+                    model += folded.constant
+            if len(folded.shape_areas):
+                model += p[folded.shape_areas] @ folded.shapes
+            groups = folded.groups
+        if self.windowed(x):
+            self._add_windowed(p, x, model, groups)
+            return model
+        for group in groups:
+            group.add_to(p, x, model)
+        return model
+
+    def peak_curves(self, p, x, windowed=False):
+        """各ピークの曲線を (ピーク数 × x) の配列で返す (spec.peaks の順番)
+
+        windowed が True で計算範囲を限る設定の場合は、フィットの中 (evaluate) と同じく計算範囲だけで計算し、
+        範囲外はローレンチアンの裾の補正を加える (各曲線の和が evaluate のピークの部分と同じになる)。
+        """
+        if windowed and self.windowed(x):
+            return self._windowed_curves(p, x)
+        curves = np.empty((len(self.peak_plan), len(x)))
+        for group in self.groups:
+            curves[group.positions] = group.curves(p, x)
+        return curves
+
+    def residual(self, p, x, y, y_err):
+        """ フィット関数の残差計算 """
+        if len(self._model_buffer) != len(x):
+            self._model_buffer = np.empty(len(x))
+        model = self.evaluate(p, x, out=self._model_buffer)
+        return (y - model) / y_err  # 残差を誤差で正規化して返す
+
+    def model_jacobian(self, p, x):
+        """モデルの各パラメータでの偏微分 (パラメータ数 × データ数)"""
+        jac = np.zeros((len(p), len(x)))
+        # バックグラウンドは x^k
+        jac[0] = 1.0
+        for k in range(1, len(BG_NAMES)):
+            np.multiply(jac[k - 1], x, out=jac[k])
+        folded = self._folded_for(p, x)
+        if folded is None:
+            groups = self.groups
+        else:
+            # 形が固定のピークは面積での偏微分 (面積1の形) だけ
+            jac[folded.shape_areas] = folded.shapes
+            groups = folded.groups
+        if self.windowed(x):
+            self._jacobian_windowed(p, x, jac, groups)
+            return jac
+        for group in groups:
+            group.jacobian_into(p, x, jac)
+        return jac
+
+    def residual_jacobian(self, p, x, y_err):
+        """可変パラメータについての残差の偏微分 (可変パラメータ数 × データ数)"""
+        return -self.model_jacobian(p, x)[self.free] / y_err
+
+
+class ChebyshevBasis:
+    """x を [lo, hi] から [-1, 1] に写した t のチェビシェフ多項式 T_0(t)..T_{size-1}(t) によるバックグラウンド
+
+    x のべき (x が 10-100 程度だと列の大きさがそろわず相関も強い) の代わりにフィットの中で使う。
+    係数 c と x のべきの係数 a は a = to_monomial @ c で変換する。値はクレンショー法で計算する。
+    """
+
+    def __init__(self, lo, hi, size):
+        self.center = 0.5 * (lo + hi)
+        self.half = 0.5 * (hi - lo)
+        self.size = size
+        # T_k(t) の t のべきの係数に t = (x - center) / half を代入して x のべきの係数にする
+        t = np.polynomial.Polynomial([-self.center / self.half, 1.0 / self.half])
+        self.to_monomial = np.zeros((size, size))
+        for k in range(size):
+            coef = np.polynomial.Polynomial(np.polynomial.chebyshev.cheb2poly(np.eye(size)[k]))(t).coef
+            self.to_monomial[:len(coef), k] = coef
+
+    def from_monomial(self, a):
+        """x のべきの係数 a (低次の size 項) をチェビシェフ多項式の係数にする"""
+        return np.linalg.solve(self.to_monomial, a)
+
+    def evaluate(self, c, x):
+        """クレンショー法で sum c_k T_k(t) を計算する"""
+        t = (x - self.center) / self.half
+        b1 = np.zeros_like(t)
+        b2 = np.zeros_like(t)
+        for ck in c[:0:-1]:
+            b1, b2 = 2 * t * b1 - b2 + ck, b1
+        return t * b1 - b2 + c[0]
+
+    def vander(self, x):
+        """T_0(t)..T_{size-1}(t) (size × データ数、係数での偏微分)"""
+        t = (x - self.center) / self.half
+        rows = np.empty((self.size, len(x)))
+        rows[0] = 1.0
+        rows[1] = t
+        for k in range(2, self.size):
+            rows[k] = 2 * t * rows[k - 1] - rows[k - 2]
+        return rows
+
+
+class BoundsTransform:
+    """MINUIT 形式の内部/外部パラメータ変換 (lmfit の leastsq と同じ変換)"""
+
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+        self.low_only = np.isfinite(lower) & ~np.isfinite(upper)
+        self.up_only = ~np.isfinite(lower) & np.isfinite(upper)
+        self.both = np.isfinite(lower) & np.isfinite(upper)
+
+    def to_internal(self, values):
+        internal = np.array(values, dtype=float)
+        lo, up = self.lower, self.upper
+        m = self.low_only
+        internal[m] = np.sqrt((values[m] - lo[m] + 1.0)**2 - 1)
+        m = self.up_only
+        internal[m] = np.sqrt((up[m] - values[m] + 1.0)**2 - 1)
+        m = self.both
+        internal[m] = np.arcsin(2 * (values[m] - lo[m]) / (up[m] - lo[m]) - 1)
+        internal[np.abs(internal) < 1.e-15] = 0.0
+        return internal
+
+    def to_external(self, internal):
+        values = np.array(internal, dtype=float)
+        lo, up = self.lower, self.upper
+        m = self.low_only
+        values[m] = lo[m] - 1.0 + np.sqrt(internal[m]**2 + 1)
+        m = self.up_only
+        values[m] = up[m] + 1 - np.sqrt(internal[m]**2 + 1)
+        m = self.both
+        values[m] = lo[m] + (np.sin(internal[m]) + 1) * (up[m] - lo[m]) / 2.0
+        return values
+
+    def gradient(self, internal):
+        """d(外部)/d(内部)"""
+        grad = np.ones_like(internal)
+        m = self.low_only
+        grad[m] = internal[m] / np.sqrt(internal[m]**2 + 1)
+        m = self.up_only
+        grad[m] = -internal[m] / np.sqrt(internal[m]**2 + 1)
+        m = self.both
+        grad[m] = np.cos(internal[m]) * (self.upper[m] - self.lower[m]) / 2.0
+        return grad
+
+
+class FitStopped(Exception):
+    """経過時間の上限または cancel でフィットを打ち切った (reason は 'time' / 'cancelled')"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class FitBudget:
+    """フィットを途中で打ち切るための経過時間の上限 time_budget [s] と cancel (is_set() を持つもの)
+
+    解法は残差を計算するたびに check を呼ぶ。それまでで χ^2 が最小だった解法の変数 (best) を覚えておき、
+    上限を超えるか cancel されたら FitStopped を投げる。どちらも None なら何もしない。
+    """
+
+    def __init__(self, time_budget=None, cancel=None):
+        self.time_budget = time_budget
+        self.deadline = None if time_budget is None else time.monotonic() + time_budget
+        self.cancel = cancel
+        self.best = None
+        self.best_chisqr = np.inf
+
+    @property
+    def active(self):
+        return self.deadline is not None or self.cancel is not None
+
+    def remaining(self):
+        """残りの時間 [s] (上限がなければ None)。入れ子のフィットに渡す"""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def check(self, variables, resid):
+        """variables (解法の変数) での残差を記録し、打ち切る場合は FitStopped を投げる"""
+        if not self.active:
+            return
+        chisqr = float(resid @ resid)
+        if chisqr < self.best_chisqr:
+            self.best_chisqr = chisqr
+            self.best = np.array(variables, dtype=float)
+        self.raise_if_stopped()
+
+    def raise_if_stopped(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise FitStopped('cancelled')
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise FitStopped('time')
+
+    def message(self, reason):
+        """打ち切った場合の FitResult.message"""
+        if reason == 'cancelled':
+            return 'Fit stopped early: cancelled. The best parameters so far are shown.'
+        return f'Fit stopped early: time budget of {self.time_budget:g} s exceeded. The best parameters so far are shown.'
+
+
+class FitResult:
+    """フィッティング結果
+
+    値と誤差は全パラメータのベクトル best_values, stderr (compiled.names の順) で持つ。
+    params (lmfit の Parameters) は名前で参照する場合のために最初に参照したときに作る
+    (ピーク数が多いと作るのに時間がかかるため)。
+    stopped は途中で打ち切った理由 (None, 'nfev' : 関数評価の回数の上限, 'time' : 経過時間の上限,
+    'cancelled')。'time' / 'cancelled' の場合の値はそれまでで χ^2 が最小のもので、誤差は求めない。
+    """
+
+    def __init__(self, compiled, best, residual, covar, nfev, success, message, start=None, stopped=None):
+        self.compiled = compiled
+        self.init_values = compiled.values if start is None else start
+        self.best_values = best
+        self.residual = residual
+        self.var_names = [compiled.names[i] for i in compiled.free]
+        self.nvarys = len(compiled.free)
+        self.ndata = len(residual)
+        self.nfree = self.ndata - self.nvarys
+        self.chisqr = float((residual**2).sum())
+        self.redchi = self.chisqr / max(1, self.nfree)
+        self.nfev = nfev
+        self.success = success
+        self.message = message
+        self.covar = covar
+        self.errorbars = covar is not None
+        self.stopped = stopped
+
+        # 名前との対応付けは最後に一度だけ行う
+        stderr = None if covar is None else np.zeros(len(best))
+        if covar is not None:
+            stderr[compiled.free] = np.sqrt(np.abs(np.diag(covar)))
+        self.stderr = stderr
+        self._params = None
+
+    @property
+    def params(self):
+        if self._params is None:
+            compiled = self.compiled
+            params = Parameters()
+            for i, name in enumerate(compiled.names):
+                lower = compiled.lower[i]
+                params.add(name, value=self.best_values[i], vary=bool(compiled.vary[i]),
+                           min=lower if np.isfinite(lower) else -np.inf)
+                params[name].stderr = None if self.stderr is None else float(self.stderr[i])
+                params[name].init_value = self.init_values[i]
+            self._params = params
+        return self._params
+
+
+def fit(spec, x, y, y_err, max_nfev=None, analytic_jacobian=True, voigt_backend=None, voigt_rtol=None,
+        start=None, window_rtol=None, bg_basis=None, time_budget=None, cancel=None):
+    """ModelSpec を x, y, y_err にフィットして FitResult を返す (lmfit の leastsq と同じ設定)
+
+    analytic_jacobian が True の場合は解析的なヤコビアンを MINPACK に渡し、
+    False の場合は従来通り差分近似で求める。
+    start は全パラメータの初期値のベクトル (省略時は spec の値)。固定パラメータは spec の値のまま。
+    window_rtol はピークを計算する範囲の許容値、bg_basis はバックグラウンドの基底
+    (CompiledModel を参照、spec が CompiledModel の場合はそちらの設定)。
+    'chebyshev' の場合も結果 (best_values, covar) は x のべきの係数で返す。
+    time_budget [s] を超えるか cancel (is_set() を持つもの) がセットされると、残差の計算の中で打ち切って
+    それまでの最良の値を返す (FitBudget、FitResult.stopped を参照)。
+    """
+    compiled = spec if isinstance(spec, CompiledModel) else \
+        CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+    compiled.fold(x)
+    free = compiled.free
+    if start is None:
+        start = compiled.values
+    else:
+        start = compiled.full_vector(np.clip(np.asarray(start, dtype=float)[free], compiled.lower[free], compiled.upper[free]))
+    bounds = BoundsTransform(compiled.lower[free], compiled.upper[free])
+    # チェビシェフ多項式のバックグラウンドでは、可変の低次の項 (free の先頭 n_bg 個、範囲なし) の
+    # 内部パラメータをチェビシェフ多項式の係数にする
+    basis = compiled.background_basis(x)
+    n_bg = 0 if basis is None else basis.size
+    if basis is not None:
+        bg_jac = -basis.vander(x) / y_err
+    budget = FitBudget(time_budget, cancel)
+    nfev = [0]
+
+    def external(internal):
+        p = compiled.full_vector(bounds.to_external(internal))
+        if basis is not None:
+            p[:n_bg] = basis.to_monomial @ internal[:n_bg]
+        return p
+
+    def func(internal):
+        nfev[0] += 1
+        p = external(internal)
+        if basis is None:
+            resid = compiled.residual(p, x, y, y_err)
+        else:
+            # 低次の項はクレンショー法で計算する (x のべきで計算すると桁落ちする)
+            p[:n_bg] = 0.0
+            resid = (y - compiled.evaluate(p, x) - basis.evaluate(internal[:n_bg], x)) / y_err
+        if not np.all(np.isfinite(resid)):
+            raise ValueError("NaN values detected in the data or the model function.")
+        budget.check(internal, resid)
+        return resid
+
+    def jac(internal):
+        # 外部パラメータでの偏微分に d(外部)/d(内部) を掛ける
+        p = external(internal)
+        jacobian = compiled.residual_jacobian(p, x, y_err)
+        if basis is not None:
+            jacobian[:n_bg] = bg_jac
+        return jacobian * bounds.gradient(internal)[:, None]
+
+    if max_nfev is None:
+        max_nfev = 2000 * (len(free) + 1)
+
+    with np.errstate(all='ignore'):
+        start_int = bounds.to_internal(start[free])
+        if basis is not None:
+            start_int[:n_bg] = basis.from_monomial(start[:n_bg])
+        stopped = None
+        if len(free) == 0:
+            best_int, cov_int, ier, errmsg = start_int, None, 1, ''
+        else:
+            try:
+                best_int, cov_int, _, errmsg, ier = leastsq(
+                    func, start_int, Dfun=jac if analytic_jacobian else None, col_deriv=1,
+                    full_output=1, ftol=1.5e-8, xtol=1.5e-8, gtol=0.0,
+                    maxfev=max_nfev, epsfcn=1.e-10, factor=100)
+            except FitStopped as stop:
+                stopped = stop.reason
+                best_int = start_int if budget.best is None else budget.best
+                cov_int, ier, errmsg = None, 0, budget.message(stopped)
+        best = external(best_int)
+        resid = compiled.residual(best, x, y, y_err)
+
+    success = ier in (1, 2, 3, 4)
+    if ier in (1, 2, 3):
+        message = 'Fit succeeded.'
+    elif ier == 5:
+        stopped = 'nfev'
+        message = f'Fit aborted: number of function evaluations > {max_nfev}.'
+    else:
+        message = errmsg
+
+    covar = None
+    if cov_int is not None:
+        # 共分散行列を外部パラメータ空間に変換し、換算χ^2でスケールする
+        grad = bounds.gradient(best_int)
+        nfree = max(1, len(resid) - len(free))
+        with np.errstate(over='ignore', invalid='ignore'):
+            if basis is None:
+                covar = cov_int * np.outer(grad, grad) * ((resid**2).sum() / nfree)
+            else:
+                # チェビシェフ多項式の係数の部分は a = to_monomial @ c で変換する
+                transform = np.diag(grad)
+                transform[:n_bg, :n_bg] = basis.to_monomial
+                covar = transform @ cov_int @ transform.T * ((resid**2).sum() / nfree)
+    return FitResult(compiled, best, resid, covar, nfev[0], success, message, start, stopped)
+
+
+# 逐次フィットで前のスキャンの換算χ^2 のこの倍数を超えたらテンプレートの初期値からやり直す
+CHI2_JUMP = 3.0
+
+# result : 採用した FitResult, start : 'previous' (前の結果から) / 'template' / 'template (retry)',
+# nfev : このスキャンで使った関数評価の合計 (やり直しを含む)
+SeriesStep = namedtuple('SeriesStep', ['result', 'start', 'nfev'])
+
+
+def _usable(result):
+    return result.success and result.stderr is not None
+
+
+def fit_series(spec, datasets, chi2_jump=CHI2_JUMP, solve=None, **kwargs):
+    """順番に並んだ (x, y, y_err) を前のスキャンの結果を初期値にしてフィットする (SeriesStep を順に返す)
+
+    前の結果から始めたフィットが失敗するか、換算χ^2 が前のスキャンの chi2_jump 倍を超えた場合は
+    テンプレート (spec) の初期値からやり直し、χ^2 の小さい方を採用する。
+    solve は1回のフィットの関数 (省略時は fit。solvers.fit に解法を指定したものなど) で、kwargs はそのまま渡す。
+    kwargs の cancel がセットされたら、そのスキャンの結果を返して終わる (time_budget はスキャンごとの上限)。
+    """
+    solve = fit if solve is None else solve
+    cancel = kwargs.get('cancel')
+    voigt_backend = kwargs.pop('voigt_backend', None)
+    voigt_rtol = kwargs.pop('voigt_rtol', None)
+    window_rtol = kwargs.pop('window_rtol', None)
+    bg_basis = kwargs.pop('bg_basis', None)
+    compiled = spec if isinstance(spec, CompiledModel) else \
+        CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    previous = None
+    for x, y, y_err in datasets:
+        if previous is None:
+            result = solve(compiled, x, y, y_err, **kwargs)
+            step = SeriesStep(result, 'template', result.nfev)
+        else:
+            result = solve(compiled, x, y, y_err, start=previous.best_values, **kwargs)
+            step = SeriesStep(result, 'previous', result.nfev)
+            if result.stopped != 'cancelled' and (not _usable(result) or result.redchi > chi2_jump * previous.redchi):
+                retry = solve(compiled, x, y, y_err, **kwargs)
+                nfev = result.nfev + retry.nfev
+                if _usable(retry) and (not _usable(result) or retry.chisqr <= result.chisqr):
+                    step = SeriesStep(retry, 'template (retry)', nfev)
+                else:
+                    step = SeriesStep(result, 'previous', nfev)
+        # 失敗したスキャンの結果は次の初期値に使わない
+        if _usable(step.result):
+            previous = step.result
+        yield step
+        if cancel is not None and cancel.is_set():
+            return
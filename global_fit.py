@@ -0,0 +1,308 @@
+"""複数のデータセットの同時フィット (グローバルフィット)
+
+全データセットに同じ ModelSpec を使い、パラメータごとに共通 (shared) か
+データセットごとか を選ぶ。残差は全データセットを連結したもの。
+
+ヤコビアンは共通パラメータの列と各データセット固有の列からなるブロック疎行列なので、
+正規方程式を Schur 補行列で解く Levenberg-Marquardt 法 (MINPACK と同じ信頼領域の手順) で最小化する。
+1反復の計算量はデータセット数 N に比例する (密な QR では N^3)。
+"""
+import numpy as np
+
+import fit_engine
+
+# 収束判定と信頼領域の初期半径の係数 (fit_engine.fit の leastsq と同じ値)
+FTOL = 1.5e-8
+XTOL = 1.5e-8
+FACTOR = 100.0
+
+
+def shared_indices(compiled, shared):
+    """共通パラメータの名前からパラメータベクトル上のインデックスを返す
+
+    'G_FWHM_1' のような名前の他に、'G_FWHM' のように番号を省略すると全ピークの項目を共通にする。
+    固定パラメータは共通・個別の区別がないので除く。
+    """
+    indices = set()
+    for name in shared:
+        name = name.strip()
+        if not name:
+            continue
+        if name in compiled.index:
+            matched = [compiled.index[name]]
+        else:
+            matched = [i for i, full in enumerate(compiled.names) if full.rsplit('_', 1)[0] == name]
+        if not matched:
+            raise ValueError(f"Unknown parameter: {name}")
+        indices.update(matched)
+    return np.array(sorted(i for i in indices if compiled.vary[i]), dtype=int)
+
+
+class GlobalFitResult:
+    """グローバルフィットの結果 (results はデータセットごとの FitResult、stopped は FitResult と同じ)"""
+
+    def __init__(self, results, shared_names, chisqr, ndata, nvarys, nfev, success, message, stopped=None):
+        self.results = results
+        self.shared_names = shared_names
+        self.chisqr = chisqr
+        self.ndata = ndata
+        self.nvarys = nvarys
+        self.nfree = ndata - nvarys
+        self.redchi = chisqr / max(1, self.nfree)
+        self.nfev = nfev
+        self.success = success
+        self.message = message
+        self.stopped = stopped
+
+
+class _Blocks:
+    """各データセットのヤコビアンから作る正規方程式のブロック
+
+    A = Σ Js Js^T, B_i = Js Jl^T, D_i = Jl Jl^T, 勾配 g_s = Σ Js r, g_i = Jl r
+    """
+
+    def __init__(self, n_shared, n_local, n_sets):
+        self.A = np.zeros((n_shared, n_shared))
+        self.g_s = np.zeros(n_shared)
+        self.B = np.zeros((n_sets, n_shared, n_local))
+        self.D = np.zeros((n_sets, n_local, n_local))
+        self.g_l = np.zeros((n_sets, n_local))
+
+    def solve(self, lam, d2_s, d2_l):
+        """(J^T J + λ D^2) δ = -J^T r を Schur 補行列で解く"""
+        A = self.A + np.diag(lam * d2_s)
+        D_inv = np.array([_inverse(D + np.diag(lam * d2)) for D, d2 in zip(self.D, d2_l)])
+        # S = A - Σ B_i D_i^-1 B_i^T, rhs = -g_s + Σ B_i D_i^-1 g_i
+        BD = self.B @ D_inv
+        schur = A - np.einsum('nsl,ntl->st', BD, self.B)
+        rhs = -self.g_s + np.einsum('nsl,nl->s', BD, self.g_l)
+        d_shared = _solve(schur, rhs)
+        d_local = np.einsum('nkl,nl->nk', D_inv, -self.g_l - np.einsum('nsl,s->nl', self.B, d_shared))
+        return d_shared, d_local
+
+    def predicted(self, d_s, d_l):
+        """線形近似での χ^2 の減少量 -2 g^T δ - δ^T J^T J δ"""
+        quad = d_s @ self.A @ d_s + 2 * np.einsum('s,nsl,nl->', d_s, self.B, d_l) + np.einsum('nk,nkl,nl->', d_l, self.D, d_l)
+        return -2 * (self.g_s @ d_s + (self.g_l * d_l).sum()) - quad
+
+    def column_norms2(self):
+        """ヤコビアンの各列のノルムの2乗 (共通, 個別)"""
+        return np.diag(self.A).copy(), np.einsum('nkk->nk', self.D).copy()
+
+    def covariance(self):
+        """(J^T J)^-1 の対角ブロック (共通, 個別) と交差ブロックを返す。特異な場合は None"""
+        try:
+            D_inv = np.array([np.linalg.inv(D) for D in self.D])
+            BD = self.B @ D_inv
+            C_ss = np.linalg.inv(self.A - np.einsum('nsl,ntl->st', BD, self.B))
+        except np.linalg.LinAlgError:
+            return None
+        # C_sl = -C_ss B_i D_i^-1, C_ll = D_i^-1 + D_i^-1 B_i^T C_ss B_i D_i^-1
+        C_sl = -np.einsum('st,ntl->nsl', C_ss, BD)
+        C_ll = D_inv - np.einsum('nsk,nsl->nkl', BD, C_sl)
+        if not (np.all(np.isfinite(C_ss)) and np.all(np.isfinite(C_ll))):
+            return None
+        return C_ss, C_sl, C_ll
+
+
+def _step(normal, d2_s, d2_l, delta, lam):
+    """信頼領域 |D δ| <= delta 内の Levenberg-Marquardt のステップ (MINPACK の lmpar と同じ考え方)
+
+    Gauss-Newton のステップが信頼領域に入らない場合は |D δ| が delta の ±10% に入るまで λ を探す。
+    (δ_s, δ_l, λ) を返す。
+    """
+    def scaled_norm(d_s, d_l):
+        return np.sqrt(d2_s @ d_s**2 + (d2_l * d_l**2).sum())
+
+    d_s, d_l = normal.solve(0.0, d2_s, d2_l)
+    norm = scaled_norm(d_s, d_l)
+    if np.isfinite(norm) and norm <= 1.1 * delta:
+        return d_s, d_l, 0.0
+    # |D δ| は λ について単調減少なので対数スケールで挟み込む
+    low, high = 0.0, None
+    lam = lam if lam > 0 else 1e-3
+    for _ in range(30):
+        d_s, d_l = normal.solve(lam, d2_s, d2_l)
+        norm = scaled_norm(d_s, d_l)
+        if abs(norm - delta) <= 0.1 * delta:
+            break
+        if norm > delta:
+            low = lam
+            lam = lam * 10 if high is None else np.sqrt(low * high)
+        else:
+            high = lam
+            lam = lam / 10 if low == 0 else np.sqrt(low * high)
+    return d_s, d_l, lam
+
+
+def _inverse(M):
+    try:
+        return np.linalg.inv(M)
+    except np.linalg.LinAlgError:
+        return np.linalg.pinv(M)
+
+
+def _solve(M, b):
+    try:
+        return np.linalg.solve(M, b)
+    except np.linalg.LinAlgError:
+        return np.linalg.lstsq(M, b, rcond=None)[0]
+
+
+def fit_global(spec, datasets, shared=(), max_nfev=None, voigt_backend=None, voigt_rtol=None, time_budget=None,
+               cancel=None):
+    """datasets = [(x, y, y_err), ...] を同時にフィットして GlobalFitResult を返す
+
+    shared : 全データセットで共通にするパラメータの名前 (shared_indices を参照)。それ以外の可変パラメータは
+    データセットごとに独立。初期値はすべて spec の値。
+    time_budget, cancel は fit_engine.FitBudget と同じで、反復の間で確かめる。打ち切った場合はそれまでの値
+    (受け入れたステップは χ^2 を減らすので最良の値) を誤差なしで返す。
+    """
+    datasets = [tuple(np.asarray(a, dtype=float) for a in data) for data in datasets]
+    if not datasets:
+        raise ValueError("No datasets to fit.")
+    n_sets = len(datasets)
+    # データセットごとに作る (作業用の配列をデータ点数ごとに持つため)
+    models = [fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol) for _ in datasets]
+    for model, (x, _, _) in zip(models, datasets):
+        model.fold(x)
+    compiled = models[0]
+    i_shared = shared_indices(compiled, shared)
+    i_local = np.array([i for i in compiled.free if i not in set(i_shared)], dtype=int)
+    n_shared, n_local = len(i_shared), len(i_local)
+    n_varys = n_shared + n_sets * n_local
+    bounds_s = fit_engine.BoundsTransform(compiled.lower[i_shared], compiled.upper[i_shared])
+    bounds_l = fit_engine.BoundsTransform(compiled.lower[i_local], compiled.upper[i_local])
+    if max_nfev is None:
+        max_nfev = 2000 * (n_varys + 1)
+    nfev = [0]
+    budget = fit_engine.FitBudget(time_budget, cancel)
+
+    def stop_reason():
+        """打ち切る理由 ('time' / 'cancelled')。続ける場合は None"""
+        try:
+            budget.raise_if_stopped()
+        except fit_engine.FitStopped as stop:
+            return stop.reason
+        return None
+
+    def vectors(q_s, q_l):
+        """内部パラメータからデータセットごとの全パラメータのベクトルを作る"""
+        ext_s = bounds_s.to_external(q_s)
+        vectors = []
+        for q in q_l:
+            p = compiled.values.copy()
+            p[i_shared] = ext_s
+            p[i_local] = bounds_l.to_external(q)
+            vectors.append(p)
+        return vectors
+
+    def residuals(q_s, q_l):
+        nfev[0] += 1
+        resid = [model.residual(p, *data) for model, p, data in zip(models, vectors(q_s, q_l), datasets)]
+        if not all(np.all(np.isfinite(r)) for r in resid):
+            raise ValueError("NaN values detected in the data or the model function.")
+        return resid
+
+    def blocks(q_s, q_l, resid):
+        """ヤコビアンをデータセットごとに計算して正規方程式のブロックにまとめる"""
+        grad_s = bounds_s.gradient(q_s)
+        result = _Blocks(n_shared, n_local, n_sets)
+        for n, (model, p, (x, _, y_err), r) in enumerate(zip(models, vectors(q_s, q_l), datasets, resid)):
+            jac = model.model_jacobian(p, x)
+            jac /= -y_err
+            J_s = jac[i_shared] * grad_s[:, None]
+            J_l = jac[i_local] * bounds_l.gradient(q_l[n])[:, None]
+            result.A += J_s @ J_s.T
+            result.g_s += J_s @ r
+            result.B[n] = J_s @ J_l.T
+            result.D[n] = J_l @ J_l.T
+            result.g_l[n] = J_l @ r
+        return result
+
+    def cost(resid):
+        return sum(float(r @ r) for r in resid)
+
+    with np.errstate(all='ignore'):
+        q_s = bounds_s.to_internal(compiled.values[i_shared])
+        q_l = np.tile(bounds_l.to_internal(compiled.values[i_local]), (n_sets, 1))
+        resid = residuals(q_s, q_l)
+        chi2 = cost(resid)
+        success, message, stopped = True, 'Fit succeeded.', None
+        # MINPACK の lmder と同じ手順 (列のノルムでスケールした信頼領域)
+        lam = 0.0
+        delta = None
+        while n_varys > 0:
+            normal = blocks(q_s, q_l, resid)
+            norms_s, norms_l = normal.column_norms2()
+            if delta is None:
+                d2_s, d2_l = norms_s, norms_l
+                # 偏微分が0の列は1にする
+                d2_s[d2_s == 0] = 1.0
+                d2_l[d2_l == 0] = 1.0
+                x_norm = np.sqrt(d2_s @ q_s**2 + (d2_l * q_l**2).sum())
+                delta = FACTOR * x_norm if x_norm > 0 else FACTOR
+            else:
+                d2_s, d2_l = np.maximum(d2_s, norms_s), np.maximum(d2_l, norms_l)
+            converged = False
+            while True:
+                d_s, d_l, lam = _step(normal, d2_s, d2_l, delta, lam)
+                step_norm = np.sqrt(d2_s @ d_s**2 + (d2_l * d_l**2).sum())
+                if nfev[0] == 1:
+                    delta = min(delta, step_norm)
+                trial_s, trial_l = q_s + d_s, q_l + d_l
+                trial = residuals(trial_s, trial_l)
+                trial_chi2 = cost(trial)
+                # 実際の減少量と予測される減少量の比で信頼領域を更新
+                actual = 1 - trial_chi2 / chi2 if chi2 > 0 else 0.0
+                predicted = normal.predicted(d_s, d_l) / chi2 if chi2 > 0 else 0.0
+                ratio = actual / predicted if predicted != 0 else 0.0
+                if ratio <= 0.25:
+                    delta = 0.5 * min(delta, step_norm / 0.1)
+                    lam *= 2.0
+                elif lam == 0 or ratio >= 0.75:
+                    delta = step_norm / 0.5
+                    lam *= 0.5
+                if ratio >= 1e-4:
+                    q_s, q_l, resid, chi2 = trial_s, trial_l, trial, trial_chi2
+                x_norm = np.sqrt(d2_s @ q_s**2 + (d2_l * q_l**2).sum())
+                if (abs(actual) <= FTOL and predicted <= FTOL and 0.5 * ratio <= 1) or delta <= XTOL * x_norm:
+                    converged = True
+                    break
+                if nfev[0] >= max_nfev:
+                    success, message = False, f'Fit aborted: number of function evaluations > {max_nfev}.'
+                    stopped = 'nfev'
+                    converged = True
+                    break
+                stopped = stop_reason()
+                if stopped is not None:
+                    success, message = False, budget.message(stopped)
+                    converged = True
+                    break
+                if ratio >= 1e-4:
+                    break
+            if converged:
+                break
+
+        covariance = None
+        if n_varys > 0 and stopped not in ('time', 'cancelled'):
+            covariance = blocks(q_s, q_l, resid).covariance()
+
+    ndata = sum(len(r) for r in resid)
+    redchi = chi2 / max(1, ndata - n_varys)
+    ext_vectors = vectors(q_s, q_l)
+    grad_s = bounds_s.gradient(q_s)
+    # データセットごとの FitResult (共分散は全体の換算χ^2 でスケール)
+    order = np.concatenate([i_shared, i_local])
+    position = np.argsort(order)  # compiled.free の順番に並べ替える
+    results = []
+    for n, (model, p, r) in enumerate(zip(models, ext_vectors, resid)):
+        covar = None
+        if covariance is not None:
+            C_ss, C_sl, C_ll = covariance
+            cov_int = np.block([[C_ss, C_sl[n]], [C_sl[n].T, C_ll[n]]])
+            grad = np.concatenate([grad_s, bounds_l.gradient(q_l[n])])
+            covar = (cov_int * np.outer(grad, grad) * redchi)[np.ix_(position, position)]
+        results.append(fit_engine.FitResult(model, p, r, covar, nfev[0], success, message, stopped=stopped))
+    shared_names = [compiled.names[i] for i in i_shared]
+    return GlobalFitResult(results, shared_names, chi2, ndata, n_varys, nfev[0], success, message, stopped)
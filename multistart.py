@@ -0,0 +1,222 @@
+"""多点スタート / 大域的最適化によるフィット
+
+ピークが大きく重なっている場合、1つの初期値からの leastsq は局所解に落ちやすい。
+ここでは探索範囲 (search_box) の中で
+    'lhs' : ラテン超方格で選んだ多数の初期値から短い局所フィットを並列に行う
+    'de'  : 差分進化 (scipy.optimize.differential_evolution) でχ^2 を最小化する
+のどちらかで候補を探し、最良の候補から fit_engine.fit で仕上げる。
+候補の計算はプロセスプールで並列に行い、cancel (threading.Event など is_set() を持つもの) と
+経過時間の上限 (time_budget [s]) でいつでも打ち切れる。仕上げも残りの時間と cancel で打ち切るので、
+探索を打ち切った場合はそれまでの最良の候補の値をそのまま返す (仕上げの FitResult.stopped が入る)。
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from scipy.optimize import differential_evolution
+from scipy.stats import qmc
+
+import fit_engine
+
+METHODS = ('lhs', 'de')
+# 'lhs' の初期値の数
+N_STARTS = 32
+# 各候補の局所フィットの関数評価の上限 (可変パラメータ数+1 の倍数)
+START_NFEV_FACTOR = 100
+# 'de' の世代数の上限と集団の大きさ (可変パラメータ数の倍数)
+DE_MAXITER = 200
+DE_POPSIZE = 10
+# 経過時間の上限 [s]
+TIME_BUDGET = 30.0
+
+# ワーカープロセスごとに一度だけ作るモデルとデータ
+_worker = {}
+
+
+class SearchResult:
+    """大域探索の結果
+
+    result : 仕上げのフィットの FitResult (仕上げを打ち切った場合は result.stopped が入る)
+    n_candidates, n_done : 候補の数と計算を終えた数 ('de' では評価した個体の数)
+    stopped : 途中で打ち切った理由 (None, 'cancelled', 'time')
+    """
+
+    def __init__(self, result, n_candidates, n_done, stopped, elapsed):
+        self.result = result
+        self.n_candidates = n_candidates
+        self.n_done = n_done
+        self.stopped = stopped
+        self.elapsed = elapsed
+
+
+def search_box(compiled, x, y):
+    """可変パラメータの探索範囲 (lower, upper) を全パラメータのベクトルで返す (固定パラメータは lower = upper)
+
+    center はデータの x の範囲、FWHM は点の間隔からデータ範囲の半分、area は0からデータの面積の2倍、
+    ratio は 0-1、バックグラウンドの定数は y の範囲。その他は初期値のまま。初期値が範囲外なら範囲を広げる。
+    """
+    values = compiled.values
+    lower, upper = values.copy(), values.copy()
+    x_min, x_max = float(np.min(x)), float(np.max(x))
+    spacing = float(np.min(np.diff(np.unique(x)))) if len(np.unique(x)) > 1 else 1.0
+    x_sorted, y_sorted = x[np.argsort(x)], np.abs(y[np.argsort(x)] - np.min(y))
+    # 台形公式でのデータの面積
+    total_area = float(np.sum(0.5 * (y_sorted[1:] + y_sorted[:-1]) * np.diff(x_sorted)))
+    ranges = {
+        'center': (x_min, x_max),
+        'G_FWHM': (spacing, max(spacing, (x_max - x_min) / 2)),
+        'L_FWHM': (spacing, max(spacing, (x_max - x_min) / 2)),
+        'area': (0.0, max(2 * total_area, 1e-12)),
+        'ratio': (0.0, 1.0),
+        'bg_a': (float(np.min(y)), float(np.max(y))),
+    }
+    for i in compiled.free:
+        field = compiled.names[i] if compiled.names[i] in fit_engine.BG_NAMES else compiled.names[i].rsplit('_', 1)[0]
+        if field in ranges:
+            low, high = ranges[field]
+            lower[i] = min(low, values[i])
+            upper[i] = max(high, values[i])
+    return lower, upper
+
+
+def latin_hypercube_starts(compiled, lower, upper, n, seed=None):
+    """探索範囲からラテン超方格で n 個の初期値を選ぶ (1つ目はテンプレートの初期値)"""
+    free = compiled.free
+    starts = np.tile(compiled.values, (n, 1))
+    if n > 1 and len(free):
+        sample = qmc.LatinHypercube(d=len(free), seed=seed).random(n - 1)
+        starts[1:, free] = lower[free] + sample * (upper[free] - lower[free])
+    return starts
+
+
+def _init_worker(spec, x, y, y_err, max_nfev, voigt_backend, voigt_rtol):
+    """ワーカープロセスの初期化"""
+    _worker['compiled'] = fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol)
+    _worker['data'] = (x, y, y_err)
+    _worker['compiled'].fold(x)
+    _worker['max_nfev'] = max_nfev
+
+
+def _fit_candidate(start):
+    """初期値 start から短い局所フィットを行い (χ^2, 最良のパラメータ) を返す"""
+    compiled = _worker['compiled']
+    try:
+        result = fit_engine.fit(compiled, *_worker['data'], max_nfev=_worker['max_nfev'], start=start)
+    except ValueError:
+        return np.inf, start
+    return result.chisqr, result.best_values
+
+
+def _chi2(free_values):
+    """可変パラメータの値からχ^2 を計算する (差分進化の目的関数)"""
+    compiled = _worker['compiled']
+    with np.errstate(all='ignore'):
+        resid = compiled.residual(compiled.full_vector(free_values), *_worker['data'])
+    chi2 = float(resid @ resid)
+    return chi2 if np.isfinite(chi2) else np.inf
+
+
+def search(spec, x, y, y_err, method='lhs', n_starts=N_STARTS, time_budget=TIME_BUDGET, workers=None,
+           seed=None, cancel=None, progress=None, voigt_backend=None, voigt_rtol=None):
+    """大域探索の後、最良の候補から局所フィットで仕上げて SearchResult を返す
+
+    progress(n_done, n_candidates, best_chisqr) は候補が終わるたびに呼び出し元のスレッドで呼ぶ。
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown search method: {method} (choose from {', '.join(METHODS)})")
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+    compiled = fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol)
+    free = compiled.free
+    lower, upper = search_box(compiled, x, y)
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
+    deadline = start_time + time_budget if time_budget else np.inf
+    initargs = (spec, x, y, y_err, START_NFEV_FACTOR * (len(free) + 1), voigt_backend, voigt_rtol)
+
+    def stop_reason():
+        if cancel is not None and cancel.is_set():
+            return 'cancelled'
+        if time.perf_counter() > deadline:
+            return 'time'
+        return None
+
+    best = [np.inf, compiled.values.copy()]
+    stopped = None
+    n_done = 0
+
+    def record(chi2, values):
+        nonlocal n_done
+        n_done += 1
+        if chi2 < best[0]:
+            best[0], best[1] = chi2, values
+        if progress is not None:
+            progress(n_done, n_candidates, best[0])
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) \
+        if workers > 1 else None
+    if executor is None:
+        _init_worker(*initargs)
+    try:
+        if method == 'lhs':
+            starts = latin_hypercube_starts(compiled, lower, upper, max(1, n_starts), seed)
+            n_candidates = len(starts)
+            if executor is None:
+                for start in starts:
+                    stopped = stop_reason()
+                    if stopped:
+                        break
+                    record(*_fit_candidate(start))
+            else:
+                pending = {executor.submit(_fit_candidate, start) for start in starts}
+                while pending:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record(*future.result())
+                    stopped = stop_reason() if pending else None
+                    if stopped:
+                        for future in pending:
+                            future.cancel()
+                        break
+        else:
+            popsize = DE_POPSIZE
+            n_candidates = DE_MAXITER * popsize * max(1, len(free))
+
+            def parallel_map(func, iterable):
+                # 個体ごとに送るとプロセス間通信が律速になるのでワーカー数で分ける
+                items = list(iterable)
+                return executor.map(func, items, chunksize=max(1, -(-len(items) // workers)))
+
+            def callback(intermediate_result):
+                nonlocal n_done
+                n_done = intermediate_result.nfev
+                values = compiled.full_vector(intermediate_result.x)
+                if intermediate_result.fun < best[0]:
+                    best[0], best[1] = intermediate_result.fun, values
+                if progress is not None:
+                    progress(n_done, n_candidates, best[0])
+                nonlocal stopped
+                stopped = stop_reason()
+                if stopped:
+                    # 差分進化はその時点の最良の個体を返して終わる
+                    raise StopIteration
+
+            if len(free):
+                de = differential_evolution(
+                    _chi2, list(zip(lower[free], upper[free])), maxiter=DE_MAXITER, popsize=popsize,
+                    seed=seed, init='latinhypercube', polish=False, updating='deferred',
+                    workers=parallel_map if executor is not None else 1, callback=callback,
+                    x0=np.clip(compiled.values[free], lower[free], upper[free]))
+                n_done = de.nfev
+                if de.fun < best[0]:
+                    best[0], best[1] = de.fun, compiled.full_vector(de.x)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # 最良の候補から仕上げる (全体の時間の上限の残りと cancel で打ち切る)
+    remaining = max(0.0, deadline - time.perf_counter()) if np.isfinite(deadline) else None
+    result = fit_engine.fit(compiled, x, y, y_err, start=best[1], time_budget=remaining, cancel=cancel)
+    return SearchResult(result, n_candidates, n_done, stopped, time.perf_counter() - start_time)
@@ -0,0 +1,200 @@
+"""ピークの自動検出とフィットの初期値の推定
+
+バックグラウンド (両端を結ぶ直線) を引いたデータから scipy.signal.find_peaks の
+prominence (周りからの突出量) でピークを探し、ピーク高さ・半値全幅から
+center, area, FWHM を推定する。ノイズの多いデータでは method='cwt' (ウェーブレット) も使える。
+点数が多い場合は平均して MAX_POINTS 点以下にしてから探すので、10^5 点でも数 ms で終わり、
+ファイルを読み込むたびに実行できる。
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy.signal import find_peaks, find_peaks_cwt, peak_prominences, peak_widths, savgol_filter
+
+import fit_engine
+
+METHODS = ('prominence', 'cwt')
+# ノイズの標準偏差の何倍の突出量をピークとみなすか
+MIN_SNR = 5.0
+# ウェーブレット (find_peaks_cwt) の信号雑音比の閾値
+CWT_MIN_SNR = 2.0
+# 平滑化 (Savitzky-Golay, 2次) の窓の点数
+SMOOTH_WINDOW = 5
+# 点数がこれより多い場合は隣り合う点を平均して減らしてから探す (速度とノイズ対策)
+MAX_POINTS = 2000
+# バックグラウンドの推定に使う両端のデータの割合
+EDGE_FRACTION = 0.05
+
+# 面積 / (高さ × FWHM)
+GAUSS_AREA_FACTOR = np.sqrt(np.pi / (4 * np.log(2)))
+LORENTZ_AREA_FACTOR = np.pi / 2
+# G_FWHM = L_FWHM = f の Voigt 関数の FWHM は約 1.638 f (Olivero の近似式)
+VOIGT_WIDTH_FACTOR = 0.5346 + np.sqrt(0.2166 + 1)
+
+# center, height (バックグラウンドからの高さ), fwhm, prominence は x, y の単位
+Peak = namedtuple('Peak', ['center', 'height', 'fwhm', 'prominence'])
+
+
+def estimate_noise(y):
+    """隣り合う点の差の中央絶対偏差からノイズの標準偏差を推定する"""
+    if len(y) < 3:
+        return 0.0
+    diff = np.diff(y)
+    return float(np.median(np.abs(diff - np.median(diff))) / 0.6745 / np.sqrt(2))
+
+
+def estimate_background(x, y):
+    """両端のデータの中央値を結ぶ直線 (a + b x) の (a, b) を返す"""
+    n = max(3, int(len(x) * EDGE_FRACTION))
+    x0, y0 = np.median(x[:n]), np.median(y[:n])
+    x1, y1 = np.median(x[-n:]), np.median(y[-n:])
+    b = (y1 - y0) / (x1 - x0) if x1 != x0 else 0.0
+    return float(y0 - b * x0), float(b)
+
+
+def _bin(x, y, max_points):
+    """max_points 点以下になるように隣り合う点を平均する"""
+    k = -(-len(x) // max_points)
+    if k <= 1:
+        return x, y
+    m = len(x) // k
+    return x[:m * k].reshape(m, k).mean(axis=1), y[:m * k].reshape(m, k).mean(axis=1)
+
+
+def detect_peaks(x, y, max_peaks=10, method='prominence', min_snr=None, smooth_window=SMOOTH_WINDOW,
+                 max_points=MAX_POINTS):
+    """ピークを検出して (Peak のリスト (center の順), バックグラウンドの (a, b)) を返す
+
+    method='prominence' は平滑化したデータの突出量がノイズの min_snr 倍 (既定 MIN_SNR) 以上の極大、
+    method='cwt' はウェーブレット変換の尾根線 (信号雑音比 min_snr, 既定 CWT_MIN_SNR) をピークとする。
+    max_peaks 個より多く見つかった場合は prominence の大きいものから選ぶ。
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown peak detection method: {method} (choose from {', '.join(METHODS)})")
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = x[valid], y[valid]
+    if np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+    if len(x) < 5:
+        return [], (float(np.mean(y)) if len(y) else 0.0, 0.0)
+
+    bg = estimate_background(x, y)
+    x, y = _bin(x, y, max_points)
+    signal = y - (bg[0] + bg[1] * x)
+    window = min(smooth_window, len(x) - (1 - len(x) % 2))
+    smoothed = savgol_filter(signal, window, 2) if window >= 5 else signal
+    noise = estimate_noise(signal)
+
+    if method == 'prominence':
+        min_snr = MIN_SNR if min_snr is None else min_snr
+        indices, properties = find_peaks(smoothed, prominence=max(min_snr * noise, np.finfo(float).tiny))
+        prominences = properties['prominences']
+    else:
+        min_snr = CWT_MIN_SNR if min_snr is None else min_snr
+        widths = np.arange(1, max(2, len(x) // 20))
+        indices = np.asarray(find_peaks_cwt(signal, widths, min_snr=min_snr), dtype=int)
+        # 尾根線の位置を平滑化したデータの極大に合わせる
+        if len(indices):
+            candidates = find_peaks(smoothed)[0]
+            if len(candidates):
+                nearest = np.searchsorted(candidates, indices).clip(1, len(candidates) - 1)
+                left_closer = indices - candidates[nearest - 1] < candidates[nearest] - indices
+                indices = np.unique(np.where(left_closer, candidates[nearest - 1], candidates[nearest]))
+        prominences = peak_prominences(smoothed, indices)[0] if len(indices) else np.empty(0)
+    keep = (prominences > 0) & (smoothed[indices] > 0)
+    indices, prominences = indices[keep], prominences[keep]
+    if len(indices) == 0:
+        return [], bg
+
+    # 突出量の大きい順に max_peaks 個
+    strongest = np.argsort(prominences)[::-1][:max_peaks]
+    indices, prominences = indices[strongest], prominences[strongest]
+    heights = smoothed[indices]
+
+    # 半値での幅。重なったピークでは反対側に広がるので、狭い側の半値半幅の2倍を FWHM とする
+    grid = np.arange(len(x))
+    bases = (np.zeros(len(indices), dtype=np.intp), np.full(len(indices), len(x) - 1, dtype=np.intp))
+    left, right = peak_widths(smoothed, indices, rel_height=0.5, prominence_data=(heights,) + bases)[2:]
+    x_peak = x[indices]
+    fwhm = 2 * np.minimum(x_peak - np.interp(left, grid, x), np.interp(right, grid, x) - x_peak)
+    # 1点より狭い場合は点の間隔にする
+    spacing = (x[-1] - x[0]) / (len(x) - 1)
+    fwhm = np.maximum(fwhm, spacing)
+
+    # 頂点の位置を前後の点を通る放物線で補正
+    i = np.clip(indices, 1, len(x) - 2)
+    y_l, y_c, y_r = smoothed[i - 1], smoothed[i], smoothed[i + 1]
+    curvature = y_l - 2 * y_c + y_r
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(curvature < 0, 0.5 * (y_l - y_r) / curvature, 0.0)
+    center = np.interp(i + np.clip(shift, -0.5, 0.5), grid, x)
+
+    peaks = [Peak(float(c), float(h), float(w), float(p))
+             for c, h, w, p in zip(center, heights, fwhm, prominences)]
+    return sorted(peaks, key=lambda peak: peak.center), bg
+
+
+def peak_values(peak, kind, ratio=0.5):
+    """検出したピークから kind のピーク関数の初期値 {'area': .., 'center': .., 'G_FWHM': .., 'L_FWHM': ..} を作る"""
+    if kind == fit_engine.GAUSSIAN:
+        return {'center': peak.center, 'area': peak.height * peak.fwhm * GAUSS_AREA_FACTOR,
+                'G_FWHM': peak.fwhm, 'L_FWHM': peak.fwhm}
+    if kind == fit_engine.LORENTZIAN:
+        return {'center': peak.center, 'area': peak.height * peak.fwhm * LORENTZ_AREA_FACTOR,
+                'G_FWHM': peak.fwhm, 'L_FWHM': peak.fwhm}
+    if kind == fit_engine.VOIGT:
+        width = peak.fwhm / VOIGT_WIDTH_FACTOR
+        factor = 0.5 * (GAUSS_AREA_FACTOR + LORENTZ_AREA_FACTOR)
+        return {'center': peak.center, 'area': peak.height * peak.fwhm * factor, 'G_FWHM': width, 'L_FWHM': width}
+    # 擬 Voigt 関数は ratio で面積の係数を混ぜる
+    ratio = min(max(ratio, 0.0), 1.0)
+    factor = ratio * GAUSS_AREA_FACTOR + (1 - ratio) * LORENTZ_AREA_FACTOR
+    return {'center': peak.center, 'area': peak.height * peak.fwhm * factor, 'G_FWHM': peak.fwhm, 'L_FWHM': peak.fwhm}
+
+
+def _match(template_centers, detected_centers):
+    """テンプレートのピークと検出したピークの対応 {テンプレートの番号: 検出の番号} を作る"""
+    if len(template_centers) == len(detected_centers):
+        # 数が同じなら center の順に対応させる
+        return dict(zip(np.argsort(template_centers), np.argsort(detected_centers)))
+    pairs = {}
+    free = list(range(len(template_centers)))
+    for j, c in enumerate(detected_centers):
+        if not free:
+            break
+        k = min(free, key=lambda k: abs(template_centers[k] - c))
+        pairs[k] = j
+        free.remove(k)
+    return pairs
+
+
+def seed_spec(spec, x, y, method='prominence', min_snr=None):
+    """検出したピークで spec の可変パラメータ (バックグラウンドの定数・1次、ピークの center, area, FWHM) の初期値を置き換える
+
+    ピークの数と種類 (ratio) はテンプレートのまま。固定パラメータと、対応するピークが見つからなかった
+    ピークはテンプレートの値を使う。
+    """
+    peaks, (a, b) = detect_peaks(x, y, len(spec.peaks), method, min_snr)
+    bg_values = list(spec.bg_values)
+    for k, value in ((0, a), (1, b)):
+        if not spec.bg_fixed[k]:
+            bg_values[k] = value
+
+    i_center = fit_engine.PEAK_FIELDS.index('center')
+    template_centers = [p.values[i_center] for p in spec.peaks]
+    pairs = _match(template_centers, [p.center for p in peaks])
+    new_peaks = list(spec.peaks)
+    for k, j in pairs.items():
+        template = spec.peaks[k]
+        ratio = template.values[fit_engine.PEAK_FIELDS.index('ratio')]
+        seeded = peak_values(peaks[j], template.kind, ratio)
+        values = list(template.values)
+        for field, value in seeded.items():
+            i = fit_engine.PEAK_FIELDS.index(field)
+            if template.fixed[i] is False:
+                values[i] = value
+        new_peaks[k] = template._replace(values=tuple(values))
+    return spec._replace(bg_values=tuple(bg_values), peaks=tuple(new_peaks))
@@ -0,0 +1,35 @@
+"""フィットの解法の選択
+
+    'leastsq' : 全可変パラメータを leastsq (MINPACK) で動かす (fit_engine.fit、従来通り)
+    'varpro'  : 線形パラメータ (バックグラウンドの係数と面積) を線形最小二乗で解き、
+                非線形パラメータだけを leastsq で動かす (varpro.fit)
+    'sparse'  : ピークの計算範囲から作った疎なヤコビアンで信頼領域法 (least_squares) を使う。
+                離れたピークが多数ある場合に速い (sparse_fit.fit)
+    'clusters': 重ならないピークの組ごとに並列にフィットしてから、全範囲で仕上げる (clusters.fit)
+    'trf'     : 範囲付き信頼領域法。ロバストな損失関数 (loss) で外れ値の影響を抑えられる (trf_fit.fit)
+
+どの解法も fit(spec, x, y, y_err, max_nfev=None, voigt_backend=None, voigt_rtol=None, start=None, window_rtol=None,
+bg_basis=None)
+の形で呼び出せて FitResult を返す。解法に固有の引数 (trf_fit.fit の loss など) はその解法にだけ渡す。
+"""
+import clusters
+import fit_engine
+import sparse_fit
+import trf_fit
+import varpro
+
+SOLVERS = {
+    'leastsq': fit_engine.fit,
+    'varpro': varpro.fit,
+    'sparse': sparse_fit.fit,
+    'clusters': clusters.fit,
+    'trf': trf_fit.fit,
+}
+DEFAULT_SOLVER = 'leastsq'
+
+
+def fit(spec, x, y, y_err, solver=DEFAULT_SOLVER, **kwargs):
+    """solver で選んだ解法でフィットして FitResult を返す"""
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver: {solver} (choose from {', '.join(SOLVERS)})")
+    return SOLVERS[solver](spec, x, y, y_err, **kwargs)
@@ -0,0 +1,168 @@
+"""疎なヤコビアンによる信頼領域法のフィット
+
+ピークが多い場合、各ピークのパラメータはそのピークの近く (CompiledModel.support_windows の計算範囲) の
+残差にしか効かないので、ヤコビアン (データ数 × 可変パラメータ数) はほとんど0になる。
+leastsq (MINPACK) は密な行列を QR 分解するので、1回の反復にデータ数 × 可変パラメータ数の2乗に比例した
+時間がかかる。ここでは偏微分を計算範囲だけで計算して疎行列 (scipy.sparse) にし、
+scipy.optimize.least_squares の信頼領域法 ('trf'、部分問題は LSMR) で解く。
+面積・FWHM >= 0 は変数変換せずに範囲 (bounds) としてそのまま渡す。
+
+計算範囲は CompiledModel の window_rtol (指定がなければ fit_engine.WINDOW_RTOL) で決める。
+範囲の外の偏微分 (ローレンチアンの裾) は0とみなすのでヤコビアンは近似になるが、残差 (モデル) は
+CompiledModel の設定通りに計算するので最適値は変わらない。モデルの計算も速くするには window_rtol を指定する。
+計算範囲を求めるために x は昇順に並べ替えて使う (残差は元の順番で返す)。
+共分散行列は最適値での疎なヤコビアン J から (J^T J)^-1 × 換算χ^2 で求める。
+"""
+import numpy as np
+from scipy import sparse
+from scipy.optimize import least_squares
+
+import fit_engine
+
+
+def sparse_jacobian(compiled, p, x, y_err, rtol, basis=None):
+    """可変パラメータについての残差の偏微分を疎行列 (データ数 × 可変パラメータ数、CSR) で返す
+
+    x は昇順。basis (fit_engine.ChebyshevBasis) を指定すると、バックグラウンドの低次の項の列は
+    チェビシェフ多項式の係数での偏微分にする。
+    """
+    free = compiled.free
+    columns = np.full(len(compiled.names), -1)
+    columns[free] = np.arange(len(free))
+    rows, cols, values = [], [], []
+    everywhere = np.arange(len(x))
+    # バックグラウンドは全データに効く
+    if basis is not None:
+        for k, row in enumerate(basis.vander(x)):
+            rows.append(everywhere)
+            cols.append(np.full(len(x), k))
+            values.append(row)
+    else:
+        for k in range(len(fit_engine.BG_NAMES)):
+            if columns[k] >= 0:
+                rows.append(everywhere)
+                cols.append(np.full(len(x), columns[k]))
+                values.append(x**k)
+    for k, (lo, hi) in enumerate(zip(*compiled.support_windows(p, x, rtol=rtol)[:2])):
+        if lo >= hi:
+            continue
+        for i, deriv in compiled.window_derivs(p, x[lo:hi], k):
+            if columns[i] >= 0:
+                rows.append(everywhere[lo:hi])
+                cols.append(np.full(hi - lo, columns[i]))
+                values.append(deriv)
+    if rows:
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        values = -np.concatenate(values) / y_err[rows]
+    else:
+        rows = cols = np.empty(0, dtype=int)
+        values = np.empty(0)
+    return sparse.csr_matrix((values, (rows, cols)), shape=(len(x), len(free)))
+
+
+def fit(spec, x, y, y_err, max_nfev=None, analytic_jacobian=True, voigt_backend=None, voigt_rtol=None,
+        start=None, window_rtol=None, bg_basis=None, time_budget=None, cancel=None):
+    """疎なヤコビアンの信頼領域法で ModelSpec を x, y, y_err にフィットして FitResult を返す
+
+    引数は fit_engine.fit と同じ。analytic_jacobian が False の場合は、初期値での計算範囲から作った
+    疎な形 (jac_sparsity) を使って差分近似で求める (フィット中にピークが計算範囲を超えて動くと不正確になる)。
+    """
+    compiled = spec if isinstance(spec, fit_engine.CompiledModel) else \
+        fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    x_in = np.asarray(x, dtype=float)
+    order = np.argsort(x_in, kind='stable')
+    x = x_in[order]
+    y_in = np.asarray(y, dtype=float)
+    y_err_in = np.asarray(y_err, dtype=float)
+    y = y_in[order]
+    y_err = y_err_in[order]
+    compiled.fold(x)
+    free = compiled.free
+    if start is None:
+        start = compiled.values
+    else:
+        start = compiled.full_vector(np.clip(np.asarray(start, dtype=float)[free], compiled.lower[free], compiled.upper[free]))
+    rtol = compiled.window_rtol or fit_engine.WINDOW_RTOL
+    # チェビシェフ多項式のバックグラウンドでは free の先頭 n_bg 個をその係数にする (fit_engine.fit と同じ)
+    basis = compiled.background_basis(x)
+    n_bg = 0 if basis is None else basis.size
+    budget = fit_engine.FitBudget(time_budget, cancel)
+    n_calls = [0]
+
+    def external(q):
+        p = compiled.full_vector(q)
+        if basis is not None:
+            p[:n_bg] = basis.to_monomial @ q[:n_bg]
+        return p
+
+    def func(q):
+        n_calls[0] += 1
+        p = external(q)
+        if basis is None:
+            resid = compiled.residual(p, x, y, y_err)
+        else:
+            p[:n_bg] = 0.0
+            resid = (y - compiled.evaluate(p, x) - basis.evaluate(q[:n_bg], x)) / y_err
+        if not np.all(np.isfinite(resid)):
+            raise ValueError("NaN values detected in the data or the model function.")
+        budget.check(q, resid)
+        return resid
+
+    def jac(q):
+        return sparse_jacobian(compiled, external(q), x, y_err, rtol, basis)
+
+    if max_nfev is None:
+        max_nfev = 2000 * (len(free) + 1)
+
+    q0 = start[free].copy()
+    if basis is not None:
+        q0[:n_bg] = basis.from_monomial(start[:n_bg])
+    stopped = None
+    with np.errstate(all='ignore'):
+        if len(free) == 0:
+            best_q, status, nfev, errmsg = q0, 1, 1, ''
+        else:
+            options = {}
+            if not analytic_jacobian:
+                pattern = jac(q0)
+                pattern.data[:] = 1.0
+                options = {'jac_sparsity': pattern}
+            try:
+                solution = least_squares(func, q0, jac=jac if analytic_jacobian else '2-point',
+                                         bounds=(compiled.lower[free], compiled.upper[free]), method='trf',
+                                         x_scale='jac', tr_solver='lsmr', ftol=1.5e-8, xtol=1.5e-8, gtol=None,
+                                         max_nfev=max_nfev, **options)
+                best_q, status, nfev, errmsg = solution.x, solution.status, solution.nfev, solution.message
+            except fit_engine.FitStopped as stop:
+                stopped = stop.reason
+                best_q = q0 if budget.best is None else budget.best
+                status, nfev, errmsg = -1, n_calls[0], budget.message(stopped)
+        best = external(best_q)
+        resid = compiled.residual(best, x_in, y_in, y_err_in)
+
+    success = status > 0
+    if success:
+        message = 'Fit succeeded.'
+    elif status == 0:
+        stopped = 'nfev'
+        message = f'Fit aborted: number of function evaluations > {max_nfev}.'
+    else:
+        message = errmsg
+
+    covar = None
+    if len(free) and stopped not in ('time', 'cancelled'):
+        jacobian = jac(best_q)
+        try:
+            cov_q = np.linalg.inv((jacobian.T @ jacobian).toarray())
+        except np.linalg.LinAlgError:
+            cov_q = None
+        if cov_q is not None and np.all(np.isfinite(cov_q)):
+            nfree = max(1, len(resid) - len(free))
+            if basis is not None:
+                # チェビシェフ多項式の係数の部分は a = to_monomial @ c で変換する
+                transform = np.eye(len(free))
+                transform[:n_bg, :n_bg] = basis.to_monomial
+                cov_q = transform @ cov_q @ transform.T
+            covar = cov_q * ((resid**2).sum() / nfree)
+    return fit_engine.FitResult(compiled, best, resid, covar, nfev, success, message, start, stopped)
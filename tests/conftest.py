@@ -0,0 +1,32 @@
+"""テストの共通部分 (モジュールはリポジトリの直下にあるので、そこを import できるようにする)"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fit_engine  # noqa: E402
+
+# 3つのピーク (ガウシアン、ローレンチアン、フォークト) と1次のバックグラウンドの合成データ
+TRUE_BG = ('5', '0.02', '0f', '0f', '0f')
+TRUE_PEAKS = [(1, ['1f', '120', '-20', '3', '3']),
+              (2, ['0f', '80', '0', '3', '4']),
+              (3, ['-1f', '60', '25', '4', '3'])]
+START_PEAKS = [(1, ['1f', '100', '-19', '4', '4']),
+               (2, ['0f', '100', '1', '4', '4']),
+               (3, ['-1f', '50', '24', '4', '4'])]
+
+
+@pytest.fixture
+def three_peaks():
+    """(初期値の ModelSpec, x, y, y_err)。y は真の値にポアソン雑音 (seed 固定) を加えたもの"""
+    x = np.linspace(-50, 50, 801)
+    truth = fit_engine.CompiledModel(fit_engine.spec_from_entries(TRUE_BG, TRUE_PEAKS))
+    model = truth.evaluate(truth.values, x)
+    rng = np.random.default_rng(0)
+    y = rng.poisson(model * 20) / 20
+    y_err = np.sqrt(np.maximum(y, 1) / 20)
+    spec = fit_engine.spec_from_entries(('4', '0', '0f', '0f', '0f'), START_PEAKS)
+    return spec, x, y, y_err
@@ -0,0 +1,54 @@
+import numpy as np
+
+import fit_engine
+
+
+def test_basis_conversion():
+    basis = fit_engine.ChebyshevBasis(10.0, 90.0, 4)
+    a = np.array([3.0, -0.2, 4e-3, -2e-5])
+    c = basis.from_monomial(a)
+    np.testing.assert_allclose(basis.to_monomial @ c, a, rtol=1e-10)
+    x = np.linspace(10, 90, 201)
+    np.testing.assert_allclose(basis.evaluate(c, x), np.polynomial.polynomial.polyval(x, a), rtol=1e-10)
+    np.testing.assert_allclose(c @ basis.vander(x), basis.evaluate(c, x), rtol=1e-10)
+
+
+def test_background_basis_needs_leading_terms():
+    spec = fit_engine.spec_from_entries(('1', '0', '0f', '0f', '0f'), [])
+    x = np.linspace(0, 1, 11)
+    assert fit_engine.CompiledModel(spec, bg_basis=fit_engine.CHEBYSHEV).background_basis(x).size == 2
+    assert fit_engine.CompiledModel(spec).background_basis(x) is None
+    # 可変の項が bg_a から続かない場合は x のべきのまま
+    gap = fit_engine.spec_from_entries(('1', '0f', '0', '0f', '0f'), [])
+    assert fit_engine.CompiledModel(gap, bg_basis=fit_engine.CHEBYSHEV).background_basis(x) is None
+
+
+def test_chebyshev_matches_monomial(three_peaks):
+    spec, x, y, y_err = three_peaks
+    # 2次のバックグラウンドも動かす
+    spec = spec._replace(bg_fixed=(False, False, False, True, True))
+    monomial = fit_engine.fit(spec, x, y, y_err)
+    chebyshev = fit_engine.fit(spec, x, y, y_err, bg_basis=fit_engine.CHEBYSHEV)
+    assert monomial.success and chebyshev.success
+    free = monomial.compiled.free
+    np.testing.assert_allclose(chebyshev.chisqr, monomial.chisqr, rtol=1e-9)
+    # 最適値の差は誤差に比べて十分小さい
+    assert np.all(np.abs(chebyshev.best_values[free] - monomial.best_values[free]) <= 1e-4 * monomial.stderr[free])
+    np.testing.assert_allclose(chebyshev.stderr[free], monomial.stderr[free], rtol=1e-3)
+
+
+def test_chebyshev_for_shifted_x(three_peaks):
+    # x が大きい (x のべきの列の大きさがそろわない) 場合も同じ最適値になる
+    spec, x, y, y_err = three_peaks
+    shift = 1000.0
+    spec = spec._replace(bg_fixed=(False, False, False, True, True),
+                         peaks=tuple(peak._replace(values=(peak.values[0], peak.values[1], peak.values[2] + shift)
+                                                   + peak.values[3:]) for peak in spec.peaks))
+    monomial = fit_engine.fit(spec, x + shift, y, y_err)
+    chebyshev = fit_engine.fit(spec, x + shift, y, y_err, bg_basis=fit_engine.CHEBYSHEV)
+    assert chebyshev.success and chebyshev.stderr is not None
+    assert chebyshev.chisqr <= monomial.chisqr * (1 + 1e-9)
+    # バックグラウンドの値 (係数ではなく) は一致する
+    bg = slice(0, len(fit_engine.BG_NAMES))
+    np.testing.assert_allclose(np.polynomial.polynomial.polyval(x + shift, chebyshev.best_values[bg]),
+                               np.polynomial.polynomial.polyval(x + shift, monomial.best_values[bg]), rtol=1e-4)
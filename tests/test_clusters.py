@@ -0,0 +1,120 @@
+import threading
+
+import numpy as np
+import pytest
+
+import clusters
+import fit_engine
+import solvers
+
+# 離れた4つのクラスタ (2つ目は重なった2つのピーク) と1次のバックグラウンドの合成データ
+TRUE_PEAKS = [(1, ['1f', '50', '50', '3', '3']),
+              (2, ['0f', '40', '150', '3', '4']),
+              (3, ['1f', '30', '158', '3', '3']),
+              (4, ['-1f', '60', '250', '4', '3']),
+              (5, ['1f', '50', '350', '3', '3'])]
+START_PEAKS = [(1, ['1f', '40', '51', '4', '4']),
+               (2, ['0f', '50', '149', '4', '4']),
+               (3, ['1f', '25', '159', '4', '4']),
+               (4, ['-1f', '50', '249', '4', '4']),
+               (5, ['1f', '40', '351', '4', '4'])]
+
+
+@pytest.fixture
+def separated_peaks():
+    """(初期値の ModelSpec, x, y, y_err)。y は真の値に正規雑音 (seed 固定) を加えたもの"""
+    x = np.linspace(0, 400, 1601)
+    truth = fit_engine.CompiledModel(fit_engine.spec_from_entries(('5', '0.01', '0f', '0f', '0f'), TRUE_PEAKS))
+    rng = np.random.default_rng(1)
+    y = truth.evaluate(truth.values, x) + rng.normal(0, 0.3, len(x))
+    y_err = np.full(len(x), 0.3)
+    spec = fit_engine.spec_from_entries(('4', '0', '0f', '0f', '0f'), START_PEAKS)
+    return spec, x, y, y_err
+
+
+def assert_same_optimum(result, reference):
+    free = reference.compiled.free
+    assert result.success and result.stderr is not None
+    np.testing.assert_allclose(result.chisqr, reference.chisqr, rtol=1e-6)
+    assert np.all(np.abs(result.best_values[free] - reference.best_values[free]) <= 1e-2 * reference.stderr[free])
+    np.testing.assert_allclose(result.stderr[free], reference.stderr[free], rtol=1e-2)
+
+
+def test_partition_groups_overlapping_peaks(separated_peaks):
+    spec = separated_peaks[0]
+    compiled = fit_engine.CompiledModel(spec)
+    parts = clusters.partition(compiled, compiled.values)
+    assert [positions for positions, _, _ in parts] == [[0], [1, 2], [3], [4]]
+    assert all(hi < next_lo for (_, _, hi), (_, next_lo, _) in zip(parts[:-1], parts[1:]))
+    # 範囲を狭くすると重なったピークも分かれ、広くすると全部1つになる
+    assert len(clusters.partition(compiled, compiled.values, widths=0.5)) == 5
+    assert [positions for positions, _, _ in clusters.partition(compiled, compiled.values, widths=20)] == \
+        [[0, 1, 2, 3, 4]]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_clusters_match_leastsq(separated_peaks, workers):
+    spec, x, y, y_err = separated_peaks
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq')
+    result = solvers.fit(spec, x, y, y_err, solver='clusters', workers=workers)
+    assert_same_optimum(result, reference)
+
+
+def test_clusters_with_fixed_background(separated_peaks):
+    # バックグラウンドがすべて固定の場合は、局所的なバックグラウンドも固定のまま
+    _, x, y, y_err = separated_peaks
+    spec = fit_engine.spec_from_entries(('5f', '0.01f', '0f', '0f', '0f'), START_PEAKS)
+    compiled = fit_engine.CompiledModel(spec)
+    local = clusters.local_spec(compiled, compiled.values, [1, 2])
+    assert all(local.bg_fixed)
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq')
+    result = solvers.fit(spec, x, y, y_err, solver='clusters', workers=1)
+    assert_same_optimum(result, reference)
+    np.testing.assert_array_equal(result.best_values[:len(fit_engine.BG_NAMES)], [5, 0.01, 0, 0, 0])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_clusters_stop_at_time_budget_and_cancel(separated_peaks, workers):
+    spec, x, y, y_err = separated_peaks
+    result = solvers.fit(spec, x, y, y_err, solver='clusters', workers=workers, time_budget=0)
+    assert result.stopped == 'time' and not result.success and result.stderr is None
+    cancel = threading.Event()
+    cancel.set()
+    result = solvers.fit(spec, x, y, y_err, solver='clusters', workers=workers, cancel=cancel)
+    assert result.stopped == 'cancelled' and not result.success
+    # 打ち切った値も範囲内
+    compiled = result.compiled
+    free = compiled.free
+    assert np.all(result.best_values[free] >= compiled.lower[free])
+    assert np.all(result.best_values[free] <= compiled.upper[free])
+
+
+@pytest.mark.parametrize('max_nfev', [2, 5, 30, 200])
+def test_clusters_honour_max_nfev(separated_peaks, max_nfev):
+    # クラスタのフィットと仕上げを合わせた回数。MINPACK は反復の終わりで回数を確かめるので数回は超えうる
+    spec, x, y, y_err = separated_peaks
+    result = solvers.fit(spec, x, y, y_err, solver='clusters', workers=1, max_nfev=max_nfev)
+    assert result.nfev <= max_nfev + 3
+    assert result.success or result.stopped == 'nfev'
+
+
+def test_clusters_split_max_nfev(separated_peaks, monkeypatch):
+    # 各クラスタのフィットには (クラスタ数 + 1) 等分ずつを渡し、仕上げには残りを渡す
+    spec, x, y, y_err = separated_peaks
+    calls = []
+    fit = fit_engine.fit
+
+    def spy(*args, **kwargs):
+        result = fit(*args, **kwargs)
+        calls.append((kwargs.get('max_nfev'), result.nfev))
+        return result
+
+    monkeypatch.setattr(clusters.fit_engine, 'fit', spy)
+    solvers.fit(spec, x, y, y_err, solver='clusters', workers=1, max_nfev=200)
+    *fits, polish = calls
+    assert [max_nfev for max_nfev, _ in fits] == [40] * 4
+    assert polish[0] == 200 - sum(nfev for _, nfev in fits)
+    # 1つのクラスタに CLUSTER_MIN_NFEV 回ずつ回せなければ仕上げだけ
+    calls.clear()
+    solvers.fit(spec, x, y, y_err, solver='clusters', workers=1, max_nfev=30)
+    assert [max_nfev for max_nfev, _ in calls] == [30]
@@ -0,0 +1,197 @@
+import csv
+import threading
+
+import numpy as np
+import pytest
+
+import csv_loader
+
+
+def old_columns(path, columns):
+    """従来の読み込み (csv.reader で全行を読んで1セルずつ float()) と同じ値"""
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))[1:]
+    return [np.array([float(row[index]) if len(row) > index and row[index] != '' else np.nan for row in rows])
+            for index in columns]
+
+
+def write(tmp_path, text, name='data.csv'):
+    path = tmp_path / name
+    path.write_bytes(text.encode('utf-8'))
+    return path
+
+
+def assert_same_as_old(path, columns, chunk_bytes=csv_loader.CHUNK_BYTES):
+    data = csv_loader.read_columns(path, columns, chunk_bytes)
+    expected = old_columns(path, columns)
+    assert data.n_rows == len(expected[0])
+    for column, values in zip(data.columns, expected):
+        np.testing.assert_array_equal(column, values)
+    return data
+
+
+def test_plain_rows(tmp_path):
+    path = write(tmp_path, 'x,y,err\n1,2,3\n4,5e-1,-6\n7,nan,inf\n')
+    data = assert_same_as_old(path, [0, 1, 2])
+    assert data.header == ['x', 'y', 'err']
+    assert data.offset == path.stat().st_size
+
+
+def test_quoted_fields(tmp_path):
+    path = write(tmp_path, '"x, a","y"\n"1","2"\n3,"4"\n"5",\n')
+    data = assert_same_as_old(path, [0, 1])
+    assert data.header == ['x, a', 'y']
+
+
+def test_blank_cells_lines_and_ragged_rows(tmp_path):
+    # 空欄・列が足りない行・列が多い行・空行 (先頭、途中、連続、最後) は従来通り NaN の行になる
+    text = 'x,y,err\n\n1,,3\n,2,\n4\n\n\n5,6,7,8\n 9 ,10 ,11\n\n'
+    data = assert_same_as_old(write(tmp_path, text), [0, 1, 2])
+    assert data.n_rows == 9
+    # CRLF でも同じ
+    assert_same_as_old(write(tmp_path, text.replace('\n', '\r\n'), 'crlf.csv'), [0, 1, 2])
+
+
+def test_whitespace_and_text_cells_raise(tmp_path):
+    # 空白だけのセルは従来通り ValueError (読まない列にあればよい)
+    path = write(tmp_path, 'x,y,err\n1,2,3\n4,  ,6\n')
+    with pytest.raises(ValueError):
+        csv_loader.read_columns(path, [0, 1, 2])
+    assert_same_as_old(path, [0, 2])
+    with pytest.raises(ValueError):
+        csv_loader.read_columns(write(tmp_path, 'x,y\n1,abc\n', 'text.csv'), [0, 1])
+
+
+def test_header_only_and_empty(tmp_path):
+    for text in ('x,y,err\n', 'x,y,err'):
+        data = csv_loader.read_columns(write(tmp_path, text), [0, 1])
+        assert data.header == ['x', 'y', 'err']
+        assert data.n_rows == 0
+        assert [len(column) for column in data.columns] == [0, 0]
+    with pytest.raises(ValueError):
+        csv_loader.read_columns(write(tmp_path, ''), [0])
+
+
+def test_chunk_boundaries(tmp_path):
+    # どこでチャンクを切っても (行の途中、空行、最後の改行のない行) 同じ値
+    rng = np.random.default_rng(0)
+    lines = []
+    for i in range(200):
+        kind = rng.integers(6)
+        if kind == 0:
+            lines.append('')
+        elif kind == 1:
+            lines.append(f'{i},')
+        else:
+            lines.append(f'{i},{rng.normal():.6g},{rng.random():.4g}')
+    path = write(tmp_path, 'x,y,err\n' + '\n'.join(lines))
+    for chunk_bytes in (1, 2, 3, 7, 64, 1 << 20):
+        assert_same_as_old(path, [0, 1, 2], chunk_bytes)
+
+
+def test_load_xye_drops_nan_rows(tmp_path):
+    path = write(tmp_path, 'x,y,err\n1,2,0\n\n3,,1\n4,5,0.5\n')
+    data = csv_loader.load_xye(path, 0, 1, 2)
+    np.testing.assert_array_equal(data.x, [1, 4])
+    np.testing.assert_array_equal(data.y, [2, 5])
+    np.testing.assert_array_equal(data.y_error, [1, 0.5])
+    assert data.n_rows == 4
+
+
+def test_progress_and_cancel(tmp_path):
+    path = write(tmp_path, 'x,y\n' + ''.join(f'{i},{i * i}\n' for i in range(1000)))
+    size = path.stat().st_size
+    calls = []
+    data = csv_loader.read_columns(path, [0, 1], chunk_bytes=1000, progress=lambda done, total: calls.append((done, total)))
+    assert data.n_rows == 1000
+    assert len(calls) >= size // 1000
+    assert all(total == size for _, total in calls)
+    assert [done for done, _ in calls] == sorted(done for done, _ in calls)
+    assert calls[-1][0] == size
+
+    cancel = threading.Event()
+
+    def stop(done, total):
+        calls.append(done)
+        cancel.set()
+
+    calls.clear()
+    with pytest.raises(csv_loader.LoadCancelled):
+        csv_loader.read_columns(path, [0, 1], chunk_bytes=1000, progress=stop, cancel=cancel)
+    # 最初のチャンクの後で止まる
+    assert len(calls) == 1
+
+
+def test_row_index(tmp_path):
+    path = write(tmp_path, 'x,y\n' + ''.join(f'{i:03d},"{i:03d}, {i:03d}"\n' for i in range(300)) + '\n300,last')
+    index = csv_loader.RowIndex(path, chunk_bytes=256)
+    assert index.header == ['x', 'y']
+    # wait=False は索引を作らない
+    assert index.rows(0, 5, wait=False) == []
+    assert index.rows(0, 2) == [['000', '000, 000'], ['001', '001, 001']]
+    assert 0 < index.n_rows < 300 and not index.complete
+    assert index.rows(0, 1000, wait=False) == index.rows(0, index.n_rows)
+    # 同じ長さの行なので見積もりはほぼ正しい
+    assert abs(index.estimated_rows() - 302) <= 3
+    index.build()
+    assert index.complete and index.n_rows == index.estimated_rows() == 302
+    assert index.rows(299, 305, wait=False) == [['299', '299, 299'], [], ['300', 'last']]
+
+
+def append(path, text):
+    with open(path, 'ab') as f:
+        f.write(text.encode('utf-8'))
+
+
+def tail_of(path):
+    data = csv_loader.load_xye(path, 0, 1, 2)
+    return csv_loader.TailReader(path, (0, 1, 2), data.x, data.y, data.y_error, data.offset)
+
+
+def test_tail_reader_appends_complete_lines(tmp_path):
+    path = write(tmp_path, 'x,y,err\n1,10,1\n2,20,0\n')
+    tail = tail_of(path)
+    assert tail.read() == 0
+    # 改行のない行は書きかけなので、改行が書かれるまで読まない
+    append(path, '3,30,1\n4,4')
+    assert tail.read() == 1
+    np.testing.assert_array_equal(tail.x, [1, 2, 3])
+    append(path, '0,1\n\n5,,1\n6,60,2\n')
+    assert tail.read() == 4
+    # y が NaN の行 (空行も) は load_xye と同じく除き、y_error <= 1e-10 は 1
+    np.testing.assert_array_equal(tail.x, [1, 2, 3, 4, 6])
+    np.testing.assert_array_equal(tail.y, [10, 20, 30, 40, 60])
+    np.testing.assert_array_equal(tail.y_error, [1, 1, 1, 1, 2])
+    data = csv_loader.load_xye(path, 0, 1, 2)
+    np.testing.assert_array_equal(tail.y, data.y)
+
+
+def test_tail_reader_rewrites_the_pending_row(tmp_path):
+    # load_xye が改行のない最後の行 ('3,3') を読んでいた場合、改行が書かれたら読み直して置き換える
+    path = write(tmp_path, 'x,y,err\n1,10,1\n2,20,1\n3,3')
+    tail = tail_of(path)
+    np.testing.assert_array_equal(tail.y, [10, 20, 3])
+    assert tail.read() == 0
+    np.testing.assert_array_equal(tail.y, [10, 20, 3])
+    append(path, '0,1\n4,40,1\n')
+    assert tail.read() == 2
+    np.testing.assert_array_equal(tail.x, [1, 2, 3, 4])
+    np.testing.assert_array_equal(tail.y, [10, 20, 30, 40])
+    # 書きかけの行の y が空欄 (NaN で除いていた) 場合は、置き換える点はない
+    path = write(tmp_path, 'x,y,err\n1,10,1\n2,', 'blank.csv')
+    tail = tail_of(path)
+    np.testing.assert_array_equal(tail.x, [1])
+    append(path, '20,1\n')
+    assert tail.read() == 1
+    np.testing.assert_array_equal(tail.y, [10, 20])
+
+
+def test_tail_reader_grows_and_detects_truncation(tmp_path):
+    path = write(tmp_path, 'x,y,err\n')
+    tail = tail_of(path)
+    append(path, ''.join(f'{i},{2 * i},1\n' for i in range(3000)))
+    assert tail.read() == 3000
+    np.testing.assert_array_equal(tail.y, 2 * np.arange(3000))
+    write(tmp_path, 'x,y,err\n1,2,3\n')
+    with pytest.raises(ValueError):
+        tail.read()
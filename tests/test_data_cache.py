@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+
+import data_cache
+
+
+def write_csv(path, n, scale=1.0):
+    x = np.arange(n, dtype=float)
+    np.savetxt(path, np.column_stack([x, scale * x, np.ones(n)]), delimiter=',', header='x,y,err', comments='')
+
+
+def npy_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.npy'))
+
+
+def test_round_trip_and_rewrite(tmp_path):
+    path = tmp_path / 'data.csv'
+    write_csv(path, 50)
+    cache = data_cache.DataCache(tmp_path / 'cache')
+    first = data_cache.cached_load_xye(path, 0, 1, 2, cache=cache)
+    second = data_cache.cached_load_xye(path, 0, 1, 2, cache=cache)
+    assert not first.cached and second.cached
+    assert second.header == ['x', 'y', 'err'] and second.n_rows == 50
+    np.testing.assert_array_equal(second.y, first.y)
+    # 書き換えたファイルは読み直す
+    write_csv(path, 60, scale=2.0)
+    os.utime(path, ns=(0, 10**18))
+    third = data_cache.cached_load_xye(path, 0, 1, 2, cache=cache)
+    assert not third.cached and len(third.y) == 60
+
+
+def test_put_writes_a_new_npy_and_removes_the_old_one(tmp_path):
+    path = tmp_path / 'data.csv'
+    write_csv(path, 20)
+    cache = data_cache.DataCache(tmp_path / 'cache')
+    data = data_cache.cached_load_xye(path, 0, 1, 2, cache=cache)
+    key = cache.key(path, (0, 1, 2))
+    mapped = cache.get(key)
+    old = npy_files(cache.directory)
+    # メモリマップしている npy ファイルは置き換えずに別の名前で書く
+    cache.put(key, data)
+    new = npy_files(cache.directory)
+    assert len(new) == 2 and old[0] in new
+    np.testing.assert_array_equal(mapped.x, data.x)
+    # 古い npy ファイルは STALE_SECONDS を過ぎたら消す
+    stale = os.path.join(cache.directory, old[0])
+    os.utime(stale, (0, 0))
+    cache.evict()
+    assert npy_files(cache.directory) == sorted(set(new) - set(old))
+    assert cache.get(key).cached
+
+
+def test_failed_removal_is_logged_and_not_counted(tmp_path, monkeypatch, caplog):
+    cache = data_cache.DataCache(tmp_path / 'cache')
+    for n in range(3):
+        path = tmp_path / f'data{n}.csv'
+        write_csv(path, 1000)
+        data_cache.cached_load_xye(path, 0, 1, 2, cache=cache)
+    names = npy_files(cache.directory)
+    # 最後に使った時刻を names の順にする (names[0] が一番古い)
+    for n, name in enumerate(names):
+        os.utime(os.path.join(cache.directory, name), (n, n))
+    oldest = names[0]
+    size = os.path.getsize(os.path.join(cache.directory, oldest))
+    remove = os.remove
+
+    def locked(path):
+        if os.path.basename(path) == oldest:
+            raise PermissionError(13, 'The process cannot access the file', path)
+        remove(path)
+
+    monkeypatch.setattr(os, 'remove', locked)
+    # 2つ分の上限: 一番古いものを消せなくても、それを数えずに残りの2つは残す
+    cache.max_bytes = 2 * size + 1
+    with caplog.at_level('WARNING', logger='data_cache'):
+        cache.evict()
+    assert oldest in caplog.text
+    assert npy_files(cache.directory) == names
+    # 消せるようになったら (指されていない古いファイルとして) 消す
+    monkeypatch.setattr(os, 'remove', remove)
+    cache.evict()
+    assert npy_files(cache.directory) == sorted(set(names) - {oldest})
+    cache.clear()
+    assert os.listdir(cache.directory) == []
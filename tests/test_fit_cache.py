@@ -0,0 +1,80 @@
+import numpy as np
+
+import faddeeva
+import fit_cache
+import fit_engine
+
+
+def make_key(cache, spec, x, y, y_err, model_settings=(), **settings):
+    return cache.key(fit_engine.CompiledModel(spec, *model_settings), x, y, y_err, **settings)
+
+
+def test_key_is_stable(tmp_path, three_peaks):
+    spec, x, y, y_err = three_peaks
+    cache = fit_cache.FitCache(tmp_path)
+    key = make_key(cache, spec, x, y, y_err, solver='leastsq')
+    # 別に作った同じ値の配列・モデルでも同じキー
+    assert make_key(cache, spec, x.copy(), list(y), y_err.copy(), solver='leastsq') == key
+    # None は省略と同じ、Voigt の計算方法の既定値は省略と同じ
+    assert make_key(cache, spec, x, y, y_err, solver='leastsq', max_nfev=None) == key
+    assert make_key(cache, spec, x, y, y_err, (faddeeva.DEFAULT_BACKEND,), solver='leastsq') == key
+
+
+def test_key_changes_with_inputs(tmp_path, three_peaks):
+    spec, x, y, y_err = three_peaks
+    cache = fit_cache.FitCache(tmp_path)
+    key = make_key(cache, spec, x, y, y_err, solver='leastsq')
+    y2 = y.copy()
+    y2[100] += 1e-9
+    fixed = spec._replace(bg_fixed=(True,) + spec.bg_fixed[1:])
+    moved = spec._replace(peaks=(spec.peaks[0]._replace(values=(1.0, 100.0, -18.0, 4.0, 4.0)),) + spec.peaks[1:])
+    others = [
+        make_key(cache, spec, x, y2, y_err, solver='leastsq'),
+        make_key(cache, spec, x[:-1], y[:-1], y_err[:-1], solver='leastsq'),
+        make_key(cache, fixed, x, y, y_err, solver='leastsq'),
+        make_key(cache, moved, x, y, y_err, solver='leastsq'),
+        make_key(cache, spec, x, y, y_err, solver='trf'),
+        make_key(cache, spec, x, y, y_err, solver='trf', loss='soft_l1'),
+        make_key(cache, spec, x, y, y_err, solver='leastsq', max_nfev=50),
+        make_key(cache, spec, x, y, y_err, ('rational', 1e-4), solver='leastsq'),
+        make_key(cache, spec, x, y, y_err, (None, None, fit_engine.WINDOW_RTOL), solver='leastsq'),
+        make_key(cache, spec, x, y, y_err, (None, None, None, fit_engine.CHEBYSHEV), solver='leastsq'),
+    ]
+    assert len(set(others + [key])) == len(others) + 1
+
+
+def test_cached_fit_round_trip(tmp_path, three_peaks):
+    spec, x, y, y_err = three_peaks
+    cache = fit_cache.FitCache(tmp_path)
+    first, cached = fit_cache.cached_fit(spec, x, y, y_err, cache=cache)
+    assert not cached
+    second, cached = fit_cache.cached_fit(spec, x, y, y_err, cache=cache)
+    assert cached
+    np.testing.assert_array_equal(second.best_values, first.best_values)
+    np.testing.assert_array_equal(second.stderr, first.stderr)
+    assert second.nfev == first.nfev and second.stopped is None
+    # 解法を変えると保存された結果は使わない
+    _, cached = fit_cache.cached_fit(spec, x, y, y_err, cache=cache, solver='trf')
+    assert not cached
+
+
+def test_stopped_fit_is_not_stored(tmp_path, three_peaks):
+    spec, x, y, y_err = three_peaks
+    cache = fit_cache.FitCache(tmp_path)
+    result, _ = fit_cache.cached_fit(spec, x, y, y_err, cache=cache, time_budget=0)
+    assert result.stopped == 'time'
+    _, cached = fit_cache.cached_fit(spec, x, y, y_err, cache=cache)
+    assert not cached
+
+
+def test_evict_keeps_size_limit(tmp_path, three_peaks):
+    spec, x, y, y_err = three_peaks
+    cache = fit_cache.FitCache(tmp_path)
+    result, _ = fit_cache.cached_fit(spec, x, y, y_err, cache=cache)
+    size = sum(p.stat().st_size for p in tmp_path.iterdir())
+    cache.max_bytes = int(2.5 * size)
+    for n in range(4):
+        cache.put(f'{n:064x}', result)
+    assert sum(p.stat().st_size for p in tmp_path.iterdir()) <= cache.max_bytes
+    cache.clear()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,71 @@
+import numpy as np
+
+import fit_engine
+
+# 形が固定のピーク (1, 3)、全項固定のピーク (2)、形が可変のピーク (4) と固定のバックグラウンド
+BG = ('5f', '0.02f', '0f', '0f', '0f')
+# (計算範囲を限る場合に範囲外の裾の補正が効くように、幅は x の範囲より十分細くする)
+PEAKS = [(1, ['1f', '120', '-20f', '0.6f', '3']),
+         (2, ['0f', '80f', '0f', '3', '0.4f']),
+         (3, ['-1f', '60', '25f', '0.3f', '0.3f']),
+         (4, ['0.5', '40', '35', '0.5', '0.3'])]
+
+
+def models(window_rtol=None):
+    spec = fit_engine.spec_from_entries(BG, PEAKS)
+    return (fit_engine.CompiledModel(spec, window_rtol=window_rtol),
+            fit_engine.CompiledModel(spec, window_rtol=window_rtol))
+
+
+def moved(compiled):
+    """可変パラメータだけを少し動かしたベクトル"""
+    p = compiled.values.copy()
+    p[compiled.free] *= 1.1
+    return p
+
+
+def test_fold_matches_unfolded():
+    x = np.linspace(-50, 50, 1001)
+    y = np.full_like(x, 10.0)
+    y_err = np.ones_like(x)
+    for window_rtol in (None, fit_engine.WINDOW_RTOL):
+        folded, plain = models(window_rtol)
+        folded.fold(x)
+        assert folded._folded is not None
+        p = moved(folded)
+        np.testing.assert_allclose(folded.residual(p, x, y, y_err), plain.residual(p, x, y, y_err),
+                                   rtol=1e-12, atol=1e-12)
+        # 範囲を限る場合の裾の偏微分は格子を使わずに計算するので、形を保存したピークの面積の偏微分は
+        # 遠方の裾の補間の分だけ違う
+        jac = plain.residual_jacobian(p, x, y_err)
+        atol = 1e-12 if window_rtol is None else 1e-6 * np.max(np.abs(jac))
+        np.testing.assert_allclose(folded.residual_jacobian(p, x, y_err), jac, rtol=1e-12, atol=atol)
+
+
+def test_fold_is_not_used_for_other_x_or_fixed_values():
+    x = np.linspace(-50, 50, 1001)
+    folded, plain = models()
+    folded.fold(x)
+    # 別の x
+    x2 = np.linspace(-40, 60, 501)
+    p = moved(folded)
+    np.testing.assert_allclose(folded.evaluate(p, x2), plain.evaluate(p, x2), rtol=1e-12, atol=1e-12)
+    # 同じ x でも固定パラメータの値が違う
+    p[folded.index['center_1']] = -18.0
+    np.testing.assert_allclose(folded.evaluate(p, x), plain.evaluate(p, x), rtol=1e-12, atol=1e-12)
+
+
+def test_fit_with_fold_matches_unfolded(three_peaks):
+    _, x, y, y_err = three_peaks
+    spec = fit_engine.spec_from_entries(('4', '0', '0f', '0f', '0f'),
+                                        [(1, ['1f', '100', '-20f', '3f', '3']),
+                                         (2, ['0f', '100', '0', '4', '4']),
+                                         (3, ['-1f', '50', '25f', '4f', '3f'])])
+    folded = fit_engine.fit(spec, x, y, y_err)
+    plain = fit_engine.CompiledModel(spec)
+    # fold しないモデル (fold を何もしないものに置き換える)
+    plain.fold = lambda x: None
+    unfolded = fit_engine.fit(plain, x, y, y_err)
+    np.testing.assert_allclose(folded.best_values, unfolded.best_values, rtol=1e-8)
+    np.testing.assert_allclose(folded.residual, unfolded.residual, rtol=1e-8, atol=1e-10)
+    assert folded.nfev == unfolded.nfev
@@ -0,0 +1,67 @@
+import numpy as np
+from scipy.optimize import leastsq
+
+import conftest
+import fit_engine
+import global_fit
+
+# 2つ目のデータセットは幅が同じで、面積と中心が違う
+SECOND_PEAKS = [(1, ['1f', '90', '-18', '3', '3']),
+                (2, ['0f', '110', '2', '3', '4']),
+                (3, ['-1f', '40', '23', '4', '3'])]
+
+
+def dataset(peaks, seed):
+    x = np.linspace(-50, 50, 801)
+    truth = fit_engine.CompiledModel(fit_engine.spec_from_entries(conftest.TRUE_BG, peaks))
+    rng = np.random.default_rng(seed)
+    y = rng.poisson(truth.evaluate(truth.values, x) * 20) / 20
+    return x, y, np.sqrt(np.maximum(y, 1) / 20)
+
+
+def stacked_leastsq(spec, datasets, shared):
+    """共通パラメータとデータセットごとのパラメータを1つのベクトルにした密な leastsq (比べるための解)"""
+    compiled = fit_engine.CompiledModel(spec)
+    i_shared = global_fit.shared_indices(compiled, shared)
+    i_local = np.array([i for i in compiled.free if i not in set(i_shared)], dtype=int)
+    n_shared, n_local = len(i_shared), len(i_local)
+
+    def vectors(q):
+        for n in range(len(datasets)):
+            p = compiled.values.copy()
+            p[i_shared] = q[:n_shared]
+            p[i_local] = q[n_shared + n * n_local:n_shared + (n + 1) * n_local]
+            yield p
+
+    def residual(q):
+        return np.concatenate([compiled.residual(p, *data) for p, data in zip(vectors(q), datasets)])
+
+    q0 = np.concatenate([compiled.values[i_shared]] + [compiled.values[i_local]] * len(datasets))
+    q, covar, _, _, _ = leastsq(residual, q0, full_output=True, ftol=1e-12, xtol=1e-12)
+    resid = residual(q)
+    chisqr = float(resid @ resid)
+    stderr = np.sqrt(np.diag(covar) * chisqr / (len(resid) - len(q)))
+    values = list(vectors(q))
+    errors = list(vectors(stderr))
+    return chisqr, values, errors, i_shared
+
+
+def test_shared_widths_match_stacked_leastsq():
+    datasets = [dataset(conftest.TRUE_PEAKS, 0), dataset(SECOND_PEAKS, 1)]
+    spec = fit_engine.spec_from_entries(('4', '0', '0f', '0f', '0f'), conftest.START_PEAKS)
+    shared = ['G_FWHM', 'L_FWHM']
+    result = global_fit.fit_global(spec, datasets, shared=shared)
+    assert result.success and result.stopped is None
+    chisqr, values, errors, i_shared = stacked_leastsq(spec, datasets, shared)
+    names = result.results[0].compiled.names
+    assert result.shared_names == [names[i] for i in i_shared] and len(i_shared) == 4
+    np.testing.assert_allclose(result.chisqr, chisqr, rtol=1e-6)
+    for fit, p, stderr in zip(result.results, values, errors):
+        free = fit.compiled.free
+        assert fit.stderr is not None
+        assert np.all(np.abs(fit.best_values[free] - p[free]) <= 1e-2 * stderr[free])
+        np.testing.assert_allclose(fit.stderr[free], stderr[free], rtol=1e-2)
+    # 共通パラメータはどちらのデータセットでも同じ値と誤差
+    first, second = result.results
+    np.testing.assert_array_equal(first.best_values[i_shared], second.best_values[i_shared])
+    np.testing.assert_allclose(first.stderr[i_shared], second.stderr[i_shared], rtol=1e-12)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import fit_engine
+import solvers
+
+
+def assert_same_optimum(result, reference):
+    free = reference.compiled.free
+    assert result.success and result.stderr is not None
+    np.testing.assert_allclose(result.chisqr, reference.chisqr, rtol=1e-6)
+    assert np.all(np.abs(result.best_values[free] - reference.best_values[free]) <= 1e-2 * reference.stderr[free])
+    np.testing.assert_allclose(result.stderr[free], reference.stderr[free], rtol=1e-2)
+
+
+@pytest.mark.parametrize('window_rtol', [None, fit_engine.WINDOW_RTOL])
+def test_sparse_matches_leastsq(three_peaks, window_rtol):
+    spec, x, y, y_err = three_peaks
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq', window_rtol=window_rtol)
+    result = solvers.fit(spec, x, y, y_err, solver='sparse', window_rtol=window_rtol)
+    assert_same_optimum(result, reference)
+
+
+def test_sparse_unsorted_x(three_peaks):
+    # x を並べ替えて計算範囲を求めるが、残差は元の順番で返す
+    spec, x, y, y_err = three_peaks
+    order = np.random.default_rng(1).permutation(len(x))
+    sorted_result = solvers.fit(spec, x, y, y_err, solver='sparse')
+    result = solvers.fit(spec, x[order], y[order], y_err[order], solver='sparse')
+    np.testing.assert_allclose(result.best_values, sorted_result.best_values, rtol=1e-8)
+    np.testing.assert_allclose(result.residual, sorted_result.residual[order], rtol=1e-6, atol=1e-8)
+
+
+def test_sparse_stops_at_time_budget(three_peaks):
+    spec, x, y, y_err = three_peaks
+    result = solvers.fit(spec, x, y, y_err, solver='sparse', time_budget=0)
+    assert result.stopped == 'time' and not result.success
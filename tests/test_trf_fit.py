@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import fit_engine
+import solvers
+import trf_fit
+
+
+def test_trf_matches_leastsq(three_peaks):
+    spec, x, y, y_err = three_peaks
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq')
+    result = solvers.fit(spec, x, y, y_err, solver='trf')
+    free = reference.compiled.free
+    assert result.success and result.stderr is not None
+    np.testing.assert_allclose(result.chisqr, reference.chisqr, rtol=1e-6)
+    assert np.all(np.abs(result.best_values[free] - reference.best_values[free]) <= 1e-2 * reference.stderr[free])
+    np.testing.assert_allclose(result.stderr[free], reference.stderr[free], rtol=1e-2)
+
+
+def test_trf_chebyshev_matches_leastsq(three_peaks):
+    spec, x, y, y_err = three_peaks
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq')
+    result = solvers.fit(spec, x, y, y_err, solver='trf', bg_basis=fit_engine.CHEBYSHEV)
+    np.testing.assert_allclose(result.chisqr, reference.chisqr, rtol=1e-6)
+
+
+@pytest.mark.parametrize('loss', ['soft_l1', 'huber', 'cauchy'])
+def test_robust_loss_ignores_spikes(three_peaks, loss):
+    spec, x, y, y_err = three_peaks
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq')
+    spiked = y.copy()
+    spiked[[100, 400, 650]] += 200 * y_err[[100, 400, 650]]
+    plain = solvers.fit(spec, x, spiked, y_err, solver='trf')
+    robust = solvers.fit(spec, x, spiked, y_err, solver='trf', loss=loss)
+    free = reference.compiled.free
+    # ロバストな損失関数の方が外れ値のないデータの最適値に近い
+    plain_shift = np.max(np.abs(plain.best_values[free] - reference.best_values[free]) / reference.stderr[free])
+    robust_shift = np.max(np.abs(robust.best_values[free] - reference.best_values[free]) / reference.stderr[free])
+    assert robust_shift < 0.1 * plain_shift
+
+
+def test_unknown_loss(three_peaks):
+    spec, x, y, y_err = three_peaks
+    with pytest.raises(ValueError):
+        trf_fit.fit(spec, x, y, y_err, loss='l2')
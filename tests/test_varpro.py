@@ -0,0 +1,104 @@
+import threading
+
+import numpy as np
+import pytest
+
+import conftest
+import fit_engine
+import solvers
+import varpro
+
+
+def assert_same_optimum(result, reference):
+    free = reference.compiled.free
+    assert result.success and result.stderr is not None
+    np.testing.assert_allclose(result.chisqr, reference.chisqr, rtol=1e-6)
+    assert np.all(np.abs(result.best_values[free] - reference.best_values[free]) <= 1e-2 * reference.stderr[free])
+    np.testing.assert_allclose(result.stderr[free], reference.stderr[free], rtol=1e-2)
+
+
+@pytest.mark.parametrize('window_rtol', [None, fit_engine.WINDOW_RTOL])
+def test_varpro_matches_leastsq(three_peaks, window_rtol):
+    spec, x, y, y_err = three_peaks
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq', window_rtol=window_rtol)
+    result = solvers.fit(spec, x, y, y_err, solver='varpro', window_rtol=window_rtol)
+    assert_same_optimum(result, reference)
+
+
+def test_varpro_jacobian_matches_finite_differences(three_peaks):
+    # Kaufman の近似は残差が小さい (最適値の近くの) 点で、射影した残差の偏微分の差分と (ほぼ) 同じ
+    spec, x, y, y_err = three_peaks
+    compiled = fit_engine.CompiledModel(spec)
+    projection = varpro.Projection(compiled, x, y, y_err)
+    best = solvers.fit(spec, x, y, y_err, solver='leastsq').best_values
+    p, resid = projection.solve(best)
+    jac = projection.jacobian(p)
+    for row, i in enumerate(projection.nonlinear):
+        step = 1e-6 * max(1.0, abs(p[i]))
+        shifted = p.copy()
+        shifted[i] += step
+        numeric = (projection.solve(shifted)[1] - resid) / step
+        np.testing.assert_allclose(jac[row], numeric, atol=1e-3 * np.abs(numeric).max())
+
+
+def test_varpro_polishes_negative_areas(three_peaks, monkeypatch):
+    # 何もない所 (データがへこんでいる所) の形を固定したピークは、解いた面積が負になるので制約付きで仕上げる
+    _, x, y, y_err = three_peaks
+    dip = fit_engine.CompiledModel(fit_engine.spec_from_entries(('0f', '0f', '0f', '0f', '0f'),
+                                                                [(1, ['1f', '20', '40', '3', '3'])]))
+    y = y - dip.evaluate(dip.values, x)
+    spec = fit_engine.spec_from_entries(('4', '0', '0f', '0f', '0f'),
+                                        conftest.START_PEAKS + [(4, ['1f', '10', '40f', '3f', '3f'])])
+    compiled = fit_engine.CompiledModel(spec)
+    projection = varpro.Projection(compiled, x, y, y_err)
+    area = compiled.peak_plan[3][1 + fit_engine.PEAK_FIELDS.index('area')]
+    assert projection.solve(compiled.values)[0][area] < 0
+    starts = []
+    fit = fit_engine.fit
+
+    def spy(*args, **kwargs):
+        starts.append(kwargs.get('start'))
+        return fit(*args, **kwargs)
+
+    monkeypatch.setattr(varpro.fit_engine, 'fit', spy)
+    result = solvers.fit(spec, x, y, y_err, solver='varpro')
+    monkeypatch.undo()
+    assert starts
+    reference = solvers.fit(spec, x, y, y_err, solver='leastsq')
+    assert result.best_values[area] >= 0
+    np.testing.assert_allclose(result.chisqr, reference.chisqr, rtol=1e-6)
+
+
+@pytest.mark.parametrize('max_nfev', [1, 3, 5])
+def test_varpro_honours_max_nfev(three_peaks, max_nfev):
+    # 仕上げ・やり直しも合わせた回数。MINPACK は反復の終わりで回数を確かめるので、1回の反復の分 (数回) は超えうる
+    spec, x, y, y_err = three_peaks
+    result = solvers.fit(spec, x, y, y_err, solver='varpro', max_nfev=max_nfev)
+    assert result.stopped == 'nfev' and not result.success
+    assert result.nfev <= max_nfev + 3
+    # 打ち切った値でも面積は範囲内
+    compiled = result.compiled
+    assert np.all(result.best_values[compiled.free] >= compiled.lower[compiled.free])
+
+
+def test_varpro_polish_and_retry_share_max_nfev(three_peaks):
+    # 負の面積の仕上げ (とやり直し) にも残りの回数だけを渡す
+    _, x, y, y_err = three_peaks
+    dip = fit_engine.CompiledModel(fit_engine.spec_from_entries(('0f', '0f', '0f', '0f', '0f'),
+                                                                [(1, ['1f', '20', '40', '3', '3'])]))
+    y = y - dip.evaluate(dip.values, x)
+    spec = fit_engine.spec_from_entries(('4', '0', '0f', '0f', '0f'),
+                                        conftest.START_PEAKS + [(4, ['1f', '10', '40f', '3f', '3f'])])
+    assert solvers.fit(spec, x, y, y_err, solver='varpro').nfev > 100
+    for max_nfev in (8, 20):
+        assert solvers.fit(spec, x, y, y_err, solver='varpro', max_nfev=max_nfev).nfev <= max_nfev + 3
+
+
+def test_varpro_stops_at_time_budget_and_cancel(three_peaks):
+    spec, x, y, y_err = three_peaks
+    result = solvers.fit(spec, x, y, y_err, solver='varpro', time_budget=0)
+    assert result.stopped == 'time' and not result.success
+    cancel = threading.Event()
+    cancel.set()
+    result = solvers.fit(spec, x, y, y_err, solver='varpro', cancel=cancel)
+    assert result.stopped == 'cancelled' and result.nfev <= 1
@@ -0,0 +1,131 @@
+"""範囲付き信頼領域法 (scipy.optimize.least_squares の 'trf') とロバストな損失関数によるフィット
+
+leastsq (MINPACK) は残差の2乗和を最小化するので、スパイクや死んだチャンネルのような外れ値が1点あるだけで
+そこに引っ張られて何百回も反復することがある。ここでは残差 (誤差で正規化したもの) に
+    'linear'  : rho(z) = z (通常の最小二乗)
+    'soft_l1' : rho(z) = 2 ((1 + z)^0.5 - 1)
+    'huber'   : rho(z) = z (z <= 1), 2 z^0.5 - 1 (z > 1)
+    'cauchy'  : rho(z) = ln(1 + z)
+(z = (残差 / f_scale)^2) の損失関数を使えるようにし、f_scale より大きい残差の重みを下げる。
+面積・FWHM >= 0 は変数変換せずに範囲 (bounds) としてそのまま渡す。x_scale (既定は 'jac') で
+パラメータの大きさをそろえ、収束の判定 (ftol, xtol, gtol) も指定できる。ヤコビアンは解析的な偏微分。
+共分散行列は最適値での (損失関数で重みを付けた) ヤコビアン J から (J^T J)^-1 × 2 cost / 自由度 で求める
+('linear' では leastsq と同じ換算χ^2 のスケール)。
+"""
+import numpy as np
+from scipy.optimize import least_squares
+
+import fit_engine
+
+LOSSES = ('linear', 'soft_l1', 'huber', 'cauchy')
+# 損失関数のスケール (誤差で正規化した残差の単位)。これより大きい残差を外れ値として扱う
+F_SCALE = 3.0
+# 収束の判定 (ftol, xtol は leastsq と同じ値)
+FTOL = 1.5e-8
+XTOL = 1.5e-8
+GTOL = 1e-8
+
+
+def fit(spec, x, y, y_err, max_nfev=None, voigt_backend=None, voigt_rtol=None, start=None, window_rtol=None,
+        bg_basis=None, loss='linear', f_scale=F_SCALE, x_scale='jac', ftol=FTOL, xtol=XTOL, gtol=GTOL,
+        time_budget=None, cancel=None):
+    """範囲付き信頼領域法で ModelSpec を x, y, y_err にフィットして FitResult を返す
+
+    引数は fit_engine.fit と同じ。loss は LOSSES のどれか、f_scale はそのスケール、
+    x_scale, ftol, xtol, gtol は least_squares にそのまま渡す。
+    """
+    if loss not in LOSSES:
+        raise ValueError(f"Unknown loss: {loss} (choose from {', '.join(LOSSES)})")
+    compiled = spec if isinstance(spec, fit_engine.CompiledModel) else \
+        fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+    compiled.fold(x)
+    free = compiled.free
+    if start is None:
+        start = compiled.values
+    else:
+        start = compiled.full_vector(np.clip(np.asarray(start, dtype=float)[free], compiled.lower[free], compiled.upper[free]))
+    # チェビシェフ多項式のバックグラウンドでは free の先頭 n_bg 個をその係数にする (fit_engine.fit と同じ)
+    basis = compiled.background_basis(x)
+    n_bg = 0 if basis is None else basis.size
+    if basis is not None:
+        bg_jac = -basis.vander(x) / y_err
+    budget = fit_engine.FitBudget(time_budget, cancel)
+    n_calls = [0]
+
+    def external(q):
+        p = compiled.full_vector(q)
+        if basis is not None:
+            p[:n_bg] = basis.to_monomial @ q[:n_bg]
+        return p
+
+    def func(q):
+        n_calls[0] += 1
+        p = external(q)
+        if basis is None:
+            resid = compiled.residual(p, x, y, y_err)
+        else:
+            p[:n_bg] = 0.0
+            resid = (y - compiled.evaluate(p, x) - basis.evaluate(q[:n_bg], x)) / y_err
+        if not np.all(np.isfinite(resid)):
+            raise ValueError("NaN values detected in the data or the model function.")
+        budget.check(q, resid)
+        return resid
+
+    def jac(q):
+        jacobian = compiled.residual_jacobian(external(q), x, y_err)
+        if basis is not None:
+            jacobian[:n_bg] = bg_jac
+        return jacobian.T
+
+    if max_nfev is None:
+        max_nfev = 2000 * (len(free) + 1)
+
+    q0 = start[free].copy()
+    if basis is not None:
+        q0[:n_bg] = basis.from_monomial(start[:n_bg])
+    stopped = None
+    with np.errstate(all='ignore'):
+        if len(free) == 0:
+            best_q, status, nfev, errmsg, cost, jacobian = q0, 1, 1, '', None, None
+        else:
+            try:
+                solution = least_squares(func, q0, jac=jac, bounds=(compiled.lower[free], compiled.upper[free]),
+                                         method='trf', loss=loss, f_scale=f_scale, x_scale=x_scale,
+                                         ftol=ftol, xtol=xtol, gtol=gtol, max_nfev=max_nfev)
+                best_q, status, nfev, errmsg = solution.x, solution.status, solution.nfev, solution.message
+                cost, jacobian = solution.cost, solution.jac
+            except fit_engine.FitStopped as stop:
+                # 損失関数を使う場合も、最良の値は残差の2乗和で選ぶ
+                stopped = stop.reason
+                best_q = q0 if budget.best is None else budget.best
+                status, nfev, errmsg, cost, jacobian = -1, n_calls[0], budget.message(stopped), None, None
+        best = external(best_q)
+        resid = compiled.residual(best, x, y, y_err)
+
+    success = status > 0
+    if success:
+        message = 'Fit succeeded.'
+    elif status == 0:
+        stopped = 'nfev'
+        message = f'Fit aborted: number of function evaluations > {max_nfev}.'
+    else:
+        message = errmsg
+
+    covar = None
+    if jacobian is not None:
+        try:
+            cov_q = np.linalg.inv(jacobian.T @ jacobian)
+        except np.linalg.LinAlgError:
+            cov_q = None
+        if cov_q is not None and np.all(np.isfinite(cov_q)):
+            nfree = max(1, len(resid) - len(free))
+            if basis is not None:
+                # チェビシェフ多項式の係数の部分は a = to_monomial @ c で変換する
+                transform = np.eye(len(free))
+                transform[:n_bg, :n_bg] = basis.to_monomial
+                cov_q = transform @ cov_q @ transform.T
+            covar = cov_q * (2 * cost / nfree)
+    return fit_engine.FitResult(compiled, best, resid, covar, nfev, success, message, start, stopped)
@@ -0,0 +1,265 @@
+"""リサンプリングによるパラメータの不確かさの推定
+
+leastsq の共分散行列から求める stderr は、重なったピークのように相関の強い場合は当てにならず、
+フィットが失敗扱いの場合は求まらない。ここではフィット結果 (FitResult) から
+    'bootstrap' : 残差ブートストラップ。y* = モデル + y_err × (正規化した残差を重複ありで並べ替えたもの)
+                  を最良値から再フィットする
+    'mcmc'      : アンサンブル MCMC (Goodman & Weare のストレッチ移動)。対数尤度は -χ^2/2 で、
+                  パラメータの範囲 (area, FWHM >= 0) と multistart.search_box の探索範囲の外は確率0
+                  (範囲がないと、フィットの悪い場合に幅や面積が無限に広がる)
+でパラメータの標本を作り、パーセンタイルで区間を求める。
+
+ブートストラップの再フィットは solver (solvers.SOLVERS) で行い、Voigt の計算方法・計算範囲 (window_rtol)・
+バックグラウンドの基底はフィット結果の CompiledModel と同じにする。
+計算は仕事を小分けにしてプロセスプールで並列に行う。乱数は seed から SeedSequence.spawn で
+仕事ごとに独立に作るので、ワーカー数によらず同じ seed なら同じ結果になる。
+標本は lmfit の Parameters ではなく (標本数 × パラメータ数) の配列で持つ。
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import fit_engine
+import multistart
+import solvers
+
+METHODS = ('bootstrap', 'mcmc')
+# ブートストラップの標本数と、1つの仕事で行う再フィットの数
+N_BOOTSTRAP = 1000
+BOOTSTRAP_CHUNK = 25
+# MCMC の1つのアンサンブルのステップ数、捨てる最初のステップ数、ウォーカー数 (可変パラメータ数の倍数)
+MCMC_STEPS = 2000
+MCMC_BURN = 500
+MCMC_WALKERS_FACTOR = 4
+# ストレッチ移動の幅
+STRETCH = 2.0
+# 区間の確率 (1σ 相当)
+LEVEL = 0.6827
+
+# ワーカープロセスごとに一度だけ作るモデルとデータ
+_worker = {}
+
+
+class Samples:
+    """パラメータの標本
+
+    names : 全パラメータの名前, values : (標本数 × パラメータ数) の配列 (失敗した再フィットは NaN),
+    chisqr : 標本ごとのχ^2, method : 'bootstrap' / 'mcmc', stopped : 途中で打ち切った場合 True
+    """
+
+    def __init__(self, names, values, chisqr, method, stopped=False, acceptance=None):
+        self.names = list(names)
+        self.values = values
+        self.chisqr = chisqr
+        self.method = method
+        self.stopped = stopped
+        self.acceptance = acceptance
+
+    @property
+    def n_valid(self):
+        return int(np.sum(np.all(np.isfinite(self.values), axis=1)))
+
+    def interval(self, level=LEVEL):
+        """パーセンタイル区間 (lower, upper) をパラメータごとの配列で返す"""
+        valid = self.values[np.all(np.isfinite(self.values), axis=1)]
+        if len(valid) == 0:
+            nan = np.full(len(self.names), np.nan)
+            return nan, nan.copy()
+        lower, upper = np.percentile(valid, [50 * (1 - level), 50 * (1 + level)], axis=0)
+        return lower, upper
+
+    def save(self, path):
+        """標本を npz ファイルに保存する"""
+        np.savez_compressed(path, names=np.array(self.names), values=self.values, chisqr=self.chisqr,
+                            method=self.method)
+
+
+def _init_worker(spec, x, y_err, best, model, scaled_resid, box, model_settings, solver, solver_options):
+    """ワーカープロセスの初期化 (model_settings は CompiledModel の voigt_backend, voigt_rtol, window_rtol, bg_basis)"""
+    _worker['box'] = box
+    _worker['compiled'] = fit_engine.CompiledModel(spec, *model_settings)
+    _worker['solver'] = solver
+    _worker['solver_options'] = solver_options
+    _worker['x'] = x
+    _worker['y_err'] = y_err
+    _worker['best'] = best
+    _worker['model'] = model
+    _worker['scaled_resid'] = scaled_resid
+    _worker['compiled'].fold(x)
+
+
+def _bootstrap_task(seed_seq, n):
+    """n 回の残差ブートストラップの再フィット"""
+    rng = np.random.default_rng(seed_seq)
+    compiled, x, y_err = _worker['compiled'], _worker['x'], _worker['y_err']
+    model, scaled_resid = _worker['model'], _worker['scaled_resid']
+    values = np.full((n, len(compiled.names)), np.nan)
+    chisqr = np.full(n, np.nan)
+    for k in range(n):
+        y = model + y_err * scaled_resid[rng.integers(0, len(x), len(x))]
+        try:
+            result = solvers.fit(compiled, x, y, y_err, solver=_worker['solver'], start=_worker['best'],
+                                 **_worker['solver_options'])
+        except ValueError:
+            continue
+        if result.success:
+            values[k] = result.best_values
+            chisqr[k] = result.chisqr
+    return values, chisqr, None
+
+
+def _mcmc_task(seed_seq, n_walkers, n_steps, burn, scale):
+    """1つのアンサンブル MCMC (ストレッチ移動、ウォーカーを半分ずつ更新)"""
+    rng = np.random.default_rng(seed_seq)
+    compiled, x, y_err = _worker['compiled'], _worker['x'], _worker['y_err']
+    # 元のデータ
+    y = _worker['model'] + y_err * _worker['scaled_resid']
+    free = compiled.free
+    lower = np.maximum(compiled.lower[free], _worker['box'][0][free])
+    upper = np.minimum(compiled.upper[free], _worker['box'][1][free])
+
+    def log_prob(q):
+        if np.any(q < lower) or np.any(q > upper):
+            return -np.inf, np.inf
+        with np.errstate(all='ignore'):
+            resid = compiled.residual(compiled.full_vector(q), x, y, y_err)
+        chi2 = float(resid @ resid)
+        return (-0.5 * chi2, chi2) if np.isfinite(chi2) else (-np.inf, np.inf)
+
+    # 最良値のまわりの小さな球から始める (範囲内に収める)
+    best = _worker['best'][free]
+    walkers = best + scale * rng.standard_normal((n_walkers, len(free)))
+    walkers = np.clip(walkers, lower, upper)
+    lp, chi2 = np.array([log_prob(q) for q in walkers]).T
+    kept = max(0, n_steps - burn)
+    chain = np.empty((kept, n_walkers, len(free)))
+    chain_chi2 = np.empty((kept, n_walkers))
+    accepted = 0
+    half = n_walkers // 2
+    for step in range(n_steps):
+        for first, second in ((slice(0, half), slice(half, None)), (slice(half, None), slice(0, half))):
+            active = walkers[first]
+            others = walkers[second]
+            n_active = len(active)
+            z = ((STRETCH - 1) * rng.random(n_active) + 1)**2 / STRETCH
+            partners = others[rng.integers(0, len(others), n_active)]
+            proposal = partners + z[:, None] * (active - partners)
+            new_lp, new_chi2 = np.array([log_prob(q) for q in proposal]).T
+            # 今の位置の確率が0 (初期値を範囲内に収めた場合) なら範囲内の提案は必ず受け入れる
+            with np.errstate(invalid='ignore'):
+                log_accept = np.where(np.isfinite(lp[first]),
+                                      (len(free) - 1) * np.log(z) + new_lp - lp[first], np.inf)
+            accept = np.log(rng.random(n_active)) < log_accept
+            walkers[first][accept] = proposal[accept]
+            lp[first][accept] = new_lp[accept]
+            chi2[first][accept] = new_chi2[accept]
+            accepted += int(accept.sum())
+        if step >= burn:
+            chain[step - burn] = walkers
+            chain_chi2[step - burn] = chi2
+    values = np.tile(compiled.values, (kept * n_walkers, 1))
+    values[:, free] = chain.reshape(-1, len(free))
+    return values, chain_chi2.ravel(), accepted / max(1, n_steps * n_walkers)
+
+
+def estimate(result, x, y, y_err, method='bootstrap', n_samples=N_BOOTSTRAP, n_steps=MCMC_STEPS, burn=MCMC_BURN,
+             n_walkers=None, workers=None, seed=None, cancel=None, progress=None, voigt_backend=None, voigt_rtol=None,
+             solver=solvers.DEFAULT_SOLVER, solver_options=None):
+    """FitResult の不確かさをブートストラップまたは MCMC で推定して Samples を返す
+
+    'bootstrap' は n_samples 回の再フィット、'mcmc' はワーカー数と同じ数の独立なアンサンブル
+    (それぞれ n_walkers 個のウォーカーで n_steps ステップ、最初の burn ステップを捨てる) を作る。
+    cancel (is_set() を持つもの) で打ち切ると、それまでに終わった仕事の標本を返す。
+    progress(n_done, n_tasks) は仕事が終わるたびに呼び出し元のスレッドで呼ぶ。
+    再フィットは solver に solver_options (trf の loss, max_nfev など) を付けて行う。voigt_backend, voigt_rtol を
+    省略すると result.compiled と同じ計算方法を使う。result.compiled は呼び出し元のスレッドでも使われうるので
+    (計算用のバッファを持つ)、ここでは同じ設定の CompiledModel を作り直して使う。
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown uncertainty method: {method} (choose from {', '.join(METHODS)})")
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+    if solver not in solvers.SOLVERS:
+        raise ValueError(f"Unknown solver: {solver} (choose from {', '.join(solvers.SOLVERS)})")
+    model_settings = (result.compiled.voigt_backend if voigt_backend is None else voigt_backend,
+                      result.compiled.voigt_rtol if voigt_rtol is None else voigt_rtol,
+                      result.compiled.window_rtol, result.compiled.bg_basis)
+    compiled = fit_engine.CompiledModel(result.compiled.spec, *model_settings)
+    best = result.best_values
+    model = compiled.evaluate(best, x)
+    scaled_resid = (y - model) / y_err
+    workers = workers or os.cpu_count() or 1
+    seeds = np.random.SeedSequence(seed)
+
+    if method == 'bootstrap':
+        sizes = [BOOTSTRAP_CHUNK] * (n_samples // BOOTSTRAP_CHUNK)
+        if n_samples % BOOTSTRAP_CHUNK:
+            sizes.append(n_samples % BOOTSTRAP_CHUNK)
+        tasks = [(_bootstrap_task, (child, n)) for child, n in zip(seeds.spawn(len(sizes)), sizes)]
+    else:
+        nfree = len(compiled.free)
+        n_walkers = n_walkers or max(2 * nfree + 2, MCMC_WALKERS_FACTOR * nfree)
+        n_walkers += n_walkers % 2
+        # 初期の球の大きさ : stderr があればその 1/10、なければ値の 1e-4
+        if result.stderr is not None and np.all(np.isfinite(result.stderr[compiled.free])):
+            scale = 0.1 * result.stderr[compiled.free] + 1e-12
+        else:
+            scale = 1e-4 * np.abs(best[compiled.free]) + 1e-8
+        tasks = [(_mcmc_task, (child, n_walkers, n_steps, burn, scale)) for child in seeds.spawn(workers)]
+
+    box = None
+    if method == 'mcmc':
+        # search_box で範囲を決めないパラメータ (lower = upper) は範囲なし。最良値は必ず範囲内にする
+        box_lower, box_upper = multistart.search_box(compiled, x, y)
+        open_ended = box_lower == box_upper
+        box = (np.where(open_ended, -np.inf, np.minimum(box_lower, best)),
+               np.where(open_ended, np.inf, np.maximum(box_upper, best)))
+    initargs = (compiled.spec, x, y_err, best, model, scaled_resid, box, model_settings, solver,
+                dict(solver_options or {}))
+    outputs = [None] * len(tasks)
+    stopped = False
+
+    def cancelled():
+        return cancel is not None and cancel.is_set()
+
+    if workers == 1:
+        _init_worker(*initargs)
+        for i, (func, args) in enumerate(tasks):
+            if cancelled():
+                stopped = True
+                break
+            outputs[i] = func(*args)
+            if progress is not None:
+                progress(i + 1, len(tasks))
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs)
+        try:
+            pending = {executor.submit(func, *args): i for i, (func, args) in enumerate(tasks)}
+            n_done = 0
+            while pending:
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    outputs[pending.pop(future)] = future.result()
+                    n_done += 1
+                    if progress is not None:
+                        progress(n_done, len(tasks))
+                if pending and cancelled():
+                    stopped = True
+                    for future in pending:
+                        future.cancel()
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    finished = [output for output in outputs if output is not None]
+    if finished:
+        values = np.concatenate([output[0] for output in finished])
+        chisqr = np.concatenate([output[1] for output in finished])
+    else:
+        values, chisqr = np.empty((0, len(compiled.names))), np.empty(0)
+    acceptance = None
+    if method == 'mcmc' and finished:
+        acceptance = float(np.mean([output[2] for output in finished]))
+    return Samples(compiled.names, values, chisqr, method, stopped, acceptance)
@@ -0,0 +1,221 @@
+"""変数射影法 (variable projection) によるフィット
+
+バックグラウンドの係数 (bg_a..bg_e) とピークの面積 (area_i) はモデルに線形に入るので、
+非線形パラメータ (center, FWHM, ratio) を決めれば、線形最小二乗で厳密に求まる。
+外側の leastsq は非線形パラメータだけを動かし、残差は線形パラメータを最適にした後のものを使う。
+探索する次元がおよそ半分になり、面積の初期値が悪くても収束しやすい。
+
+外側のヤコビアンは Kaufman の近似 (線形パラメータを固定したモデルの偏微分を、線形パラメータの列の
+張る空間の直交補空間に射影したもの) を解析的に求める。
+
+探索中は面積の >= 0 の制約を付けない (面積が0に張り付くとそのピークの center や FWHM を
+動かしても残差が変わらず、そこで止まってしまうため)。解いた面積が範囲内なら、それがそのまま
+制約付きの最適値なので、共分散行列は全可変パラメータのヤコビアンから求める。範囲外の面積が
+あれば全パラメータを fit_engine.fit で制約付きで仕上げる。
+center の初期値がピークから FWHM 以上離れていると、面積が0になってそのピークが動かなくなる。
+面積が0のピークが残った場合や誤差が求まらない場合は、テンプレートの初期値からも fit_engine.fit で
+フィットして、誤差の求まった方、どちらも同じならχ^2 の小さい方を採用する
+(fit_engine.fit_series のやり直しと同じ考え方)。
+"""
+import numpy as np
+from scipy.optimize import leastsq
+
+import fit_engine
+
+
+class Projection:
+    """非線形パラメータから線形パラメータを解いて残差を計算する"""
+
+    def __init__(self, compiled, x, y, y_err):
+        self.compiled = compiled
+        self.x, self.y, self.y_err = x, y, y_err
+        compiled.fold(x)
+        vary = compiled.vary
+        i_area = 1 + fit_engine.PEAK_FIELDS.index('area')
+        # 可変の線形パラメータ : バックグラウンドの係数 (次数 k) と面積 (ピークの位置)
+        self.bg_linear = [k for k in range(len(fit_engine.BG_NAMES)) if vary[k]]
+        self.area_linear = [(plan[i_area], position) for position, plan in enumerate(compiled.peak_plan)
+                            if vary[plan[i_area]]]
+        self.linear = np.array(self.bg_linear + [i for i, _ in self.area_linear], dtype=int)
+        self.nonlinear = np.setdiff1d(compiled.free, self.linear)
+        # residual_jacobian の行 (可変パラメータの順) のうち非線形パラメータの行
+        self.nonlinear_rows = np.searchsorted(compiled.free, self.nonlinear)
+        # 最後に solve で解いた線形パラメータの列 (重み付き) の正規直交基底
+        self.basis = None
+        # バックグラウンドの列 x^k (非線形パラメータによらない)
+        self.powers = np.array([x**k for k in self.bg_linear]).reshape(len(self.bg_linear), len(x))
+
+    def design(self, p):
+        """線形パラメータの係数の行列 (線形パラメータ数 × データ数) と、それ以外の部分のモデルを返す"""
+        p = p.copy()
+        p[self.linear] = 0.0
+        base = self.compiled.evaluate(p, self.x, out=np.empty(len(self.x)))
+        if self.area_linear:
+            # 面積 1 の形 (evaluate と同じ計算範囲と裾の補正。面積について線形なので、その面積での偏微分と同じ)
+            p[[i for i, _ in self.area_linear]] = 1.0
+            shapes = self.compiled.peak_curves(p, self.x, windowed=True)[[position for _, position in self.area_linear]]
+            columns = np.vstack([self.powers, shapes])
+        else:
+            columns = self.powers
+        return columns, base
+
+    def solve(self, p):
+        """非線形パラメータ p (全パラメータのベクトル) に対して線形パラメータを解き、(全パラメータ, 残差) を返す"""
+        p = p.copy()
+        columns, base = self.design(p)
+        self.basis = None
+        if len(self.linear):
+            a = (columns / self.y_err).T
+            b = (self.y - base) / self.y_err
+            # x^k は x の範囲が大きいと列の大きさがそろわないので、列を正規化してから解く
+            norms = np.sqrt(np.einsum('ij,ij->j', a, a))
+            norms[norms == 0] = 1.0
+            a /= norms
+            u, sv, vt = np.linalg.svd(a, full_matrices=False)
+            # lstsq (rcond=None) と同じ打ち切りで、小さな特異値の方向は使わない
+            rank = int(np.sum(sv > sv[0] * max(a.shape) * np.finfo(float).eps)) if len(sv) and sv[0] > 0 else 0
+            u, sv, vt = u[:, :rank], sv[:rank], vt[:rank]
+            p[self.linear] = vt.T @ ((u.T @ b) / sv) / norms
+            self.basis = u
+        return p, self.compiled.residual(p, self.x, self.y, self.y_err)
+
+    def jacobian(self, p):
+        """solve で解いた p での非線形パラメータについての残差の偏微分 (Kaufman の近似、非線形パラメータ数 × データ数)
+
+        直前の solve と同じ p で呼ぶこと (線形パラメータの列の基底を使い回す)。
+        """
+        jac = self.compiled.residual_jacobian(p, self.x, self.y_err)[self.nonlinear_rows]
+        if self.basis is not None:
+            jac -= (jac @ self.basis) @ self.basis.T
+        return jac
+
+
+def fit(spec, x, y, y_err, max_nfev=None, voigt_backend=None, voigt_rtol=None, start=None, window_rtol=None,
+        bg_basis=None, time_budget=None, cancel=None):
+    """変数射影法で ModelSpec を x, y, y_err にフィットして FitResult を返す
+
+    引数は fit_engine.fit と同じ。max_nfev は外側の残差計算 (線形最小二乗を含む) と仕上げ・やり直しの
+    関数評価を合わせた回数の上限 (外側で使い切ったら仕上げずに、面積を範囲内に切り詰めて stopped='nfev' で返す。
+    fit_engine.fit と同じく MINPACK は反復の終わりで回数を確かめるので、1回の反復の分だけ超えることがある)。
+    bg_basis は仕上げの fit_engine.fit で使う (線形最小二乗では列を正規化するので基底によらない)。
+    nfev は外側の残差計算と仕上げの関数評価の合計。time_budget, cancel は外側と仕上げを合わせた打ち切りの条件。
+    """
+    compiled = spec if isinstance(spec, fit_engine.CompiledModel) else \
+        fit_engine.CompiledModel(spec, voigt_backend, voigt_rtol, window_rtol, bg_basis)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+    free = compiled.free
+    if start is None:
+        start = compiled.values
+    else:
+        start = compiled.full_vector(np.clip(np.asarray(start, dtype=float)[free], compiled.lower[free], compiled.upper[free]))
+    projection = Projection(compiled, x, y, y_err)
+    nonlinear = projection.nonlinear
+    bounds = fit_engine.BoundsTransform(compiled.lower[nonlinear], compiled.upper[nonlinear])
+    budget = fit_engine.FitBudget(time_budget, cancel)
+    nfev = [0]
+    last = [None]
+
+    def vector(internal):
+        p = start.copy()
+        p[nonlinear] = bounds.to_external(internal)
+        return p
+
+    def func(internal):
+        nfev[0] += 1
+        p, resid = projection.solve(vector(internal))
+        last[0] = (internal.copy(), p)
+        if not np.all(np.isfinite(resid)):
+            raise ValueError("NaN values detected in the data or the model function.")
+        budget.check(internal, resid)
+        return resid
+
+    def jac(internal):
+        # MINPACK は残差を計算した点でヤコビアンを求めるので、そのときに解いた線形パラメータを使う
+        if last[0] is None or not np.array_equal(last[0][0], internal):
+            func(internal)
+            nfev[0] -= 1
+        return projection.jacobian(last[0][1]) * bounds.gradient(internal)[:, None]
+
+    outer_nfev = 2000 * (len(nonlinear) + 1) if max_nfev is None else max_nfev
+
+    def remaining_nfev(used):
+        """仕上げ・やり直しに使える関数評価の回数 (上限がなければ None)"""
+        return None if max_nfev is None else max_nfev - used
+
+    with np.errstate(all='ignore'):
+        start_int = bounds.to_internal(start[nonlinear])
+        if len(nonlinear) == 0:
+            best_int, ier, errmsg = start_int, 1, ''
+            nfev[0] += 1
+        else:
+            try:
+                best_int, _, _, errmsg, ier = leastsq(
+                    func, start_int, Dfun=jac, col_deriv=1, full_output=1, ftol=1.5e-8, xtol=1.5e-8, gtol=0.0,
+                    maxfev=outer_nfev, epsfcn=1.e-10, factor=100)
+            except fit_engine.FitStopped as stop:
+                # 打ち切った場合は仕上げをしない
+                best, resid = projection.solve(vector(start_int if budget.best is None else budget.best))
+                return fit_engine.FitResult(compiled, best, resid, None, nfev[0], False, budget.message(stop.reason),
+                                            start, stop.reason)
+        best, resid = projection.solve(vector(best_int))
+
+    linear = projection.linear
+    feasible = np.all((best[linear] >= compiled.lower[linear]) & (best[linear] <= compiled.upper[linear]))
+    polish_nfev = remaining_nfev(nfev[0])
+    if ier == 5 or (not feasible and polish_nfev is not None and polish_nfev <= 0):
+        # 回数の上限に達したら仕上げない (範囲外の線形パラメータは範囲内に切り詰める)
+        message = f'Fit aborted: number of function evaluations > {outer_nfev}.'
+        if not feasible:
+            best[linear] = np.clip(best[linear], compiled.lower[linear], compiled.upper[linear])
+            resid = compiled.residual(best, x, y, y_err)
+        result = fit_engine.FitResult(compiled, best, resid, covariance(compiled, best, x, y_err, resid), 0,
+                                      False, message, start, 'nfev')
+    elif feasible:
+        # 解いた線形パラメータが範囲内なら仕上げずに、全可変パラメータのヤコビアンから共分散行列を求める
+        message = 'Fit succeeded.' if ier in (1, 2, 3) else errmsg
+        result = fit_engine.FitResult(compiled, best, resid, covariance(compiled, best, x, y_err, resid), 0,
+                                      ier in (1, 2, 3, 4), message, start)
+    else:
+        # 範囲外の面積があれば制約を付けて全パラメータで仕上げる
+        result = fit_engine.fit(compiled, x, y, y_err, max_nfev=polish_nfev, start=best,
+                                time_budget=budget.remaining(), cancel=cancel)
+        if ier not in (1, 2, 3, 4) and result.stopped is None:
+            result.success, result.message = False, errmsg
+    result.nfev += nfev[0]
+    i_area = 1 + fit_engine.PEAK_FIELDS.index('area')
+    areas = [i for i in (plan[i_area] for plan in compiled.peak_plan) if compiled.vary[i]]
+    # 面積が0のピークが残るか誤差が求まらない (ピークが遠くへ行った場合など) ときはテンプレートの初期値からもフィットする
+    # (打ち切った場合と、回数の上限に残りがない場合はしない)
+    retry_nfev = remaining_nfev(result.nfev)
+    if ((np.any(result.best_values[areas] <= 0) or not fit_engine._usable(result)) and result.stopped is None
+            and (retry_nfev is None or retry_nfev > 0)):
+        retry = fit_engine.fit(compiled, x, y, y_err, max_nfev=retry_nfev, start=start,
+                               time_budget=budget.remaining(), cancel=cancel)
+        retry.nfev += result.nfev
+        if (fit_engine._usable(retry), -retry.chisqr) > (fit_engine._usable(result), -result.chisqr):
+            return retry
+        result.nfev = retry.nfev
+    result.init_values = start
+    return result
+
+
+def covariance(compiled, p, x, y_err, resid):
+    """p での可変パラメータの共分散行列 (換算χ^2 でスケールする)。特異なら None"""
+    with np.errstate(all='ignore'):
+        jac = compiled.residual_jacobian(p, x, y_err)
+        # 列の大きさをそろえてから逆行列を求める (x のべきの係数とピークのパラメータで桁が違う)
+        norms = np.sqrt(np.einsum('ij,ij->i', jac, jac))
+        if not np.all(np.isfinite(norms)) or np.any(norms == 0):
+            return None
+        scaled = jac / norms[:, None]
+        try:
+            inverse = np.linalg.inv(scaled @ scaled.T)
+        except np.linalg.LinAlgError:
+            return None
+        nfree = max(1, len(resid) - len(compiled.free))
+        covar = inverse / np.outer(norms, norms) * ((resid**2).sum() / nfree)
+    if not np.all(np.isfinite(covar)) or np.any(np.diag(covar) < 0):
+        return None
+    return covar
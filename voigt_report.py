@@ -0,0 +1,76 @@
+"""Voigt 関数の backend ごとの精度と速度を表示する
+
+    python voigt_report.py [--points 1000000] [--repeat 5]
+
+結果を見て VOIGT_BACKEND / VOIGT_RTOL (環境変数) を配置先ごとに決める。
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.special import wofz
+
+import faddeeva
+import fit_engine
+
+# 比較する (backend, rtol)
+CANDIDATES = [('wofz', None), ('rational', 1e-4), ('rational', 1e-6), ('rational', 1e-8),
+              ('rational', 1e-10), ('rational', 1e-13), ('table', None)]
+# L_FWHM / G_FWHM の比 (小さいほどガウシアンに近い)
+SHAPE_RATIOS = [1e-3, 1e-2, 0.1, 0.5, 1.0, 2.0, 10.0, 100.0]
+
+
+def faddeeva_error(func):
+    """上半面の格子での |Δw|/|w| の最大値"""
+    x = np.concatenate([-np.logspace(-3, 3, 300), np.linspace(-8, 8, 401), np.logspace(-3, 3, 300)])
+    y = np.concatenate([[0.0], np.logspace(-6, 3, 200)])
+    z = x[None, :] + 1j * y[:, None]
+    exact = wofz(z)
+    return np.max(np.abs(func(z) - exact) / np.abs(exact))
+
+
+def profile_error(func):
+    """面積1の Voigt 関数の誤差の最大値 (ピーク高さとの比)"""
+    x = np.linspace(-50, 50, 20001)
+    worst = 0.0
+    for ratio in SHAPE_RATIOS:
+        exact = fit_engine.voigt(x, 0.0, 1.0, 1.0, ratio)
+        approx = fit_engine.voigt(x, 0.0, 1.0, 1.0, ratio, func)
+        worst = max(worst, np.max(np.abs(approx - exact)) / np.max(exact))
+    return worst
+
+
+def speed(func, points, repeat):
+    """1点あたりの計算時間 [ns] (中心 ±50 FWHM の範囲、L_FWHM = G_FWHM)"""
+    x = np.linspace(-50, 50, points)
+    sigma = fit_engine.SIGMA_PER_FWHM
+    z = (x + 0.5j) / (sigma * fit_engine.SQRT2)
+    out = np.empty_like(z)
+    func(z, out=out)  # 表の作成などの初回の処理を除く
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(z, out=out)
+        best = min(best, time.perf_counter() - start)
+    return best / points * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy/speed report of the Voigt backends.")
+    parser.add_argument('--points', type=int, default=1000000, help="number of points for the timing")
+    parser.add_argument('--repeat', type=int, default=5, help="number of timing repetitions")
+    args = parser.parse_args()
+
+    print(f"{'backend':<10}{'rtol':>8}{'max |dw|/|w|':>16}{'profile error':>16}{'ns/point':>12}{'speedup':>10}")
+    reference = None
+    for name, rtol in CANDIDATES:
+        func = faddeeva.get_backend(name, rtol)
+        t = speed(func, args.points, args.repeat)
+        reference = t if reference is None else reference
+        rtol_text = '-' if rtol is None else f"{rtol:.0e}"
+        print(f"{name:<10}{rtol_text:>8}{faddeeva_error(func):>16.2e}{profile_error(func):>16.2e}"
+              f"{t:>12.1f}{reference / t:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()